@@ -1,7 +1,7 @@
 import os
 os.environ["TF_USE_LEGACY_KERAS"] = "1" # needed for tfgnn
-from utils import utils_data, utils_graph
-from models import base_gnn
+from utils import utils_data, utils_graph, utils_tfrecord, utils_distribute, utils_random
+from models import base_gnn, band_gnn, dense_gnn, export_tflite
 
 import pandas as pd 
 import tensorflow as tf 
@@ -18,15 +18,31 @@ def main():
     
     tf.random.set_seed(32) # Possibly change seed if a model isn't working good !
 
+    # Data parallel training : None, 'mirrored' (local GPUs, or NUM_CPU_DEVICES logical CPU devices)
+    # or 'multi_worker' (configured through TF_CONFIG ; try it locally with utils_distribute.launch_local_workers(2, ['main.py']))
+    DISTRIBUTION = None
+    NUM_CPU_DEVICES = 4
+    # The strategy must be created before any other tensorflow operation runs
+    strategy = utils_distribute.get_strategy(DISTRIBUTION, num_cpu_devices = NUM_CPU_DEVICES)
+    NUM_WORKERS, WORKER_INDEX = utils_distribute.worker_info()
+
     SAMPLE_RATE = 16000 # given in the dataset
     FRAME_LENGTH = int(SAMPLE_RATE * 0.025)  # 25 ms 
     FRAME_STEP = int(SAMPLE_RATE * 0.010)  # 10 ms 
+    FEATURE_CACHE_DIR = 'feature_cache' # deterministic (val/test) features are computed once and streamed from here
+                                        # (shared by the workers : each one adds the features of its own files)
+    AUGMENTATION_SEED = 32 # the noise of every training example is drawn from (seed, epoch, file index) : reproducible epochs
+                           # (None for the stateful random ops)
+    TFLITE_EXPORT_DIR = None # e.g. 'tflite' : after training, export the model to TFLite (float32, float16, int8)
+    TFRECORD_EXPORT_DIR = None # e.g. 'graph_tfrecords' : export the ready-to-train graphs and stop
+                               # (train from them with utils_tfrecord.read_graph_tfrecords(f'{TFRECORD_EXPORT_DIR}/train', shuffle = True))
 
 
     # Load data
     train_files, train_labels, val_files, val_labels, test_files, test_labels, class_to_index = utils_data.load_audio_dataset(data_dir = 'speech_commands_v0.02',
                                                                                                                     validation_file = 'speech_commands_v0.02/validation_list.txt',
-                                                                                                                      test_file = 'speech_commands_v0.02/testing_list.txt')
+                                                                                                                      test_file = 'speech_commands_v0.02/testing_list.txt',
+                                                                                                                      use_manifest = True)
     
 
     # Check the data split (predefined in the text files)
@@ -48,16 +64,21 @@ def main():
 
 
     
+    augmentation_seeds = utils_random.AugmentationSeeds(AUGMENTATION_SEED) if AUGMENTATION_SEED is not None else None
+
     # noise = True to match 2015 google paper ; possibly do a comparison with noise = False
     train_ds, val_ds, test_ds = utils_data.create_tf_dataset(train_files, train_labels, sample_rate= SAMPLE_RATE, 
                                                              frame_length = FRAME_LENGTH, frame_step= FRAME_STEP,
-                                                              mode = 'train', gammatone = True, noise = True, spec_augmentation = False),\
+                                                              mode = 'train', gammatone = True, noise = True, spec_augmentation = False,
+                                                              num_shards = NUM_WORKERS, shard_index = WORKER_INDEX, augmentation_seeds = augmentation_seeds),\
                                 utils_data.create_tf_dataset(val_files, val_labels,sample_rate= SAMPLE_RATE, 
                                                              frame_length = FRAME_LENGTH, frame_step= FRAME_STEP,
-                                                              mode = 'val', gammatone = True, noise = False, spec_augmentation = False),\
+                                                              mode = 'val', gammatone = True, noise = False, spec_augmentation = False, cache_dir = FEATURE_CACHE_DIR,
+                                                              num_shards = NUM_WORKERS, shard_index = WORKER_INDEX),\
                                 utils_data.create_tf_dataset(test_files, test_labels, sample_rate= SAMPLE_RATE, 
                                                              frame_length = FRAME_LENGTH, frame_step= FRAME_STEP,
-                                                              mode = 'test', gammatone = True, noise = False, spec_augmentation = False)
+                                                              mode = 'test', gammatone = True, noise = False, spec_augmentation = False, cache_dir = FEATURE_CACHE_DIR,
+                                                              num_shards = NUM_WORKERS, shard_index = WORKER_INDEX)
     
 
 
@@ -101,16 +122,23 @@ def main():
 
     N_DILATION_LAYERS = 0
 
-    train_ds = train_ds.map(lambda mfcc, wav, label: utils_graph.create_adjacency_matrix(mfcc, N_FRAMES, label, mode='cosine window',window_size_cosine = 25, n_dilation_layers= N_DILATION_LAYERS, window_size=5, threshold = 0.3))
-    val_ds = val_ds.map(lambda mfcc, wav, label: utils_graph.create_adjacency_matrix(mfcc, N_FRAMES, label, mode='cosine window',window_size_cosine = 25, n_dilation_layers= N_DILATION_LAYERS, window_size=5, threshold = 0.3))
-    test_ds = test_ds.map(lambda mfcc, wav, label: utils_graph.create_adjacency_matrix(mfcc, N_FRAMES, label,mode='cosine window',window_size_cosine = 25, n_dilation_layers= N_DILATION_LAYERS, window_size=5, threshold = 0.3))
+    # Keep the val features, for the TFLite calibration and parity report
+    val_features_ds = val_ds
+
+    # For the banded modes ('window', 'cosine window') we build the edge lists directly (sparse),
+    # without materializing the dense adjacency matrices
+    train_ds = train_ds.map(lambda mfcc, wav, label: utils_graph.create_edge_lists(mfcc, N_FRAMES, label, mode='cosine window',window_size_cosine = 25, n_dilation_layers= N_DILATION_LAYERS, window_size=5))
+    val_ds = val_ds.map(lambda mfcc, wav, label: utils_graph.create_edge_lists(mfcc, N_FRAMES, label, mode='cosine window',window_size_cosine = 25, n_dilation_layers= N_DILATION_LAYERS, window_size=5))
+    test_ds = test_ds.map(lambda mfcc, wav, label: utils_graph.create_edge_lists(mfcc, N_FRAMES, label,mode='cosine window',window_size_cosine = 25, n_dilation_layers= N_DILATION_LAYERS, window_size=5))
     # Check the shape of the dataset
-    for mfcc, adjacency_matrices, label in train_ds.take(1):
+    for mfcc, edge_lists, label in train_ds.take(1):
         print(f"MFCC shape: {mfcc.shape}")
  
 
         print(f"Label shape: {label.shape}")
         example_mfcc = mfcc
+        # Dense version of the same graph, for visualization
+        _, adjacency_matrices, _ = utils_graph.create_adjacency_matrix(mfcc, N_FRAMES, label, mode='cosine window',window_size_cosine = 25, n_dilation_layers= N_DILATION_LAYERS, window_size=5)
         example_adjacency_matrix = adjacency_matrices[0]
 
     
@@ -144,38 +172,109 @@ def main():
 
 
  
+    # Backend of the model : 'tfgnn' (GraphTensors), 'band' (band_gnn : the same model computed
+    # with windowed operations on [batch, frames, features] tensors, for the banded modes only)
+    # or 'dense' (dense_gnn : padded edge lists per graph, no merge_batch_to_components)
+    GNN_BACKEND = 'tfgnn'
+    BANDS = band_gnn.bands_for_mode('cosine window', N_DILATION_LAYERS, window_size = 5, window_size_cosine = 25)
+    MAX_EDGES = dense_gnn.max_edges_for_bands(N_FRAMES, BANDS)
+    # Hyperparameters of the model, whatever the backend (also used by the parity check)
+    MODEL_KWARGS = {'n_message_passing_layers': 2, 'dilation': False, 'n_dilation_layers': 0}
+    # Check that the band / dense backend computes the same logits as the tfgnn one (same weights) before training
+    # (for the dense backend, every builder of dense_gnn.DENSE_BUILDERS is checked)
+    PARITY_CHECK = True
+    # The exports and the batching by edge count need GraphTensors
+    if GNN_BACKEND not in ('tfgnn', 'band', 'dense'):
+        raise ValueError(f"Unknown GNN_BACKEND: {GNN_BACKEND}")
+    if GNN_BACKEND != 'tfgnn' and (TFRECORD_EXPORT_DIR is not None or TFLITE_EXPORT_DIR is not None):
+        raise ValueError(f"TFRECORD_EXPORT_DIR and TFLITE_EXPORT_DIR are only supported with GNN_BACKEND = 'tfgnn' (got '{GNN_BACKEND}')")
+
+    if GNN_BACKEND == 'band' and PARITY_CHECK:
+        print("Parity with the tfgnn backend:", band_gnn.check_parity(val_ds, BANDS, num_frames = int(N_FRAMES), num_features = int(N_MFCCS), **MODEL_KWARGS))
+    elif GNN_BACKEND == 'dense' and PARITY_CHECK:
+        print("Parity with the tfgnn backend:", dense_gnn.check_parity(val_ds, MAX_EDGES, num_frames = int(N_FRAMES), num_features = int(N_MFCCS), **MODEL_KWARGS))
+
     # Finally, we create our final dataset, which puts mfcc's & adjacney matrices together into a graph
-    train_ds = train_ds.map(lambda mfcc, adjacency_matrices, label: base_gnn.mfccs_to_graph_tensors_for_dataset(mfcc, adjacency_matrices, label))
-    val_ds = val_ds.map(lambda mfcc, adjacency_matrices, label:  base_gnn.mfccs_to_graph_tensors_for_dataset(mfcc, adjacency_matrices, label))
-    test_ds = test_ds.map(lambda mfcc, adjacency_matrices, label:  base_gnn.mfccs_to_graph_tensors_for_dataset(mfcc, adjacency_matrices, label))
+    if GNN_BACKEND == 'band':
+        to_model_inputs = lambda mfcc, edge_lists, label: band_gnn.band_inputs_for_dataset(*band_gnn.edge_lists_to_band_weights(mfcc, edge_lists, label, BANDS))
+    elif GNN_BACKEND == 'dense':
+        to_model_inputs = lambda mfcc, edge_lists, label: dense_gnn.edge_lists_to_dense_graph_for_dataset(mfcc, edge_lists, label, MAX_EDGES)
+    else:
+        to_model_inputs = lambda mfcc, edge_lists, label: base_gnn.edge_lists_to_graph_tensors_for_dataset(mfcc, edge_lists, label)
+    train_ds = train_ds.map(to_model_inputs)
+    val_ds = val_ds.map(to_model_inputs)
+    test_ds = test_ds.map(to_model_inputs)
+
+    # Optionally export the graphs, so that training jobs can skip the audio processing entirely
+    if TFRECORD_EXPORT_DIR is not None:
+        for split, ds in [('train', train_ds), ('val', val_ds), ('test', test_ds)]:
+            utils_tfrecord.write_graph_tfrecords(ds, f'{TFRECORD_EXPORT_DIR}/{split}', num_shards = 16, compression = 'GZIP')
+        return
 
     # Now batch
 
-    BATCH_SIZE = 64
-    train_ds = train_ds.batch(BATCH_SIZE).prefetch(tf.data.AUTOTUNE)
+    # 64 graphs per replica and step
+    BATCH_SIZE = utils_distribute.global_batch_size(64, strategy)
+    # With a variable number of edges per graph ('similarity', thresholded 'cosine window'), the training
+    # graphs can instead be batched by edge count, with at most EDGE_BUDGET edges per batch (e.g. BATCH_SIZE * 2000).
+    # These batches are not padded (variable batch size and edge count) : do not combine with JIT_COMPILE,
+    # XLA would recompile the train step for every new shape
+    EDGE_BUDGET = None
+    if EDGE_BUDGET is not None and GNN_BACKEND != 'tfgnn':
+        raise ValueError(f"EDGE_BUDGET is only supported with GNN_BACKEND = 'tfgnn' (got '{GNN_BACKEND}')")
+    if EDGE_BUDGET is not None and NUM_WORKERS > 1:
+        # The number of batches by edge count depends on the graphs of each worker : the workers would not
+        # run the same number of steps, and the gradient all-reduce would hang at the end of the epoch
+        raise ValueError("EDGE_BUDGET is not supported with several workers")
+    if EDGE_BUDGET is not None:
+        boundaries = base_gnn.edge_count_boundaries(train_ds, num_buckets = 4)
+        train_ds = base_gnn.batch_by_edge_count(train_ds, boundaries, EDGE_BUDGET).prefetch(tf.data.AUTOTUNE)
+    else:
+        train_ds = train_ds.batch(BATCH_SIZE).prefetch(tf.data.AUTOTUNE)
     val_ds = val_ds.batch(BATCH_SIZE).prefetch(tf.data.AUTOTUNE)
     test_ds = test_ds.batch(BATCH_SIZE).prefetch(tf.data.AUTOTUNE)
 
+    # The files are already split across the workers (num_shards / shard_index above), with the same
+    # number of files on every worker : all the workers run the same number of steps per epoch
+    train_ds, val_ds, test_ds = [utils_distribute.set_auto_shard_policy(ds, file_based = False) for ds in (train_ds, val_ds, test_ds)]
+
 
 
     # Check the shape of the dataset
     for graph, label in train_ds.take(1):
-        print(f"Graph shape: {graph.shape}")
+        # (a GraphTensor, or the tensors of the band / dense inputs)
+        print(f"Graph shape: {tf.nest.map_structure(lambda t: t.shape, graph)}")
         print(f"Label shape: {label.shape}")
         print(label)
     
         # We need to get the graphs_spec for our model input
-        graphs_spec = graph.spec 
+        graphs_spec = graph.spec if GNN_BACKEND == 'tfgnn' else None
 
     # Note : GCN residual block we didn't implement the dilation mode
 
    
     
+    # Performance mode : mixed precision ('mixed_float16' on GPUs, 'mixed_bfloat16' on TPUs / recent CPUs)
+    # must be set before the model is built ; XLA pays off with static shapes (fixed edge counts, drop_remainder)
+    PRECISION = None
+    JIT_COMPILE = False
+    if JIT_COMPILE and EDGE_BUDGET is not None:
+        raise ValueError("The batches by edge count (EDGE_BUDGET) have variable shapes : XLA would recompile the train step at every batch")
+    STEPS_PER_EXECUTION = 1
+    PROFILE_DIR = None # e.g. 'logs/profile' : TensorBoard trace of steps 10-20, input wait vs compute, examples/sec and memory
+    base_gnn.set_precision(PRECISION)
+
     # Note that we actually have 35 classes !!! not like written in project B1
-    base_model = base_gnn.base_GATv2_model(graph_tensor_specification = graphs_spec,
-                                                  n_message_passing_layers = 2,
-                                                  dilation = False,
-                                                  n_dilation_layers= 0)
+    # (built under the strategy scope, with a per replica graph spec)
+    if GNN_BACKEND == 'band':
+        with strategy.scope():
+            base_model = band_gnn.band_GATv2_model(num_frames = int(N_FRAMES), num_features = int(N_MFCCS), bands = BANDS, **MODEL_KWARGS)
+    elif GNN_BACKEND == 'dense':
+        with strategy.scope():
+            base_model = dense_gnn.dense_gnn_model(MAX_EDGES, num_frames = int(N_FRAMES), num_features = int(N_MFCCS),
+                                                   builder = 'base_GATv2_model', **MODEL_KWARGS)
+    else:
+        base_model = utils_distribute.build_model(base_gnn.base_GATv2_model, graphs_spec, strategy, **MODEL_KWARGS)
                                                 #  skip_connection_type= 'sum')
 
 
@@ -191,7 +290,17 @@ def main():
                              test_ds = test_ds,
                              epochs = 2,
                              batch_size = BATCH_SIZE,
-                             learning_rate = 0.001)
+                             learning_rate = 0.001,
+                             jit_compile = JIT_COMPILE,
+                             steps_per_execution = STEPS_PER_EXECUTION,
+                             strategy = strategy,
+                             profile_dir = PROFILE_DIR,
+                             memory_sample_interval = 1.0,
+                             augmentation_seeds = augmentation_seeds)
+
+    if TFLITE_EXPORT_DIR is not None:
+        export_tflite.export_tflite(base_model, graphs_spec, val_features_ds, TFLITE_EXPORT_DIR, mode = 'cosine window',
+                                    graph_kwargs = {'window_size_cosine': 25, 'n_dilation_layers': N_DILATION_LAYERS, 'window_size': 5})
     
 
 
@@ -0,0 +1,126 @@
+import numpy as np
+import tensorflow as tf
+from utils import utils_distribute
+from models import base_gnn
+
+
+
+# Code shared by the backends of the GNNs that do not use GraphTensors
+# (band_gnn, dense_gnn) : the layers they have in common, and the tools
+# to check them against the tfgnn models of base_gnn.
+
+
+
+### LAYERS
+
+def dense(units, l2_reg_factor, dropout_rate, use_layer_normalization = False):
+    """ Dense layer with regularization (L2 & Dropout) & normalization (as in the base_gnn builders)"""
+    regularizer = tf.keras.regularizers.l2(l2_reg_factor)
+    result = tf.keras.Sequential([
+        tf.keras.layers.Dense(
+            units,
+            activation = "relu",
+            use_bias = True,
+            kernel_regularizer = regularizer,
+            bias_regularizer = regularizer),
+        tf.keras.layers.Dropout(dropout_rate)])
+    if use_layer_normalization:
+        result.add(tf.keras.layers.LayerNormalization())
+    return result
+
+
+class ContextGATv2(tf.keras.layers.Layer):
+    """
+    Dense version of tfgnn's GATv2Conv with receiver_tag = tfgnn.CONTEXT and the frames as senders :
+    every graph has exactly num_frames nodes, so the attention is a softmax over the frames axis.
+    The sublayers (and their variables) are the ones of GATv2Conv.
+    """
+
+    def __init__(self, num_heads, per_head_channels, l2_reg_factor, **kwargs):
+        super().__init__(**kwargs)
+        self.num_heads = num_heads
+        self.per_head_channels = per_head_channels
+        regularizer = tf.keras.regularizers.l2(l2_reg_factor)
+
+        self.w_query = tf.keras.layers.Dense(per_head_channels * num_heads, kernel_regularizer = regularizer, name = "query")
+        self.w_sender_node = tf.keras.layers.Dense(per_head_channels * num_heads, kernel_regularizer = regularizer, name = "value_node")
+        # One attention function per head
+        self.attention_logits_fn = tf.keras.layers.EinsumDense("...ik,ki->...i", output_shape = (num_heads,),
+                                                                kernel_regularizer = regularizer, name = "attn_logits")
+
+    def call(self, context_state, node_states):
+        batch_size, num_frames = tf.shape(node_states)[0], tf.shape(node_states)[1]
+
+        # [B, 1, heads, channels] and [B, num_frames, heads, channels]
+        query = tf.reshape(self.w_query(context_state), [batch_size, 1, self.num_heads, self.per_head_channels])
+        value = tf.reshape(self.w_sender_node(node_states), [batch_size, num_frames, self.num_heads, self.per_head_channels])
+
+        feature = tf.nn.leaky_relu(query + value, alpha = 0.2)
+        # [B, num_frames, heads, 1], normalized over the frames
+        logits = tf.expand_dims(self.attention_logits_fn(feature), -1)
+        attention_coefficients = tf.nn.softmax(logits, axis = 1)
+
+        pooled = tf.nn.relu(tf.reduce_sum(value * attention_coefficients, axis = 1))
+
+        # Concatenate the heads
+        return tf.reshape(pooled, [batch_size, self.num_heads * self.per_head_channels])
+
+
+
+### PARITY WITH THE TFGNN BACKEND
+
+def copy_weights(source_model, target_model):
+    """
+    Load the weights of a model in its counterpart of the other backend
+    (e.g. base_gnn.base_GATv2_model -> band_GATv2_model, built with the same hyperparameters).
+    """
+    source_shapes = [tuple(weight.shape) for weight in source_model.weights]
+    target_shapes = [tuple(weight.shape) for weight in target_model.weights]
+
+    if source_shapes != target_shapes:
+        raise ValueError(f"The models do not have the same variables:\n{source_shapes}\n{target_shapes}")
+
+    target_model.set_weights(source_model.get_weights())
+
+
+def graphs_spec_for_edge_lists(edge_lists_ds, batch_size = 32):
+    """
+    Spec of the batched GraphTensors of an edge lists dataset, to build the base_gnn models with.
+
+    Args:
+        edge_lists_ds: Unbatched dataset of (mfcc, edge_lists, label) (utils_graph.create_edge_lists)
+    """
+    graph_ds = edge_lists_ds.map(base_gnn.edge_lists_to_graph_tensors_for_dataset).batch(batch_size)
+
+    return utils_distribute.per_replica_graph_spec(graph_ds.element_spec[0])
+
+
+def parity_report(tfgnn_model, model, edge_lists_ds, to_model_inputs, batch_size = 32, num_batches = 4):
+    """
+    Compare the logits of a base_gnn model and of its counterpart of another backend on the same graphs.
+
+    Args:
+        tfgnn_model: Model of base_gnn, taking the GraphTensors
+        model: Its counterpart (with the same weights, see copy_weights)
+        edge_lists_ds: Unbatched dataset of (mfcc, edge_lists, label) (utils_graph.create_edge_lists)
+        to_model_inputs: Function (mfcc, edge_lists, label) -> (inputs of model, label)
+    Returns:
+        report: Dictionary with the largest absolute difference of the logits and the agreement of the predictions
+    """
+    graph_ds = edge_lists_ds.map(base_gnn.edge_lists_to_graph_tensors_for_dataset).batch(batch_size)
+    model_ds = edge_lists_ds.map(to_model_inputs).batch(batch_size)
+
+    max_abs_diff, agreement, num_examples = 0., 0, 0
+    for (graph, _), (inputs, _) in zip(graph_ds.take(num_batches), model_ds.take(num_batches)):
+        tfgnn_logits = tfgnn_model(graph, training = False).numpy()
+        logits = model(inputs, training = False).numpy()
+
+        max_abs_diff = max(max_abs_diff, float(np.max(np.abs(tfgnn_logits - logits))))
+        agreement += int(np.sum(np.argmax(tfgnn_logits, -1) == np.argmax(logits, -1)))
+        num_examples += len(tfgnn_logits)
+
+    return {
+        'num_examples': num_examples,
+        'max_abs_logit_diff': max_abs_diff,
+        'prediction_agreement': agreement / max(num_examples, 1),
+    }
@@ -0,0 +1,297 @@
+import numpy as np
+import tensorflow as tf
+from utils import utils_graph
+from models import base_gnn, backend_common
+
+
+
+# Band backend of the GNNs.
+# The graphs of the banded modes ('window', 'cosine window') only connect frames
+# that are at most max_distance apart, and every clip has the same 98 frames.
+# Message passing over such a graph is a 1-D windowed operation over the frames :
+# instead of broadcasting the node states to the edges and pooling them back
+# (tfgnn.broadcast_node_to_edges / pool_edges_to_node on a batch merged with
+# merge_batch_to_components), the models below work directly on [B, num_frames, D]
+# tensors, with the edge weights laid out per offset, [B, num_frames, num_offsets] :
+#     band_weights[b, i, k] = weight of the edge (i + offsets[k]) -> i   (0 if there is no such edge)
+# The weighted sum over the band is then a sum of num_offsets shifted (strided) slices
+# of the node states, and the attention to the context node a softmax over the frames axis.
+#
+# The computations are the same as the ones of the tfgnn layers (up to the summation
+# order of floating point numbers), and the models have the same variables in the same
+# order : weights trained with one backend can be loaded in the other (see backend_common.copy_weights).
+
+
+
+### BAND LAYOUT
+
+def bands_for_mode(mode = 'window', n_dilation_layers = 0, window_size = 5, window_size_cosine = 10):
+    """
+    (min_distance, max_distance] of every edge set built by utils_graph.create_edge_lists.
+
+    The dilated edge sets of the 'window' mode are the bands ((d-1) * window_size, d * window_size] ;
+    the ones of the 'cosine window' mode (d hops in the thresholded graph) lie within (0, d * window_size_cosine].
+
+    Returns:
+        bands: Tuple with one (min_distance, max_distance) tuple per edge set
+    """
+    dilation_rates = tuple(2 * (i + 1) for i in range(n_dilation_layers))
+
+    if mode == 'window':
+        return ((0, window_size),) + tuple(((rate - 1) * window_size, rate * window_size) for rate in dilation_rates)
+
+    if mode == 'cosine window':
+        return ((0, window_size_cosine),) + tuple((0, rate * window_size_cosine) for rate in dilation_rates)
+
+    raise ValueError("Unsupported mode for the band backend: {}".format(mode))
+
+
+def edge_lists_to_band_weights(mfcc, edge_lists, label, bands):
+    """
+    Convert the edge lists of one example (utils_graph.create_edge_lists) to the band layout.
+    Can be mapped on the dataset instead of base_gnn.edge_lists_to_graph_tensors_for_dataset.
+
+    Args:
+        mfcc: Node features [num_frames, num_features]
+        edge_lists: Tuple with one (sources, targets, weights) tuple per edge set
+        label: The label of the audio file
+        bands: Band of every edge set (see bands_for_mode) ; every edge must lie in its band
+    Returns:
+        mfcc: Node features [num_frames, num_features]
+        band_weights: Tuple with one [num_frames, num_offsets] tensor per edge set
+        label: The label of the audio file
+    """
+    num_frames = tf.shape(mfcc, out_type = tf.int64)[0]
+    band_weights = ()
+
+    for (sources, targets, weights), (min_distance, max_distance) in zip(edge_lists, bands):
+        offsets = utils_graph.band_offsets(max_distance, min_distance)
+
+        # Column of every offset in the band layout
+        columns = np.full(2 * max_distance + 1, -1, dtype = np.int64)
+        columns[offsets + max_distance] = np.arange(len(offsets))
+        edge_columns = tf.gather(tf.constant(columns), tf.cast(sources - targets, tf.int64) + max_distance)
+
+        # Messages flow from the sources to the targets : row = target
+        indices = tf.stack([tf.cast(targets, tf.int64), edge_columns], axis = 1)
+        band_weights += (tf.scatter_nd(indices, tf.cast(weights, tf.float32), tf.stack([num_frames, len(offsets)])),)
+
+    return mfcc, band_weights, label
+
+
+def create_band_weights(mfcc, num_frames, label, mode = 'window', n_dilation_layers = 0, window_size = 5, window_size_cosine = 10, cosine_window_thresh = 0.3):
+    """
+    Build the band weights directly from the MFCCs (same graph as utils_graph.create_edge_lists,
+    followed by edge_lists_to_band_weights), with the cosine similarities computed on shifted slices.
+
+    The dilated edge sets of the 'cosine window' mode depend on the thresholded graph :
+    they are built through the edge lists.
+
+    Returns:
+        mfcc: Node features [num_frames, num_features]
+        band_weights: Tuple with one [num_frames, num_offsets] tensor per edge set
+        label: The label of the audio file
+    """
+    bands = bands_for_mode(mode, n_dilation_layers, window_size, window_size_cosine)
+
+    if mode == 'cosine window' and n_dilation_layers > 0:
+        mfcc, edge_lists, label = utils_graph.create_edge_lists(mfcc, num_frames, label, mode = mode, n_dilation_layers = n_dilation_layers,
+                                                                window_size = window_size, window_size_cosine = window_size_cosine,
+                                                                cosine_window_thresh = cosine_window_thresh)
+        return edge_lists_to_band_weights(mfcc, edge_lists, label, bands)
+
+    num_frames = tf.get_static_value(num_frames)
+    if num_frames is None:
+        raise ValueError("The band backend needs a static number of frames.")
+    num_frames = int(num_frames)
+
+    band_weights = ()
+    for min_distance, max_distance in bands:
+        offsets = utils_graph.band_offsets(max_distance, min_distance)
+        # The offsets falling outside the clip have no edge
+        frames = np.arange(num_frames)[:, None] + offsets[None, :]
+        valid = tf.constant((frames >= 0) & (frames < num_frames), dtype = tf.float32)
+
+        if mode == 'window':
+            band_weights += (valid,)
+            continue
+
+        # Normalized cosine similarity of every frame with its neighbors in the band
+        normalized_features = tf.nn.l2_normalize(mfcc, axis = 1)
+        padded = tf.pad(normalized_features, [[max_distance, max_distance], [0, 0]])
+        neighbors = tf.stack([padded[max_distance + offset : max_distance + offset + num_frames] for offset in offsets], axis = 1)
+        weights = (tf.einsum('nf,nkf->nk', normalized_features, neighbors) + 1) / 2
+
+        # Same threshold as create_edge_lists
+        band_weights += (tf.where(weights >= cosine_window_thresh, weights, tf.zeros_like(weights)) * valid,)
+
+    return mfcc, band_weights, label
+
+
+def band_inputs_for_dataset(mfcc, band_weights, label):
+    """
+    Inputs of the band models, ((features, band_weights), label) (counterpart of base_gnn.edge_lists_to_graph_tensors_for_dataset).
+    """
+    return (mfcc, band_weights), label
+
+
+
+### LAYERS
+
+def band_weighted_sum(node_states, band_weights, offsets):
+    """
+    pooled[b, i] = sum_k band_weights[b, i, k] * node_states[b, i + offsets[k]]
+    (the sum over the incoming edges of each frame), as a sum of shifted slices.
+
+    Args:
+        node_states: [B, num_frames, D]
+        band_weights: [B, num_frames, len(offsets)]
+        offsets: Offsets of the band (numpy array)
+    """
+    num_frames = node_states.shape[1]
+    max_distance = int(np.max(np.abs(offsets)))
+    band_weights = tf.cast(band_weights, node_states.dtype)
+
+    padded = tf.pad(node_states, [[0, 0], [max_distance, max_distance], [0, 0]])
+
+    pooled = 0
+    for k, offset in enumerate(offsets):
+        start = max_distance + int(offset)
+        pooled += band_weights[:, :, k, None] * padded[:, start : start + num_frames]
+
+    return pooled
+
+
+class BandWeightedSumConvolution(tf.keras.layers.Layer):
+    """
+    Band version of the WeightedSumConvolution of base_GATv2_model (receiver_tag = tfgnn.TARGET).
+    """
+
+    def __init__(self, message_dim, offsets, l2_reg_factor, dropout_rate, use_layer_normalization, **kwargs):
+        super().__init__(**kwargs)
+        self.offsets = np.asarray(offsets)
+        self.dense = backend_common.dense(message_dim, l2_reg_factor, dropout_rate, use_layer_normalization)
+
+    def call(self, node_states, band_weights, training = None):
+        return self.dense(band_weighted_sum(node_states, band_weights, self.offsets), training = training)
+
+
+class BandGATv2Update(tf.keras.layers.Layer):
+    """
+    One message passing layer of base_GATv2_model (the GraphUpdate) : the frames are updated from
+    their band neighbors, then the context from the updated frames (with attention).
+    """
+
+    def __init__(self, offsets, message_dim, next_state_dim, num_heads, l2_reg_factor, dropout_rate, use_layer_normalization, **kwargs):
+        super().__init__(**kwargs)
+        self.convolution = BandWeightedSumConvolution(message_dim, offsets, l2_reg_factor, dropout_rate, use_layer_normalization)
+        self.node_next_state = backend_common.dense(next_state_dim, l2_reg_factor, dropout_rate, use_layer_normalization)
+        self.gat_convolution = backend_common.ContextGATv2(num_heads, per_head_channels = 128, l2_reg_factor = l2_reg_factor)
+        self.context_next_state = backend_common.dense(next_state_dim, l2_reg_factor, dropout_rate, use_layer_normalization)
+
+    def call(self, node_states, context_state, band_weights, training = None):
+        # NextStateFromConcat : [old state, pooled messages]
+        messages = self.convolution(node_states, band_weights, training = training)
+        node_states = self.node_next_state(tf.concat([node_states, messages], axis = -1), training = training)
+
+        messages = self.gat_convolution(context_state, node_states)
+        context_state = self.context_next_state(tf.concat([context_state, messages], axis = -1), training = training)
+
+        return node_states, context_state
+
+
+
+### MODELS
+
+def band_GATv2_model(
+        num_frames = 98,
+        num_features = 39,
+        bands = ((0, 5),),
+        initial_nodes_mfccs_layer_dims = 64,
+        message_dim = 128,
+        next_state_dim = 128,
+        num_classes = 35,
+        l2_reg_factor = 6e-6,
+        dropout_rate = 0.2,
+        use_layer_normalization = True,
+        n_message_passing_layers = 4,
+        dilation = False,
+        n_dilation_layers = 2,
+        ):
+    """
+    Band backend of base_GATv2_model (same hyperparameters, same variables).
+
+    Inputs: (features [B, num_frames, num_features], band_weights), with one
+    [B, num_frames, num_offsets] tensor per edge set (see create_band_weights / edge_lists_to_band_weights).
+
+    Args:
+        bands: Band of every edge set (see bands_for_mode)
+    """
+    features = tf.keras.layers.Input(shape = (num_frames, num_features), name = 'features')
+    band_weights = [tf.keras.layers.Input(shape = (num_frames, len(utils_graph.band_offsets(max_distance, min_distance))), name = f'weights_{i}')
+                    for i, (min_distance, max_distance) in enumerate(bands)]
+
+    node_states = tf.keras.layers.Dense(initial_nodes_mfccs_layer_dims, activation = "relu", name = 'init_states')(features)
+    # Empty context (as tfgnn.keras.layers.MakeEmptyFeature)
+    context_state = tf.zeros([tf.shape(features)[0], 0], dtype = node_states.dtype)
+
+    if not dilation:
+        n_dilation_layers = 1
+
+    for i in range(n_message_passing_layers):
+        dil_layer_num = i % n_dilation_layers # circular usage of the dilated edge sets
+        min_distance, max_distance = bands[dil_layer_num]
+        node_states, context_state = BandGATv2Update(utils_graph.band_offsets(max_distance, min_distance),
+                                                     message_dim, next_state_dim, num_heads = 2,
+                                                     l2_reg_factor = l2_reg_factor, dropout_rate = dropout_rate,
+                                                     use_layer_normalization = use_layer_normalization)(node_states, context_state, band_weights[dil_layer_num])
+
+    logits = tf.keras.layers.Dense(num_classes, dtype = 'float32')(context_state)
+
+    return tf.keras.Model((features, tuple(band_weights)), logits)
+
+
+
+### PARITY WITH THE TFGNN BACKEND
+
+def parity_report(tfgnn_model, band_model, edge_lists_ds, bands, batch_size = 32, num_batches = 4):
+    """
+    Compare the logits of the two backends on the same graphs (see backend_common.parity_report).
+
+    Args:
+        tfgnn_model: Model of base_gnn, taking the GraphTensors
+        band_model: Its band counterpart (with the same weights, see backend_common.copy_weights)
+        edge_lists_ds: Unbatched dataset of (mfcc, edge_lists, label) (utils_graph.create_edge_lists)
+        bands: Band of every edge set
+    """
+    to_band_inputs = lambda mfcc, edge_lists, label: band_inputs_for_dataset(*edge_lists_to_band_weights(mfcc, edge_lists, label, bands))
+
+    return backend_common.parity_report(tfgnn_model, band_model, edge_lists_ds, to_band_inputs, batch_size = batch_size, num_batches = num_batches)
+
+
+def check_parity(edge_lists_ds, bands, num_frames = 98, num_features = 39, tolerance = 1e-4, batch_size = 32, num_batches = 2, **model_kwargs):
+    """
+    Build base_gnn.base_GATv2_model and band_GATv2_model with the same hyperparameters, load the
+    weights of the first in the second and compare their logits (see parity_report).
+
+    Args:
+        edge_lists_ds: Unbatched dataset of (mfcc, edge_lists, label) (utils_graph.create_edge_lists)
+        bands: Band of every edge set
+        tolerance: Largest accepted absolute difference of the logits
+        model_kwargs: Hyperparameters of both models (n_message_passing_layers, dilation, ...)
+    Returns:
+        report: The parity report
+    Raises:
+        AssertionError: If the logits of the two backends differ by more than tolerance
+    """
+    graphs_spec = backend_common.graphs_spec_for_edge_lists(edge_lists_ds, batch_size)
+
+    tfgnn_model = base_gnn.base_GATv2_model(graphs_spec, **model_kwargs)
+    band_model = band_GATv2_model(num_frames = num_frames, num_features = num_features, bands = bands, **model_kwargs)
+    backend_common.copy_weights(tfgnn_model, band_model)
+
+    report = parity_report(tfgnn_model, band_model, edge_lists_ds, bands, batch_size = batch_size, num_batches = num_batches)
+    if report['max_abs_logit_diff'] > tolerance:
+        raise AssertionError(f"The band backend does not match the tfgnn backend: {report}")
+
+    return report
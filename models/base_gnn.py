@@ -3,6 +3,7 @@ import tensorflow_gnn as tfgnn
 import numpy as np 
 from tensorflow_gnn.models.gcn import gcn_conv
 from tensorflow_gnn.models.gat_v2.layers import GATv2Conv
+from utils import utils_profiling, utils_random
 #tf.config.run_functions_eagerly(True) 
 #tf.data.experimental.enable_debug_mode()
 
@@ -130,6 +131,115 @@ def mfccs_to_graph_tensors_for_dataset(mfcc, adjacency_matrices, label):
     return graph_tensor, label
 
 
+def edge_lists_to_graph_tensors_for_dataset(mfcc, edge_lists, label):
+    """
+    Same as mfccs_to_graph_tensors_for_dataset, but the edge sets are given
+    directly as edge lists (see utils_graph.create_edge_lists), so no
+    tf.where / gather_nd over dense adjacency matrices is needed.
+    
+    Args:
+        mfcc: MFCC features
+        edge_lists: Tuple of (sources, targets, weights), each will become an edge set
+        label: Class label
+    
+    Returns:
+        A tuple (graph_tensor, label) where graph_tensor contains one edge set per edge list
+    """
+    # Ensure current shape of MFCC (98 frames, 39 MFCCs)
+    mfcc_static = tf.reshape(mfcc, [98, 39])
+    
+    # Create the node set that will be shared by all edge sets
+    node_sets = {
+        "frames": tfgnn.NodeSet.from_fields(
+            features={"features": mfcc_static},  
+            sizes=[tf.shape(mfcc_static)[0]]
+        )
+    }
+    
+    # Create an edge set for each edge list
+    edge_sets = {}
+
+    for i, (sources, targets, weights) in enumerate(edge_lists):
+        edge_sets[f"connections_{i}"] = tfgnn.EdgeSet.from_fields(
+            features={"weights" : weights}, 
+            sizes=[tf.shape(sources)[0]],
+            adjacency=tfgnn.Adjacency.from_indices(
+                source=("frames", sources),
+                target=("frames", targets)
+            )
+        )
+    
+    # Create the graph tensor with all node sets and edge sets
+    graph_tensor = tfgnn.GraphTensor.from_pieces(
+        node_sets=node_sets,
+        edge_sets=edge_sets
+    )
+    
+    return graph_tensor, label
+
+
+def num_edges(graph):
+    """
+    Total number of edges (over all the edge sets) of a GraphTensor.
+    """
+    return tf.add_n([tf.reduce_sum(tf.cast(edge_set.sizes, tf.int64)) for edge_set in graph.edge_sets.values()])
+
+
+def edge_count_boundaries(ds, num_buckets = 4, num_examples = 512):
+    """
+    Bucket boundaries for batch_by_edge_count : quantiles of the number of edges per graph,
+    measured on the first num_examples graphs of ds (the last boundary is the largest graph seen).
+
+    Args:
+        ds: Unbatched dataset of (graph, label)
+        num_buckets: Number of buckets
+        num_examples: Number of graphs measured
+    Returns:
+        boundaries: List of increasing edge counts
+    """
+    counts = np.array([int(num_edges(graph)) for graph, _ in ds.take(num_examples)])
+
+    boundaries = np.percentile(counts, np.linspace(0, 100, num_buckets + 1)[1:])
+
+    return sorted(set(int(np.ceil(boundary)) for boundary in boundaries))
+
+
+def batch_by_edge_count(ds, boundaries, edge_budget):
+    """
+    Batch the graphs by number of edges (like tf.data.Dataset.bucket_by_sequence_length, for GraphTensors) :
+    the graphs are grouped in buckets (num_edges <= boundaries[0], <= boundaries[1], ...) and every
+    bucket gets the batch size edge_budget // boundaries[i], so that a batch never holds more than
+    edge_budget edges (whatever the mode of the graphs, e.g. 'similarity' or thresholded 'cosine window').
+    The step times stay flat and the memory bounded ; the graphs larger than the last boundary are batched alone.
+
+    The batches are capped, not padded : their number of graphs (last batch of every bucket) and their
+    total number of edges still vary from one batch to the next. This is meant for the eager / graph mode
+    train step : with jit_compile = True, XLA would recompile the step for (almost) every new shape.
+    For XLA, batch with a fixed size (drop_remainder = True) and fixed edge counts per graph instead.
+
+    Args:
+        ds: Unbatched dataset of (graph, label)
+        boundaries: Increasing upper bounds of the number of edges of each bucket (see edge_count_boundaries)
+        edge_budget: Maximum number of edges per batch
+    Returns:
+        Batched dataset of (graph, label), with a variable batch size
+    """
+    boundaries = [int(boundary) for boundary in boundaries]
+    batch_sizes = [max(1, edge_budget // boundary) for boundary in boundaries] + [1]
+
+    def key_func(graph, label):
+        # Index of the first bucket the graph fits in
+        return tf.reduce_sum(tf.cast(num_edges(graph) > tf.constant(boundaries, dtype=tf.int64), tf.int64))
+
+    def window_size_func(key):
+        return tf.gather(tf.constant(batch_sizes, dtype=tf.int64), key)
+
+    def reduce_func(key, window):
+        return window.batch(tf.gather(tf.constant(batch_sizes, dtype=tf.int64), key))
+
+    return ds.group_by_window(key_func = key_func, reduce_func = reduce_func, window_size_func = window_size_func)
+
+
 def mfccs_to_graph_tensors(mfccs, adjacency_matrices):
     """
     Convert MFCC features to graph tensors using custom adjacency matrices.
@@ -462,7 +572,9 @@ def base_gnn_model(
     # which is then representing the context vector (i.e. the "graph node")
     pooled_features = tfgnn.keras.layers.Pool(
         tfgnn.CONTEXT, "sum", node_set_name = "frames")(graph)  
-    logits = tf.keras.layers.Dense(num_classes)(pooled_features)
+
+    # The logits stay in float32, also under a mixed precision policy (see set_precision)
+    logits = tf.keras.layers.Dense(num_classes, dtype='float32')(pooled_features)
 
 
     
@@ -637,7 +749,7 @@ def base_gnn_model_learning_edge_weights(
     # which is then representing the context vector (i.e. the "graph node")
     pooled_features = tfgnn.keras.layers.Pool(
         tfgnn.CONTEXT, "sum", node_set_name = "frames")(graph)  
-    logits = tf.keras.layers.Dense(num_classes)(pooled_features)
+    logits = tf.keras.layers.Dense(num_classes, dtype='float32')(pooled_features)
 
 
     
@@ -873,7 +985,7 @@ def GAT_GCN_model(
     # Dropout # TODO: like in speechreco paper, see if it works/ m
     context_state = tf.keras.layers.Dropout(dropout_rate)(context_state)
 
-    logits = tf.keras.layers.Dense(num_classes)(context_state)
+    logits = tf.keras.layers.Dense(num_classes, dtype='float32')(context_state)
 
     model = tf.keras.Model(input_graph, logits)
 
@@ -1049,8 +1161,8 @@ def base_GATv2_model(
                 self.sender_tag,
                 feature_name="hidden_state") # Take the hidden state of the node
             
-            # Get edge weights
-            weights = graph.edge_sets[edge_set_name].features['weights']
+            # Get edge weights (in the compute dtype of the messages, e.g. float16 under mixed precision)
+            weights = tf.cast(graph.edge_sets[edge_set_name].features['weights'], messages.dtype)
             
             # Apply weights to messages
             weighted_messages = tf.expand_dims(weights, -1) * messages
@@ -1101,7 +1213,7 @@ def base_GATv2_model(
     # Dropout # TODO: like in speechreco paper, see if it works/ m
   #  context_state = tf.keras.layers.Dropout(dropout_rate)(context_state)
 
-    logits = tf.keras.layers.Dense(num_classes)(context_state)
+    logits = tf.keras.layers.Dense(num_classes, dtype='float32')(context_state)
 
 
     
@@ -1258,7 +1370,7 @@ def base_gnn_model_using_gcn(
 
     pooled_features = tfgnn.keras.layers.Pool(
         tfgnn.CONTEXT, "mean", node_set_name = "frames")(graph)   # maybe mean is not the best choice, consider also sum/max
-    logits = tf.keras.layers.Dense(num_classes)(pooled_features)
+    logits = tf.keras.layers.Dense(num_classes, dtype='float32')(pooled_features)
 
 
     
@@ -1409,7 +1521,7 @@ def base_gnn_model_using_gcn_with_residual_blocks(
         tfgnn.CONTEXT, "sum", node_set_name="frames")(graph)
     
     # Add a final classifier layer
-    logits = tf.keras.layers.Dense(num_classes)(pooled_features)
+    logits = tf.keras.layers.Dense(num_classes, dtype='float32')(pooled_features)
     
     # Create the model
     model = tf.keras.Model(input_graph, logits)
@@ -1581,7 +1693,7 @@ def base_gnn_with_context_node_model(
     # This represents the master node, which is updated in each message passing layer !
     context_state = graph.context.features['hidden_state']
 
-    logits = tf.keras.layers.Dense(num_classes)(context_state)
+    logits = tf.keras.layers.Dense(num_classes, dtype='float32')(context_state)
 
 
     
@@ -1768,8 +1880,8 @@ def base_gnn_weighted_model(
                 self.sender_tag,
                 feature_name="hidden_state") # Take the hidden state of the node
             
-            # Get edge weights
-            weights = graph.edge_sets[edge_set_name].features['weights']
+            # Get edge weights (in the compute dtype of the messages, e.g. float16 under mixed precision)
+            weights = tf.cast(graph.edge_sets[edge_set_name].features['weights'], messages.dtype)
             
             # Apply weights to messages
             weighted_messages = tf.expand_dims(weights, -1) * messages
@@ -1814,7 +1926,7 @@ def base_gnn_weighted_model(
 
     pooled_features = tfgnn.keras.layers.Pool(
         tfgnn.CONTEXT, "max", node_set_name = "frames")(graph)   
-    logits = tf.keras.layers.Dense(num_classes)(pooled_features)
+    logits = tf.keras.layers.Dense(num_classes, dtype='float32')(pooled_features)
 
 
     
@@ -1827,6 +1939,29 @@ def base_gnn_weighted_model(
 
 
 
+# Side of the edges on which the message passing of every builder receives the messages
+RECEIVER_TAGS = {
+    'base_gnn_model': tfgnn.SOURCE,
+    'base_gnn_model_learning_edge_weights': tfgnn.SOURCE,
+    'base_gnn_model_using_gcn': tfgnn.SOURCE,
+    'base_gnn_model_using_gcn_with_residual_blocks': tfgnn.SOURCE,
+    'base_gnn_with_context_node_model': tfgnn.SOURCE,
+    'base_gnn_weighted_model': tfgnn.TARGET,
+    'base_GATv2_model': tfgnn.TARGET,
+    'GAT_GCN_model': tfgnn.TARGET,
+}
+
+
+def knn_direction_for_builder(builder):
+    """
+    knn_direction of utils_graph.create_adjacency_matrix / create_edge_lists ('knn' mode) for which
+    every frame of the model built by builder receives exactly k messages : 'in' (neighbors -> frame)
+    for the builders receiving at tfgnn.TARGET, 'out' (frame -> neighbors) for the ones receiving at tfgnn.SOURCE.
+    """
+    return 'in' if RECEIVER_TAGS[builder] == tfgnn.TARGET else 'out'
+
+
+
 
 # NOTE: 
 # This model is just to see if my ATTENTION WEIGHTS are correctly detecting the important parts of the audio signal
@@ -1893,7 +2028,75 @@ def extract_attention(base_model):
 
 
 
-def train(model, train_ds, val_ds, test_ds, epochs = 50, batch_size = 32, use_callbacks = True, learning_rate = 0.001):
+def set_precision(precision = None):
+    """
+    Set the Keras dtype policy. Must be called before the model is built,
+    since every layer takes the policy that is active when it is created.
+
+    Args:
+        precision: None or 'float32' (default), 'mixed_float16' (GPUs) or 'mixed_bfloat16' (TPUs, recent CPUs)
+    """
+    tf.keras.mixed_precision.set_global_policy(precision or 'float32')
+
+
+def uses_float16(model):
+    """
+    Whether (some layers of) the model compute in float16, i.e. the loss needs to be scaled.
+    """
+    return any(layer.dtype_policy.compute_dtype == 'float16' for layer in model.layers)
+
+
+def compile_model(model, learning_rate = 0.001, jit_compile = False, steps_per_execution = 1):
+    """
+    Compile the model for training (see train).
+    """
+    # legacy due to running on mac m1
+    optimizer = tf.keras.optimizers.legacy.Adam(learning_rate = learning_rate)
+
+    # With float16 the small gradients underflow : scale the loss (dynamically) to keep them representable
+    if uses_float16(model):
+        optimizer = tf.keras.mixed_precision.LossScaleOptimizer(optimizer)
+
+    model.compile(
+        optimizer = optimizer,
+        # using sparse categorical bc our labels are encoded as numbers and not one-hot
+        loss = tf.keras.losses.SparseCategoricalCrossentropy(from_logits = True),
+        metrics = [tf.keras.metrics.SparseCategoricalAccuracy()],
+        # XLA compilation of the train step ; the shapes are static when all the batches
+        # have the same number of edges ('window' mode, batches with drop_remainder = True),
+        # otherwise XLA recompiles for every new shape
+        jit_compile = jit_compile,
+        # Number of batches run inside each tf.function call (less Python overhead per step)
+        steps_per_execution = steps_per_execution,
+       # run_eagerly = True
+    )
+
+    return model
+
+
+def train(model, train_ds, val_ds, test_ds, epochs = 50, batch_size = 32, use_callbacks = True, learning_rate = 0.001, jit_compile = False, steps_per_execution = 1, strategy = None,
+          profile_dir = None, profile_batches = (10, 20), input_wait_steps = 50, memory_sample_interval = None, augmentation_seeds = None):
+    """
+    Train and evaluate the model.
+
+    For mixed precision, call set_precision('mixed_float16' or 'mixed_bfloat16') before building
+    the model : the loss scaling is then added automatically (float16 only).
+
+    Args:
+        jit_compile: Compile the train step with XLA
+        steps_per_execution: Number of batches per tf.function call
+        strategy: tf.distribute strategy the model was built under (see utils_distribute.build_model);
+                  the datasets must then be batched with the global batch size
+        profile_dir: If given, the run is profiled (see utils_profiling) and the traces and
+                     profile_report.json are written to this directory
+        profile_batches: (first, last) step captured in the TensorBoard profiler trace (None for no trace)
+        input_wait_steps: Number of steps run one by one before fit, to split the step time into
+                          input pipeline wait and compute (the weights and optimizer state are
+                          restored afterwards, so fit starts from the initial model)
+        memory_sample_interval: If given, the host memory is sampled every memory_sample_interval seconds
+        augmentation_seeds: utils_random.AugmentationSeeds of the training dataset (if any) : its epoch
+                            is advanced after every epoch, so that every epoch gets new (reproducible) augmentations
+    """
 
     # Define callbacks
     callbacks = [
@@ -1910,21 +2113,43 @@ def train(model, train_ds, val_ds, test_ds, epochs = 50, batch_size = 32, use_ca
      #   )
     ]
 
+    # Callbacks that are always used
+    base_callbacks = []
+    if augmentation_seeds is not None:
+        base_callbacks.append(utils_random.EpochCallback(augmentation_seeds))
 
-    model.compile(
-        # legacy due to running on mac m1
-        optimizer = tf.keras.optimizers.legacy.Adam(learning_rate = learning_rate),
-        # using sparse categorical bc our labels are encoded as numbers and not one-hot
-        loss = tf.keras.losses.SparseCategoricalCrossentropy(from_logits = True),
-        metrics = [tf.keras.metrics.SparseCategoricalAccuracy()],
-       # run_eagerly = True
-    )
+
+    # The optimizer and metrics variables are mirrored like the model ones
+    with (strategy or tf.distribute.get_strategy()).scope():
+        compile_model(model, learning_rate = learning_rate, jit_compile = jit_compile, steps_per_execution = steps_per_execution)
+
+
+    # Opt-in profiling
+    profiling_callbacks, memory_sampler, profile_report = [], None, {}
+    if profile_dir is not None:
+        profiling_callbacks = utils_profiling.profiling_callbacks(profile_dir, batch_size, profile_batches = profile_batches)
+
+        if memory_sample_interval is not None:
+            memory_sampler = utils_profiling.MemorySampler(memory_sample_interval)
+            memory_sampler.start()
+
+        if input_wait_steps:
+            profile_report['input_wait'] = utils_profiling.measure_input_wait(model, train_ds, num_steps = input_wait_steps)
+            print(f"Input bound fraction of the step time: {profile_report['input_wait'].get('input_bound_fraction', float('nan')):.2f}")
 
 
     if use_callbacks:
-        history = model.fit(train_ds, validation_data = val_ds, epochs = epochs, callbacks = callbacks)
+        history = model.fit(train_ds, validation_data = val_ds, epochs = epochs, callbacks = base_callbacks + callbacks + profiling_callbacks)
     else:
-        history = model.fit(train_ds, validation_data = val_ds, epochs = epochs)
+        history = model.fit(train_ds, validation_data = val_ds, epochs = epochs, callbacks = base_callbacks + profiling_callbacks)
+
+
+    if profile_dir is not None:
+        profile_report['epochs'] = profiling_callbacks[-1].epochs
+        if memory_sampler is not None:
+            memory_sampler.stop()
+            profile_report['memory'] = memory_sampler.summary()
+        utils_profiling.write_profile_report(profile_dir, profile_report)
 
 
     # Evaluate the model
@@ -0,0 +1,510 @@
+import inspect
+import tensorflow as tf
+import tensorflow_gnn as tfgnn
+from utils import utils_graph
+from models import base_gnn, backend_common
+
+
+
+# Dense graph batches.
+# The base_gnn builders merge every batch of GraphTensors into one big graph
+# (merge_batch_to_components), which rebuilds the contiguous node / edge indices
+# of the B * 98 nodes and all their edges at every step. Here a batch of graphs is
+# instead a dictionary of plain (padded) tensors :
+#     'features'        : node features [B, num_frames, num_features]
+#     'connections_i'   : {'edges'   : (source, target) of every edge [B, max_edges, 2] (int32, local to the graph),
+#                          'mask'    : 1 for the real edges, 0 for the padding [B, max_edges],
+#                          'weights' : edge weights [B, max_edges]}
+# with a fixed max_edges per edge set, so that every tensor of the model has a static
+# shape (XLA friendly). The message passing gathers along the edges with batch_dims = 1
+# and pools with a segment sum in which the padded edges contribute nothing.
+#
+# Every message passing layer of base_gnn has its counterpart below, computing the
+# same values ; the dense_* builders mirror the base_gnn builders (same hyperparameters,
+# same variables in the same order, see backend_common.copy_weights).
+
+
+
+### DENSE GRAPH BATCHES
+
+def max_edges_for_bands(num_frames, bands):
+    """
+    Number of edges of each edge set of a banded graph, once all the candidate edges are kept
+    (an upper bound for the thresholded 'cosine window' graphs).
+
+    Args:
+        num_frames: Number of frames
+        bands: Band of every edge set (see band_gnn.bands_for_mode)
+    Returns:
+        max_edges: Tuple with the padded size of every edge set
+    """
+    return tuple(len(utils_graph.band_edges(int(num_frames), max_distance, min_distance)[0]) for min_distance, max_distance in bands)
+
+
+def edge_lists_to_dense_graph_for_dataset(mfcc, edge_lists, label, max_edges):
+    """
+    Counterpart of base_gnn.edge_lists_to_graph_tensors_for_dataset for the dense models :
+    the edge lists (see utils_graph.create_edge_lists) are padded to max_edges.
+
+    Args:
+        mfcc: MFCC features [num_frames, num_features]
+        edge_lists: Tuple of (sources, targets, weights), one per edge set
+        label: Class label
+        max_edges: Padded size of every edge set (see max_edges_for_bands)
+    Returns:
+        A tuple (dense_graph, label)
+    """
+    dense_graph = {'features': mfcc}
+
+    for i, ((sources, targets, weights), num_padded) in enumerate(zip(edge_lists, max_edges)):
+        num_edges = tf.shape(sources)[0]
+        tf.debugging.assert_less_equal(num_edges, num_padded, message = f"Too many edges in connections_{i}")
+        padding = [[0, num_padded - num_edges]]
+
+        edges = tf.stack([tf.pad(tf.cast(sources, tf.int32), padding), tf.pad(tf.cast(targets, tf.int32), padding)], axis = -1)
+
+        dense_graph[f'connections_{i}'] = {
+            'edges': tf.ensure_shape(edges, [num_padded, 2]),
+            'mask': tf.ensure_shape(tf.pad(tf.ones([num_edges], dtype = tf.float32), padding), [num_padded]),
+            'weights': tf.ensure_shape(tf.pad(tf.cast(weights, tf.float32), padding), [num_padded]),
+        }
+
+    return dense_graph, label
+
+
+def dense_graph_inputs(num_frames, num_features, max_edges):
+    """
+    Keras inputs of a dense graph batch (same structure as edge_lists_to_dense_graph_for_dataset).
+    """
+    inputs = {'features': tf.keras.layers.Input(shape = (num_frames, num_features), name = 'features')}
+
+    for i, num_padded in enumerate(max_edges):
+        inputs[f'connections_{i}'] = {
+            'edges': tf.keras.layers.Input(shape = (num_padded, 2), dtype = tf.int32, name = f'connections_{i}_edges'),
+            'mask': tf.keras.layers.Input(shape = (num_padded,), name = f'connections_{i}_mask'),
+            'weights': tf.keras.layers.Input(shape = (num_padded,), name = f'connections_{i}_weights'),
+        }
+
+    return inputs
+
+
+
+### OPERATIONS ON THE EDGES
+
+# Column of the incident node in the 'edges' tensor
+ENDPOINT_COLUMN = {tfgnn.SOURCE: 0, tfgnn.TARGET: 1}
+
+
+def broadcast_node_to_edges(node_states, edge_set, tag):
+    """
+    State of the tag (tfgnn.SOURCE / tfgnn.TARGET) node of every edge [B, max_edges, D].
+    """
+    return tf.gather(node_states, edge_set['edges'][..., ENDPOINT_COLUMN[tag]], batch_dims = 1)
+
+
+def pool_edges_to_node(values, edge_set, tag, num_nodes, reduce_type = 'sum'):
+    """
+    Pool the values of the edges [B, max_edges, D] to their tag node [B, num_nodes, D] ;
+    the padded edges are left out. reduce_type is 'sum' or 'mean' (0 for the nodes without edges, as in tfgnn).
+    """
+    mask = tf.cast(edge_set['mask'], values.dtype)
+    batch_size = tf.shape(values)[0]
+
+    # Graph b owns the segments [b * num_nodes, (b + 1) * num_nodes)
+    segment_ids = edge_set['edges'][..., ENDPOINT_COLUMN[tag]] + tf.range(batch_size)[:, None] * num_nodes
+    pooled = tf.math.unsorted_segment_sum(values * mask[..., None], segment_ids, batch_size * num_nodes)
+    pooled = tf.reshape(pooled, [batch_size, num_nodes, values.shape[-1]])
+
+    if reduce_type == 'mean':
+        counts = tf.reshape(tf.math.unsorted_segment_sum(mask, segment_ids, batch_size * num_nodes), [batch_size, num_nodes, 1])
+        pooled = tf.math.divide_no_nan(pooled, counts)
+    elif reduce_type != 'sum':
+        raise ValueError("Unsupported reduce_type: {}".format(reduce_type))
+
+    return pooled
+
+
+def pool_nodes_to_context(node_states, reduce_type = 'sum'):
+    """
+    Counterpart of tfgnn.keras.layers.Pool(tfgnn.CONTEXT, reduce_type, node_set_name = "frames").
+    """
+    if reduce_type == 'sum':
+        return tf.reduce_sum(node_states, axis = 1)
+    if reduce_type == 'mean':
+        return tf.reduce_mean(node_states, axis = 1)
+    if reduce_type == 'max':
+        return tf.reduce_max(node_states, axis = 1)
+
+    raise ValueError("Unsupported reduce_type: {}".format(reduce_type))
+
+
+
+### LAYERS
+
+class DenseSimpleConv(tf.keras.layers.Layer):
+    """
+    Counterpart of tfgnn.keras.layers.SimpleConv : message_fn is applied to the concatenation of
+    [edge state (if sender_edge_feature), sender state, receiver state (if receiver_feature)]
+    and the messages are pooled to the receivers.
+    """
+
+    def __init__(self, message_fn, reduce_type = 'sum', receiver_tag = tfgnn.TARGET, receiver_feature = True, sender_edge_feature = False, **kwargs):
+        super().__init__(**kwargs)
+        self.message_fn = message_fn
+        self.reduce_type = reduce_type
+        self.receiver_tag = receiver_tag
+        self.sender_tag = tfgnn.reverse_tag(receiver_tag)
+        self.receiver_feature = receiver_feature
+        self.sender_edge_feature = sender_edge_feature
+
+    def call(self, node_states, edge_set, edge_states = None, training = None):
+        inputs = []
+        if self.sender_edge_feature:
+            inputs.append(edge_states)
+        inputs.append(broadcast_node_to_edges(node_states, edge_set, self.sender_tag))
+        if self.receiver_feature:
+            inputs.append(broadcast_node_to_edges(node_states, edge_set, self.receiver_tag))
+
+        messages = self.message_fn(tf.concat(inputs, axis = -1), training = training)
+
+        return pool_edges_to_node(messages, edge_set, self.receiver_tag, node_states.shape[1], self.reduce_type)
+
+
+class DenseWeightedSumConvolution(tf.keras.layers.Layer):
+    """
+    Counterpart of the WeightedSumConvolution of base_GATv2_model and base_gnn_weighted_model.
+    """
+
+    def __init__(self, message_dim, receiver_tag, l2_reg_factor, dropout_rate, use_layer_normalization, **kwargs):
+        super().__init__(**kwargs)
+        self.receiver_tag = receiver_tag
+        self.sender_tag = tfgnn.reverse_tag(receiver_tag)
+        self.dense = backend_common.dense(message_dim, l2_reg_factor, dropout_rate, use_layer_normalization)
+
+    def call(self, node_states, edge_set, training = None):
+        messages = broadcast_node_to_edges(node_states, edge_set, self.sender_tag)
+        weighted_messages = tf.cast(edge_set['weights'], messages.dtype)[..., None] * messages
+        pooled_messages = pool_edges_to_node(weighted_messages, edge_set, self.receiver_tag, node_states.shape[1])
+
+        return self.dense(pooled_messages, training = training)
+
+
+class DenseGCNConv(tf.keras.layers.Layer):
+    """
+    Counterpart of tensorflow_gnn.models.gcn.gcn_conv.GCNConv (same options, the edge
+    weights are taken from the 'weights' of the edge set if use_edge_weights).
+    """
+
+    def __init__(self, units, receiver_tag = tfgnn.TARGET, activation = 'relu', use_bias = True, add_self_loops = False,
+                 kernel_regularizer = None, use_edge_weights = False, degree_normalization = 'in_out', **kwargs):
+        super().__init__(**kwargs)
+        if degree_normalization not in ('none', 'in', 'out', 'in_out', 'in_in'):
+            raise ValueError("Expecting degree_normalization to be `none`, `in`, `out`, `in_out`, or `in_in`.")
+
+        self.filter = tf.keras.layers.Dense(units, activation = activation, use_bias = use_bias, kernel_regularizer = kernel_regularizer)
+        self.receiver_tag = receiver_tag
+        self.sender_tag = tfgnn.reverse_tag(receiver_tag)
+        self.add_self_loops = add_self_loops
+        self.use_edge_weights = use_edge_weights
+        self.degree_normalization = degree_normalization
+
+    def call(self, node_states, edge_set):
+        num_nodes = node_states.shape[1]
+        edge_weights = (edge_set['weights'] if self.use_edge_weights else tf.ones_like(edge_set['mask']))[..., None]
+        edge_weights = tf.cast(edge_weights, node_states.dtype)
+
+        def get_degree(tag):
+            node_degree = pool_edges_to_node(edge_weights, edge_set, tag, num_nodes)
+            return node_degree + 1 if self.add_self_loops else tf.maximum(node_degree, 1)
+
+        sender_scale = receiver_scale = None
+        if self.degree_normalization == 'in':
+            receiver_scale = 1 / get_degree(self.receiver_tag)
+        elif self.degree_normalization == 'out':
+            sender_scale = 1 / get_degree(self.sender_tag)
+        elif self.degree_normalization == 'in_out':
+            sender_scale = tf.math.rsqrt(get_degree(self.sender_tag))
+            receiver_scale = tf.math.rsqrt(get_degree(self.receiver_tag))
+        elif self.degree_normalization == 'in_in':
+            sender_scale = receiver_scale = tf.math.rsqrt(get_degree(self.receiver_tag))
+
+        normalized_values = node_states if sender_scale is None else sender_scale * node_states
+
+        messages = broadcast_node_to_edges(normalized_values, edge_set, self.sender_tag)
+        if self.use_edge_weights:
+            messages = messages * edge_weights
+        pooled = pool_edges_to_node(messages, edge_set, self.receiver_tag, num_nodes)
+
+        if receiver_scale is not None:
+            pooled = receiver_scale * pooled
+        if self.add_self_loops:
+            pooled += normalized_values if receiver_scale is None else receiver_scale * normalized_values
+
+        return self.filter(pooled)
+
+
+class DenseEdgeSetUpdate(tf.keras.layers.Layer):
+    """
+    Counterpart of tfgnn.keras.layers.EdgeSetUpdate (edge_input_feature = tfgnn.HIDDEN_STATE, node_input_tags = (SOURCE, TARGET)) :
+    the new edge states are next_state([edge state, source state, target state]).
+    """
+
+    def __init__(self, next_state, **kwargs):
+        super().__init__(**kwargs)
+        self.next_state = next_state
+
+    def call(self, node_states, edge_set, edge_states, training = None):
+        return self.next_state(tf.concat([edge_states,
+                                          broadcast_node_to_edges(node_states, edge_set, tfgnn.SOURCE),
+                                          broadcast_node_to_edges(node_states, edge_set, tfgnn.TARGET)], axis = -1), training = training)
+
+
+class DenseNodeSetUpdate(tf.keras.layers.Layer):
+    """
+    Counterpart of a GraphUpdate with a NodeSetUpdate (NextStateFromConcat) on the frames,
+    optionally preceded by an EdgeSetUpdate and followed by a ContextUpdate (NextStateFromConcat) :
+        convolution : layer called as convolution(node_states, edge_set, ...) (DenseSimpleConv, DenseGCNConv, ...)
+        context_convolution : None, 'sum' / 'mean' / 'max' (pooling) or a layer called as context_convolution(context_state, node_states) (backend_common.ContextGATv2)
+    """
+
+    def __init__(self, convolution, next_state, edge_update = None, context_convolution = None, context_next_state = None, **kwargs):
+        super().__init__(**kwargs)
+        # Same order as in tfgnn.keras.layers.GraphUpdate : edge sets, node sets, context
+        self.edge_update = edge_update
+        self.convolution = convolution
+        self.next_state = next_state
+        self.context_convolution = context_convolution
+        self.context_next_state = context_next_state
+
+    def call(self, node_states, edge_set, edge_states = None, context_state = None, training = None):
+        if self.edge_update is not None:
+            edge_states = self.edge_update(node_states, edge_set, edge_states, training = training)
+            messages = self.convolution(node_states, edge_set, edge_states, training = training)
+        elif isinstance(self.convolution, DenseGCNConv):
+            messages = self.convolution(node_states, edge_set)
+        else:
+            messages = self.convolution(node_states, edge_set, training = training)
+
+        node_states = self.next_state(tf.concat([node_states, messages], axis = -1), training = training)
+
+        if self.context_convolution is None:
+            return node_states, edge_states, context_state
+
+        if isinstance(self.context_convolution, str):
+            messages = pool_nodes_to_context(node_states, self.context_convolution)
+        else:
+            messages = self.context_convolution(context_state, node_states)
+        context_state = self.context_next_state(tf.concat([context_state, messages], axis = -1), training = training)
+
+        return node_states, edge_states, context_state
+
+
+
+### MODELS
+
+def empty_context(node_states):
+    """ Empty context state [B, 0] (as tfgnn.keras.layers.MakeEmptyFeature)"""
+    return tf.zeros([tf.shape(node_states)[0], 0], dtype = node_states.dtype)
+
+
+def split_features_encoder(features, initial_nodes_mfccs_layer_dims, l2_reg_factor, dropout_rate):
+    """
+    Initial node states of GAT_GCN_model and base_gnn_weighted_model : the cepstra, deltas,
+    delta-deltas and energies are encoded separately, then together.
+    """
+    base_processed = backend_common.dense(24, l2_reg_factor, dropout_rate, use_layer_normalization = True)(features[..., 0:12])
+    delta_processed = backend_common.dense(24, l2_reg_factor, dropout_rate, use_layer_normalization = True)(features[..., 12:24])
+    delta_delta_processed = backend_common.dense(24, l2_reg_factor, dropout_rate, use_layer_normalization = True)(features[..., 24:36])
+    energy_processed = backend_common.dense(8, l2_reg_factor, dropout_rate, use_layer_normalization = True)(features[..., 36:39])
+
+    combined_features = tf.keras.layers.Concatenate()([base_processed, delta_processed, delta_delta_processed, energy_processed])
+
+    return backend_common.dense(initial_nodes_mfccs_layer_dims, l2_reg_factor, dropout_rate, use_layer_normalization = True)(combined_features)
+
+
+def dense_gnn_model(
+        max_edges,
+        num_frames = 98,
+        num_features = 39,
+        initial_nodes_mfccs_layer_dims = 64,
+        initial_edges_weights_layer_dims = 64,
+        message_dim = 128,
+        next_state_dim = 128,
+        num_classes = 35,
+        l2_reg_factor = 6e-6,
+        dropout_rate = 0.2,
+        use_layer_normalization = True,
+        n_message_passing_layers = 4,
+        dilation = False,
+        n_dilation_layers = 2,
+        skip_connection_type = None,
+        builder = 'base_gnn_model',
+        ):
+    """
+    Dense counterpart of the base_gnn builders.
+
+    Args:
+        max_edges: Padded size of every edge set (see max_edges_for_bands)
+        builder: Name of the base_gnn builder to mirror : 'base_gnn_model', 'base_gnn_model_learning_edge_weights',
+                 'base_gnn_model_using_gcn', 'base_gnn_with_context_node_model', 'base_gnn_weighted_model',
+                 'base_GATv2_model', 'GAT_GCN_model' or 'base_gnn_model_using_gcn_with_residual_blocks'
+                 (the latter has no dilation ; its single edge set is connections_0)
+        initial_edges_weights_layer_dims: Size of the edge states (base_gnn_model_learning_edge_weights only)
+        skip_connection_type: None or 'sum' (base_gnn_model_using_gcn_with_residual_blocks only)
+        The other arguments are the ones of the builders.
+    """
+    if builder not in DENSE_BUILDERS:
+        raise ValueError("Unsupported builder: {}".format(builder))
+
+    inputs = dense_graph_inputs(num_frames, num_features, max_edges)
+    features = inputs['features']
+
+    def dense(units, use_layer_normalization = False):
+        return backend_common.dense(units, l2_reg_factor, dropout_rate, use_layer_normalization)
+
+    def gcn_convolution(receiver_tag):
+        return DenseGCNConv(message_dim, receiver_tag = receiver_tag, activation = 'relu', use_bias = True,
+                            kernel_regularizer = tf.keras.regularizers.l2(l2_reg_factor), add_self_loops = False,
+                            use_edge_weights = True, degree_normalization = 'in')
+
+    # Initial states
+    if builder in ('GAT_GCN_model', 'base_gnn_weighted_model'):
+        node_states = split_features_encoder(features, initial_nodes_mfccs_layer_dims, l2_reg_factor, dropout_rate)
+    else:
+        node_states = tf.keras.layers.Dense(initial_nodes_mfccs_layer_dims, activation = "relu")(features)
+
+    edge_states = None
+    if builder == 'base_gnn_model_learning_edge_weights':
+        # Only the non-dilated edge set gets an edge state
+        edge_states = tf.keras.layers.Dense(initial_edges_weights_layer_dims, activation = "relu")(inputs['connections_0']['weights'][..., None])
+
+    context_state = None
+    if builder in ('base_gnn_with_context_node_model', 'base_GATv2_model', 'GAT_GCN_model'):
+        context_state = empty_context(node_states)
+
+    if not dilation or builder == 'base_gnn_model_using_gcn_with_residual_blocks':
+        n_dilation_layers = 1
+
+    for i in range(n_message_passing_layers):
+        dil_layer_num = i % n_dilation_layers # circular usage of the dilated edge sets
+        edge_set = inputs[f'connections_{dil_layer_num}']
+
+        edge_update, context_convolution, context_next_state = None, None, None
+
+        if builder == 'base_gnn_model':
+            convolution = DenseSimpleConv(dense(message_dim), "sum", receiver_tag = tfgnn.SOURCE)
+        elif builder == 'base_gnn_model_learning_edge_weights':
+            edge_update = DenseEdgeSetUpdate(dense(next_state_dim, use_layer_normalization))
+            convolution = DenseSimpleConv(dense(message_dim), "sum", receiver_tag = tfgnn.SOURCE, sender_edge_feature = True)
+        elif builder in ('base_gnn_model_using_gcn', 'base_gnn_model_using_gcn_with_residual_blocks'):
+            convolution = gcn_convolution(tfgnn.SOURCE)
+        elif builder == 'base_gnn_with_context_node_model':
+            convolution = DenseSimpleConv(dense(message_dim), "sum", receiver_tag = tfgnn.SOURCE)
+            context_convolution = 'mean'
+        elif builder == 'base_gnn_weighted_model':
+            convolution = DenseWeightedSumConvolution(message_dim, tfgnn.TARGET, l2_reg_factor, dropout_rate, use_layer_normalization)
+        elif builder == 'base_GATv2_model':
+            convolution = DenseWeightedSumConvolution(message_dim, tfgnn.TARGET, l2_reg_factor, dropout_rate, use_layer_normalization)
+            context_convolution = backend_common.ContextGATv2(num_heads = 2, per_head_channels = 128, l2_reg_factor = l2_reg_factor)
+        elif builder == 'GAT_GCN_model':
+            convolution = gcn_convolution(tfgnn.TARGET)
+            context_convolution = backend_common.ContextGATv2(num_heads = 3, per_head_channels = 32, l2_reg_factor = l2_reg_factor)
+
+        if context_convolution is not None:
+            context_next_state = dense(next_state_dim, use_layer_normalization)
+
+        update = DenseNodeSetUpdate(convolution, dense(next_state_dim, use_layer_normalization), edge_update = edge_update,
+                                    context_convolution = context_convolution, context_next_state = context_next_state)
+        new_node_states, edge_states, context_state = update(node_states, edge_set, edge_states, context_state)
+
+        # Residual blocks (all but the first update) of base_gnn_model_using_gcn_with_residual_blocks
+        if builder == 'base_gnn_model_using_gcn_with_residual_blocks' and i > 0 and skip_connection_type == 'sum':
+            node_states = node_states + new_node_states
+        else:
+            node_states = new_node_states
+
+    # Readout
+    if context_state is not None:
+        readout = context_state
+        if builder == 'GAT_GCN_model':
+            readout = tf.keras.layers.Dropout(dropout_rate)(readout)
+    else:
+        readout = pool_nodes_to_context(node_states, DENSE_BUILDERS[builder])
+
+    logits = tf.keras.layers.Dense(num_classes, dtype = 'float32')(readout)
+
+    return tf.keras.Model(inputs, logits)
+
+
+# Builders mirrored by dense_gnn_model, with the pooling of their readout
+DENSE_BUILDERS = {
+    'base_gnn_model': 'sum',
+    'base_gnn_model_learning_edge_weights': 'sum',
+    'base_gnn_model_using_gcn': 'mean',
+    'base_gnn_model_using_gcn_with_residual_blocks': 'sum',
+    'base_gnn_with_context_node_model': None,
+    'base_gnn_weighted_model': 'max',
+    'base_GATv2_model': None,
+    'GAT_GCN_model': None,
+}
+
+
+
+### PARITY WITH THE TFGNN BACKEND
+
+def parity_report(tfgnn_model, dense_model, edge_lists_ds, max_edges, batch_size = 32, num_batches = 4):
+    """
+    Compare the logits of a base_gnn model and of its dense counterpart (with the same weights,
+    see backend_common.copy_weights and backend_common.parity_report).
+
+    Args:
+        edge_lists_ds: Unbatched dataset of (mfcc, edge_lists, label) (utils_graph.create_edge_lists)
+        max_edges: Padded size of every edge set
+    """
+    to_dense_graph = lambda mfcc, edge_lists, label: edge_lists_to_dense_graph_for_dataset(mfcc, edge_lists, label, max_edges)
+
+    return backend_common.parity_report(tfgnn_model, dense_model, edge_lists_ds, to_dense_graph, batch_size = batch_size, num_batches = num_batches)
+
+
+def check_parity(edge_lists_ds, max_edges, num_frames = 98, num_features = 39, builders = None, tolerance = 1e-4, batch_size = 32, num_batches = 2, **model_kwargs):
+    """
+    For every builder of DENSE_BUILDERS : build the base_gnn model and dense_gnn_model with the same
+    hyperparameters, load the weights of the first in the second and compare their logits (see parity_report).
+
+    The hyperparameters are the ones of the base_gnn builder (its defaults, updated with the model_kwargs
+    it accepts, e.g. base_gnn_model_using_gcn_with_residual_blocks has no dilation), so that both models
+    have the same variables.
+
+    Args:
+        edge_lists_ds: Unbatched dataset of (mfcc, edge_lists, label) (utils_graph.create_edge_lists)
+        max_edges: Padded size of every edge set
+        builders: Names of the builders to check (default : all of DENSE_BUILDERS)
+        tolerance: Largest accepted absolute difference of the logits
+        model_kwargs: Hyperparameters of the models (n_message_passing_layers, dilation, ...)
+    Returns:
+        reports: Dictionary builder -> parity report
+    Raises:
+        AssertionError: If the logits of the two backends differ by more than tolerance for any builder
+    """
+    graphs_spec = backend_common.graphs_spec_for_edge_lists(edge_lists_ds, batch_size)
+    dense_parameters = inspect.signature(dense_gnn_model).parameters
+
+    reports = {}
+    for builder in (builders or DENSE_BUILDERS):
+        base_builder = getattr(base_gnn, builder)
+        kwargs = {name: parameter.default for name, parameter in inspect.signature(base_builder).parameters.items()
+                  if parameter.default is not inspect.Parameter.empty}
+        kwargs.update({name: value for name, value in model_kwargs.items() if name in kwargs})
+
+        tfgnn_model = base_builder(graphs_spec, **kwargs)
+        dense_model = dense_gnn_model(max_edges, num_frames = num_frames, num_features = num_features, builder = builder,
+                                      **{name: value for name, value in kwargs.items() if name in dense_parameters})
+        backend_common.copy_weights(tfgnn_model, dense_model)
+
+        reports[builder] = parity_report(tfgnn_model, dense_model, edge_lists_ds, max_edges, batch_size = batch_size, num_batches = num_batches)
+
+    failures = {builder: report for builder, report in reports.items() if report['max_abs_logit_diff'] > tolerance}
+    if failures:
+        raise AssertionError(f"The dense backend does not match the tfgnn backend: {failures}")
+
+    return reports
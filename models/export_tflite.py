@@ -0,0 +1,313 @@
+import os
+import json
+import numpy as np
+import tensorflow as tf
+import tensorflow_gnn as tfgnn
+from utils import utils_graph
+from models import base_gnn
+
+
+
+# Export of the trained GNNs to TFLite, for small-footprint deployment.
+# Since every clip has the same 98 frames, the topology of the 'window' graphs
+# (and the candidate edges of the 'cosine window' graphs) is fixed : it is frozen
+# into constant indices, so that the message passing reduces to gather /
+# unsorted_segment_sum ops on plain dense tensors, and the exported signature is
+#     logits [1, num_classes] = serve(features [1, 98, 39], weights [num_edges])
+
+
+
+### FIXED TOPOLOGY
+
+def fixed_topology_template(mode = 'window', num_frames = 98, window_size = 5, window_size_cosine = 10, n_dilation_layers = 0):
+    """
+    Constant edges of the exported graph (see utils_graph.get_edge_template).
+
+    For 'cosine window', the template holds all the candidate (in-band) edges : the
+    edges removed by the threshold get a zero weight instead (see template_edge_weights).
+    This is exact for the models multiplying the messages by the edge weights
+    (e.g. base_GATv2_model, base_gnn_weighted_model) ; models using the weights as
+    features, or ignoring them, must be exported with the topology they were trained on ('window').
+
+    Returns:
+        template: Tuple with one (sources, targets) tuple per edge set
+    """
+    if mode == 'window':
+        dilation_rates = tuple(2 * (i + 1) for i in range(n_dilation_layers))
+        return utils_graph.get_edge_template(mode, num_frames, window_size, dilation_rates)
+
+    if mode == 'cosine window':
+        if n_dilation_layers > 0:
+            raise ValueError("The dilated edge sets of the 'cosine window' mode depend on the thresholded graph and cannot be frozen.")
+        return utils_graph.get_edge_template(mode, num_frames, window_size_cosine)
+
+    raise ValueError("Unsupported mode for a fixed topology: {}".format(mode))
+
+
+def template_edge_weights(features, template, mode = 'window', cosine_window_thresh = 0.3):
+    """
+    Edge weights of one example, in template order (all the edge sets concatenated).
+    This is the (cheap) host side part of the graph construction.
+
+    Args:
+        features: MFCCs/GNCCs of the example [98, 39]
+        template: Template returned by fixed_topology_template
+        mode: Mode of the template
+        cosine_window_thresh: Threshold for the 'cosine window' mode (removed edges get a zero weight)
+    Returns:
+        weights: tf.Tensor [num_edges]
+    """
+    if mode == 'window':
+        return tf.ones([sum(int(sources.shape[0]) for sources, _ in template)], dtype=tf.float32)
+
+    sources, targets = template[0]
+    weights = utils_graph.edge_cosine_similarity(tf.nn.l2_normalize(features, axis=1), sources, targets)
+
+    return tf.where(weights >= cosine_window_thresh, weights, tf.zeros_like(weights))
+
+
+def graph_from_dense(features, weights, template, edge_set_names, indices_dtype = tf.int64):
+    """
+    Build a batch of one GraphTensor from dense tensors and the constant template
+    (the structure is the one of base_gnn.edge_lists_to_graph_tensors_for_dataset after batching).
+
+    Args:
+        features: Node features [1, num_frames, num_features]
+        weights: Edge weights of all the edge sets, concatenated [num_edges]
+        template: Template returned by fixed_topology_template
+        edge_set_names: Name of each edge set of the template
+        indices_dtype: Index dtype of the model input spec
+    """
+    num_frames = features.shape[1]
+
+    node_sets = {
+        "frames": tfgnn.NodeSet.from_fields(
+            features={"features": features},
+            sizes=tf.constant([[num_frames]], dtype=indices_dtype)
+        )
+    }
+
+    edge_sets = {}
+    offset = 0
+    for name, (sources, targets) in zip(edge_set_names, template):
+        num_edges = int(sources.shape[0])
+
+        edge_sets[name] = tfgnn.EdgeSet.from_fields(
+            features={"weights": tf.expand_dims(weights[offset:offset + num_edges], 0)},
+            sizes=tf.constant([[num_edges]], dtype=indices_dtype),
+            adjacency=tfgnn.Adjacency.from_indices(
+                source=("frames", tf.expand_dims(tf.cast(sources, indices_dtype), 0)),
+                target=("frames", tf.expand_dims(tf.cast(targets, indices_dtype), 0))
+            )
+        )
+        offset += num_edges
+
+    return tfgnn.GraphTensor.from_pieces(node_sets=node_sets, edge_sets=edge_sets)
+
+
+
+### EXPORT
+
+class FixedTopologyModel(tf.Module):
+    """
+    Wraps a trained GNN into a function of dense tensors only, with the topology frozen into constants.
+
+    Args:
+        model: Trained GNN (batched GraphTensor -> logits)
+        graph_tensor_specification: Graph spec the model was built with
+        template: Template returned by fixed_topology_template
+        num_frames, num_features: Shape of the node features
+    """
+
+    def __init__(self, model, graph_tensor_specification, template, num_frames = 98, num_features = 39):
+        super().__init__()
+        self.model = model
+        self.template = template
+        # Edge sets are named connections_0, connections_1, ... (one per template entry)
+        self.edge_set_names = sorted(graph_tensor_specification.edge_sets_spec.keys(), key = lambda name: int(name.split('_')[-1]))
+        self.indices_dtype = graph_tensor_specification.indices_dtype
+        self.num_edges = sum(int(sources.shape[0]) for sources, _ in template)
+
+        if len(self.edge_set_names) != len(template):
+            raise ValueError(f"The model has {len(self.edge_set_names)} edge sets, the template {len(template)}")
+
+        self.serve = tf.function(self._serve, input_signature = [
+            tf.TensorSpec([1, num_frames, num_features], tf.float32, name = 'features'),
+            tf.TensorSpec([self.num_edges], tf.float32, name = 'weights'),
+        ])
+
+    def _serve(self, features, weights):
+        graph = graph_from_dense(features, weights, self.template, self.edge_set_names, self.indices_dtype)
+        return self.model(graph, training = False)
+
+
+def representative_dataset(ds, template, mode = 'window', cosine_window_thresh = 0.3, num_samples = 200):
+    """
+    Representative inputs for the int8 calibration, taken from an (unbatched) split
+    of (features, wav, label), e.g. the val split of utils_data.create_tf_dataset.
+    """
+    def generator():
+        for features, _, _ in ds.take(num_samples):
+            weights = template_edge_weights(features, template, mode = mode, cosine_window_thresh = cosine_window_thresh)
+            yield [tf.expand_dims(features, 0), weights]
+
+    return generator
+
+
+def convert_to_tflite(exported, quantization = None, representative_data = None, allow_select_tf_ops = False):
+    """
+    Convert the exported model to TFLite.
+
+    Args:
+        exported: FixedTopologyModel
+        quantization: None (float32), 'float16' (float16 weights) or 'int8'
+                      (post-training quantization calibrated on representative_data)
+        representative_data: Generator returned by representative_dataset (needed for 'int8')
+        allow_select_tf_ops: Let the ops without a TFLite builtin fall back to TensorFlow kernels
+    Returns:
+        tflite_model: Serialized TFLite flatbuffer (bytes)
+    """
+    converter = tf.lite.TFLiteConverter.from_concrete_functions([exported.serve.get_concrete_function()], exported)
+
+    if quantization == 'float16':
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.target_spec.supported_types = [tf.float16]
+
+    elif quantization == 'int8':
+        if representative_data is None:
+            raise ValueError("int8 quantization needs a representative dataset")
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.representative_dataset = representative_data
+
+    elif quantization is not None:
+        raise ValueError("Unsupported quantization: {}".format(quantization))
+
+    if allow_select_tf_ops:
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS, tf.lite.OpsSet.SELECT_TF_OPS]
+
+    return converter.convert()
+
+
+
+### PARITY
+
+def tflite_predict(tflite_model, features, weights):
+    """
+    Run a TFLite model on one example (features [1, 98, 39], weights [num_edges]).
+    """
+    interpreter = tf.lite.Interpreter(model_content = tflite_model)
+    runner = interpreter.get_signature_runner()
+    outputs = runner(features = features, weights = weights)
+
+    return next(iter(outputs.values()))
+
+
+def parity_report(model, tflite_models, ds, template, mode = 'window', graph_kwargs = None, num_samples = 500):
+    """
+    Compare the TFLite models with the Keras model on a split of (features, wav, label).
+    The Keras model gets the graph used in training (utils_graph.create_edge_lists),
+    so for 'cosine window' the report also checks that the zero-weight edges are harmless.
+
+    Args:
+        model: Trained GNN
+        tflite_models: Dictionary {name: flatbuffer}
+        ds: Unbatched dataset of (features, wav, label)
+        template: Template returned by fixed_topology_template
+        mode: Mode of the template
+        graph_kwargs: Arguments of utils_graph.create_edge_lists used in training (besides mode)
+        num_samples: Number of examples compared
+    Returns:
+        report: Dictionary {name: {'size_bytes', 'max_abs_diff', 'mean_abs_diff', 'top1_agreement', 'accuracy'}, 'keras': {'accuracy'}}
+    """
+    graph_kwargs = dict(graph_kwargs or {})
+    cosine_window_thresh = graph_kwargs.get('cosine_window_thresh', 0.3)
+
+    interpreters = {}
+    for name, tflite_model in tflite_models.items():
+        interpreter = tf.lite.Interpreter(model_content = tflite_model)
+        interpreters[name] = interpreter.get_signature_runner()
+
+    keras_logits, tflite_logits, labels = [], {name: [] for name in tflite_models}, []
+
+    for features, _, label in ds.take(num_samples):
+        # Keras reference on the training graph
+        _, edge_lists, _ = utils_graph.create_edge_lists(features, 98, label, mode = mode, **graph_kwargs)
+        graph, _ = base_gnn.edge_lists_to_graph_tensors_for_dataset(features, edge_lists, label)
+        graph = tf.data.Dataset.from_tensors(graph).batch(1).get_single_element()
+        keras_logits.append(model(graph, training = False).numpy()[0])
+
+        weights = template_edge_weights(features, template, mode = mode, cosine_window_thresh = cosine_window_thresh).numpy()
+        for name, runner in interpreters.items():
+            outputs = runner(features = features.numpy()[None], weights = weights)
+            tflite_logits[name].append(next(iter(outputs.values()))[0])
+
+        labels.append(int(label))
+
+    keras_logits, labels = np.array(keras_logits), np.array(labels)
+    keras_predictions = np.argmax(keras_logits, axis=-1)
+
+    report = {'keras': {'accuracy': float(np.mean(keras_predictions == labels)), 'num_samples': int(len(labels))}}
+
+    for name, logits in tflite_logits.items():
+        logits = np.array(logits)
+        predictions = np.argmax(logits, axis=-1)
+        report[name] = {
+            'size_bytes': len(tflite_models[name]),
+            'max_abs_diff': float(np.max(np.abs(logits - keras_logits))),
+            'mean_abs_diff': float(np.mean(np.abs(logits - keras_logits))),
+            'top1_agreement': float(np.mean(predictions == keras_predictions)),
+            'accuracy': float(np.mean(predictions == labels)),
+        }
+
+    return report
+
+
+def export_tflite(model, graph_tensor_specification, val_ds, output_dir, mode = 'window', graph_kwargs = None,
+                  quantizations = (None, 'float16', 'int8'), num_representative = 200, num_parity = 500, allow_select_tf_ops = False):
+    """
+    Export a trained GNN to TFLite (one file per quantization) and write the parity report.
+
+    Args:
+        model: Trained GNN
+        graph_tensor_specification: Graph spec the model was built with
+        val_ds: Unbatched val split of (features, wav, label) (calibration + parity)
+        output_dir: Where to write model_<quantization>.tflite and parity_report.json
+        mode: 'window' or 'cosine window' (as in training)
+        graph_kwargs: Arguments of utils_graph.create_edge_lists used in training (besides mode)
+        quantizations: Quantizations to export (None = float32)
+        num_representative: Number of val examples for the int8 calibration
+        num_parity: Number of val examples for the parity report
+        allow_select_tf_ops: See convert_to_tflite
+    Returns:
+        report: Parity report (see parity_report)
+    """
+    graph_kwargs = dict(graph_kwargs or {})
+    os.makedirs(output_dir, exist_ok = True)
+
+    template = fixed_topology_template(mode, num_frames = 98,
+                                       window_size = graph_kwargs.get('window_size', 5),
+                                       window_size_cosine = graph_kwargs.get('window_size_cosine', 10),
+                                       n_dilation_layers = graph_kwargs.get('n_dilation_layers', 0))
+    exported = FixedTopologyModel(model, graph_tensor_specification, template)
+
+    representative_data = representative_dataset(val_ds, template, mode = mode, num_samples = num_representative,
+                                                 cosine_window_thresh = graph_kwargs.get('cosine_window_thresh', 0.3))
+
+    tflite_models = {}
+    for quantization in quantizations:
+        name = quantization or 'float32'
+        tflite_models[name] = convert_to_tflite(exported, quantization = quantization, representative_data = representative_data,
+                                                allow_select_tf_ops = allow_select_tf_ops)
+
+        with open(os.path.join(output_dir, f"model_{name}.tflite"), 'wb') as f:
+            f.write(tflite_models[name])
+
+    report = parity_report(model, tflite_models, val_ds, template, mode = mode, graph_kwargs = graph_kwargs, num_samples = num_parity)
+
+    with open(os.path.join(output_dir, 'parity_report.json'), 'w') as f:
+        json.dump(report, f, indent = 2)
+
+    for name, metrics in report.items():
+        print(f"{name}: {metrics}")
+
+    return report
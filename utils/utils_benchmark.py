@@ -0,0 +1,552 @@
+"""
+Throughput benchmark of the input pipeline.
+
+Every stage of utils_data.create_tf_dataset / utils_graph.create_adjacency_matrix
+(decode, noise mixing, noise reduction, STFT, filterbank, DCT + deltas, adjacency,
+GraphTensor) is timed
+    - in isolation : the stage alone, called once per (pre-materialized) element
+    - cumulatively : a tf.data pipeline running all the stages up to (and including) it
+and the examples/sec, p50/p99 per-element latency, RSS growth during the stage and peak RSS of the
+process (so far) are written to JSON.
+
+Runs on CPU only (GPUs are hidden) on a synthetic corpus, or on a sample of the real one:
+    python -m utils.utils_benchmark --num-examples 256 --output benchmark.json
+    python -m utils.utils_benchmark --data-dir speech_commands_v0.02 --num-examples 512
+
+The frontend suite compares the feature extraction with the time domain noise reduction
+(STFT, mask, inverse STFT, then the STFT of the features) and with the spectral one
+(mask applied to the spectrogram of the features), and reports how close the features are:
+    python -m utils.utils_benchmark --suite frontend --num-examples 256
+
+The training suite compares, for each model builder, the training steps/sec and the
+val accuracy of the float32 / mixed precision and eager / XLA compiled configurations:
+    python -m utils.utils_benchmark --suite training --num-examples 2048 --epochs 3
+"""
+import os
+os.environ["TF_USE_LEGACY_KERAS"] = "1" # needed for tfgnn
+import sys
+import json
+import time
+import random
+import pathlib
+import argparse
+import platform
+import tempfile
+import numpy as np
+import tensorflow as tf
+from scipy.io import wavfile
+from utils import utils_data, utils_graph, utils_noise, utils_profiling
+from models import base_gnn
+
+
+
+STAGES = ['decode', 'noise_mixing', 'noise_reduction', 'stft', 'filterbank', 'dct_deltas', 'adjacency', 'graph_tensor']
+
+
+
+### CORPUS
+
+def make_synthetic_corpus(output_dir, num_examples = 256, num_classes = 8, sample_rate = 16000, seed = 0):
+    """
+    Write a reproducible synthetic corpus in the Speech Commands layout
+    (class subfolders + _background_noise_). The clips are harmonic tones with
+    a random pitch and envelope plus a little white noise, and their lengths
+    vary between 0.8 and 1.0 seconds so that the padding path is exercised too.
+
+    Returns:
+        path_files, labels: List of the audio file paths and of the corresponding labels
+        noise_dir: Directory with the background noise files
+    """
+    rng = np.random.default_rng(seed)
+    path_files, labels = [], []
+
+    for i in range(num_examples):
+        label = i % num_classes
+        class_dir = os.path.join(output_dir, f"class_{label:02d}")
+        os.makedirs(class_dir, exist_ok = True)
+
+        length = int(rng.integers(int(0.8 * sample_rate), sample_rate + 1))
+        t = np.arange(length) / sample_rate
+        f0 = 100 + 50 * label + rng.uniform(-20, 20)
+        wav = sum(np.sin(2 * np.pi * k * f0 * t) / k for k in range(1, 4))
+        wav *= np.hanning(length) * rng.uniform(0.2, 0.8)
+        wav += 0.01 * rng.standard_normal(length)
+
+        path = os.path.join(class_dir, f"{i:08x}_nohash_0.wav")
+        wavfile.write(path, sample_rate, (np.clip(wav, -1, 1) * 32767).astype(np.int16))
+        path_files.append(path)
+        labels.append(label)
+
+    noise_dir = os.path.join(output_dir, '_background_noise_')
+    os.makedirs(noise_dir, exist_ok = True)
+    for name in ['white_noise', 'brown_noise']:
+        noise = rng.standard_normal(5 * sample_rate)
+        if name == 'brown_noise':
+            noise = np.cumsum(noise)
+            noise /= np.max(np.abs(noise))
+        wavfile.write(os.path.join(noise_dir, name + '.wav'), sample_rate, (0.3 * noise * 32767 / np.max(np.abs(noise))).astype(np.int16))
+
+    return path_files, labels, noise_dir
+
+
+def sample_corpus(data_dir, num_examples = 256, seed = 0):
+    """
+    Sample a reproducible subset of a real corpus (class subfolders + _background_noise_).
+
+    Returns:
+        path_files, labels, noise_dir: Same as make_synthetic_corpus
+    """
+    data_dir = pathlib.Path(data_dir)
+    class_names = sorted(d.name for d in data_dir.iterdir() if d.is_dir() and d.name != '_background_noise_')
+
+    all_files = [(str(path), label) for label, class_name in enumerate(class_names)
+                 for path in sorted((data_dir / class_name).glob('*.wav'))]
+
+    sampled = random.Random(seed).sample(all_files, min(num_examples, len(all_files)))
+
+    return [path for path, _ in sampled], [label for _, label in sampled], str(data_dir / '_background_noise_')
+
+
+
+### STAGES
+
+def build_stages(noise_bank, sample_rate = 16000, frame_length = 400, frame_step = 160, gammatone = True, graph_mode = 'similarity', target_snr_db = 5):
+    """
+    Split the preprocessing into its stages. Each stage maps the output tuple
+    of the previous one, starting from (file_path, label).
+
+    Returns:
+        stages: List of (name, function)
+    """
+    if gammatone:
+        apply_filterbank = utils_data.apply_gammatone_filterbanks
+        get_cepstra = lambda log_spectrogram, wav: utils_data.get_gnccs(log_spectrogram, wav, frame_length = frame_length, frame_step = frame_step, M = 2, num_coeffs = 12)
+    else:
+        apply_filterbank = utils_data.apply_mel_filterbanks
+        get_cepstra = lambda log_spectrogram, wav: utils_data.get_mfccs(log_spectrogram, wav, frame_length = frame_length, frame_step = frame_step, M = 2)
+
+    def noise_mixing(wav, label):
+        noise_segment = utils_noise.sample_noise_segment(noise_bank, segment_length = 16000)
+        return utils_noise.mix_noise(wav, noise_segment, target_snr_db), label
+
+    return [
+        ('decode', lambda file_path, label: utils_data.load_audio(file_path, label, noise = False)),
+        ('noise_mixing', noise_mixing),
+        ('noise_reduction', lambda wav, label: (utils_data.noise_reduction(wav, noise_threshold = 0.1, frame_length = frame_length, frame_step = frame_step), label)),
+        ('stft', lambda wav, label: (utils_data.get_spectrogram(wav, sample_rate)[0], wav, label)),
+        ('filterbank', lambda spectrogram, wav, label: (apply_filterbank(spectrogram, sample_rate), wav, label)),
+        ('dct_deltas', lambda log_spectrogram, wav, label: (get_cepstra(log_spectrogram, wav), label)),
+        ('adjacency', lambda features, label: utils_graph.create_adjacency_matrix(features, 98, label, mode = graph_mode, window_size_cosine = 25)),
+        ('graph_tensor', lambda features, adjacency_matrices, label: base_gnn.mfccs_to_graph_tensors_for_dataset(features, adjacency_matrices, label)),
+    ]
+
+
+def pipeline(path_files, labels, stages, parallel = True):
+    """
+    tf.data pipeline running the given stages one after the other (in file order).
+    """
+    ds = tf.data.Dataset.from_tensor_slices((path_files, labels))
+    for _, fn in stages:
+        ds = ds.map(fn, num_parallel_calls = tf.data.AUTOTUNE if parallel else None, deterministic = True)
+
+    return ds
+
+
+
+### MEASUREMENTS
+
+def summarize(latencies, total_time, rss_before = None):
+    """
+    Summary statistics of a run (latencies and total time in seconds).
+    rss_delta_mb is the growth of the resident memory during the run (from rss_before, in MB) ;
+    peak_rss_mb is the peak RSS of the process so far (ru_maxrss), which mostly reflects the inputs
+    materialized before and the previous stages, so it only grows from one stage to the next.
+    """
+    rss_after = utils_profiling.current_rss_mb()
+
+    latencies = np.asarray(latencies) * 1000
+
+    return {
+        'examples': int(len(latencies)),
+        'examples_per_sec': float(len(latencies) / total_time) if total_time > 0 else None,
+        'p50_ms': float(np.percentile(latencies, 50)),
+        'p99_ms': float(np.percentile(latencies, 99)),
+        'mean_ms': float(np.mean(latencies)),
+        'rss_delta_mb': rss_after - rss_before if rss_before is not None and rss_after is not None else None,
+        'peak_rss_mb': utils_profiling.peak_rss_mb(),
+    }
+
+
+def benchmark_isolated(fn, inputs, warmup = 2):
+    """
+    Time a stage alone : the inputs are already materialized, and the stage
+    (wrapped in a tf.function, like inside a dataset map) is called once per element.
+
+    Args:
+        fn: Stage function
+        inputs: List of input tuples
+        warmup: Number of calls excluded from the measurements (tracing)
+    """
+    stage_fn = tf.function(fn)
+
+    for element in inputs[:warmup]:
+        tf.nest.map_structure(lambda t: t.numpy() if hasattr(t, 'numpy') else t, stage_fn(*element), expand_composites = True)
+
+    rss_before = utils_profiling.current_rss_mb()
+    latencies = []
+    start = time.perf_counter()
+    for element in inputs:
+        t0 = time.perf_counter()
+        outputs = stage_fn(*element)
+        # Make sure the outputs are actually computed
+        tf.nest.map_structure(lambda t: t.numpy() if hasattr(t, 'numpy') else t, outputs, expand_composites = True)
+        latencies.append(time.perf_counter() - t0)
+
+    return summarize(latencies, time.perf_counter() - start, rss_before)
+
+
+def benchmark_cumulative(ds, warmup = 2):
+    """
+    Time a tf.data pipeline : the latency of an element is the time waited for it
+    by the consumer (i.e. what the training loop would see).
+    """
+    iterator = iter(ds)
+    for _ in range(warmup):
+        next(iterator)
+
+    rss_before = utils_profiling.current_rss_mb()
+    latencies = []
+    start = time.perf_counter()
+    t0 = start
+    for _ in iterator:
+        t1 = time.perf_counter()
+        latencies.append(t1 - t0)
+        t0 = t1
+
+    return summarize(latencies, time.perf_counter() - start, rss_before)
+
+
+def run_benchmark(path_files, labels, noise_dir, gammatone = True, graph_mode = 'similarity', warmup = 2):
+    """
+    Benchmark every stage in isolation and cumulatively.
+
+    Args:
+        path_files: List of audio file paths
+        labels: List of corresponding labels
+        noise_dir: Directory with the background noise files
+        gammatone: GNCCs (True) or MFCCs (False)
+        graph_mode: Mode of utils_graph.create_adjacency_matrix
+        warmup: Number of elements excluded from the measurements
+    Returns:
+        results: Dictionary {stage: {'isolated': {...}, 'cumulative': {...}}}
+    """
+    noise_bank = utils_noise.load_noise_bank(noise_dir)
+    stages = build_stages(noise_bank, gammatone = gammatone, graph_mode = graph_mode)
+
+    results = {}
+    for k, (name, fn) in enumerate(stages):
+        # Inputs of the stage, computed by the previous stages and kept in memory
+        inputs = list(pipeline(path_files, labels, stages[:k]).as_numpy_iterator()) if k > 0 else list(zip(path_files, labels))
+        inputs = [tuple(tf.constant(t) for t in element) for element in inputs]
+
+        results[name] = {
+            'isolated': benchmark_isolated(fn, inputs, warmup = warmup),
+            'cumulative': benchmark_cumulative(pipeline(path_files, labels, stages[:k + 1]).prefetch(tf.data.AUTOTUNE), warmup = warmup),
+        }
+        del inputs
+
+        print(f"{name:>16}   isolated {results[name]['isolated']['examples_per_sec']:9.1f} ex/s  p50 {results[name]['isolated']['p50_ms']:7.2f} ms  p99 {results[name]['isolated']['p99_ms']:7.2f} ms"
+              f"   |   cumulative {results[name]['cumulative']['examples_per_sec']:9.1f} ex/s  p50 {results[name]['cumulative']['p50_ms']:7.2f} ms  p99 {results[name]['cumulative']['p99_ms']:7.2f} ms")
+
+    return results
+
+
+### FEATURE FRONT-END
+
+# Columns of the [98, 39] features (see utils_data.get_mfccs / get_gnccs)
+FEATURE_GROUPS = {'cepstra': slice(0, 12), 'delta': slice(12, 24), 'delta_delta': slice(24, 36), 'energies': slice(36, 39)}
+
+NOISE_REDUCTION_MODES = ['time', 'spectral', None]
+
+# Largest difference allowed between the FeatureFrontend and extract_features (same ops, float rounding only)
+FRONTEND_TOLERANCE = 1e-3
+
+
+def feature_parity(reference, candidate):
+    """
+    Distance between two sets of features [N, 98, 39], per group of coefficients.
+
+    Returns:
+        report: {group: {'max_abs_diff', 'mean_abs_diff', 'relative_error' (mean |diff| / mean |reference|), 'cosine_similarity'}}
+    """
+    report = {}
+    for group, columns in FEATURE_GROUPS.items():
+        ref, cand = reference[..., columns].reshape(len(reference), -1), candidate[..., columns].reshape(len(candidate), -1)
+        diff = np.abs(ref - cand)
+        cosine = np.sum(ref * cand, axis = 1) / (np.linalg.norm(ref, axis = 1) * np.linalg.norm(cand, axis = 1) + 1e-12)
+
+        report[group] = {
+            'max_abs_diff': float(np.max(diff)),
+            'mean_abs_diff': float(np.mean(diff)),
+            'relative_error': float(np.mean(diff) / (np.mean(np.abs(ref)) + 1e-12)),
+            'cosine_similarity': float(np.mean(cosine)),
+        }
+
+    return report
+
+
+def benchmark_frontend(path_files, labels, gammatone = True, frame_length = 400, frame_step = 160, warmup = 2):
+    """
+    Time utils_data.extract_features with every noise reduction mode (on the decoded waveforms),
+    and compare the features of each mode with the ones of the legacy 'time' mode.
+
+    Returns:
+        results: {mode: {'isolated': {...}, 'speedup_vs_time': float, 'parity_vs_time': {...}}}
+    """
+    inputs = [tuple(tf.constant(t) for t in element)
+              for element in pipeline(path_files, labels, [('decode', lambda file_path, label: utils_data.load_audio(file_path, label, noise = False))]).as_numpy_iterator()]
+
+    results, features = {}, {}
+    for mode in NOISE_REDUCTION_MODES:
+        fn = lambda wav, label, mode = mode: utils_data.extract_features(wav, label, 16000, frame_length, frame_step,
+                                                                         gammatone = gammatone, noise_reduction_mode = mode)[0]
+        name = str(mode)
+        results[name] = {'isolated': benchmark_isolated(fn, inputs, warmup = warmup)}
+
+        extract = tf.function(fn)
+        features[name] = np.stack([extract(*element).numpy() for element in inputs])
+
+    for mode in NOISE_REDUCTION_MODES:
+        name = str(mode)
+        results[name]['speedup_vs_time'] = results[name]['isolated']['examples_per_sec'] / results['time']['isolated']['examples_per_sec']
+        results[name]['parity_vs_time'] = feature_parity(features['time'], features[name])
+
+        print(f"{name:>10}   {results[name]['isolated']['examples_per_sec']:9.1f} ex/s  p50 {results[name]['isolated']['p50_ms']:7.2f} ms"
+              f"   speedup x{results[name]['speedup_vs_time']:.2f}"
+              f"   cepstra rel. error {results[name]['parity_vs_time']['cepstra']['relative_error']:.3f}")
+
+    # The FeatureFrontend must give the features of extract_features, in every mode
+    wavs = tf.stack([element[0] for element in inputs])
+    results['frontend_vs_extract_features'] = utils_data.frontend_parity(wavs, gammatone = gammatone, frame_length = frame_length,
+                                                                         frame_step = frame_step, noise_reduction_modes = NOISE_REDUCTION_MODES)
+    for name, max_abs_diff in results['frontend_vs_extract_features'].items():
+        print(f"FeatureFrontend vs extract_features ({name}): max abs diff {max_abs_diff:.2e}")
+        if max_abs_diff > FRONTEND_TOLERANCE:
+            raise AssertionError(f"FeatureFrontend differs from extract_features with noise_reduction_mode = {name}: {max_abs_diff:.2e}")
+
+    return results
+
+
+def environment_info(num_threads):
+    """
+    Machine and library information stored alongside the results, to compare runs.
+    """
+    return {
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'tensorflow': tf.__version__,
+        'cpu_count': os.cpu_count(),
+        'num_threads': num_threads,
+    }
+
+
+
+### TRAINING
+
+MODEL_BUILDERS = {
+    'base_gnn_model': base_gnn.base_gnn_model,
+    'base_gnn_model_learning_edge_weights': base_gnn.base_gnn_model_learning_edge_weights,
+    'GAT_GCN_model': base_gnn.GAT_GCN_model,
+    'base_GATv2_model': base_gnn.base_GATv2_model,
+    'base_gnn_model_using_gcn': base_gnn.base_gnn_model_using_gcn,
+    'base_gnn_model_using_gcn_with_residual_blocks': base_gnn.base_gnn_model_using_gcn_with_residual_blocks,
+    'base_gnn_with_context_node_model': base_gnn.base_gnn_with_context_node_model,
+    'base_gnn_weighted_model': base_gnn.base_gnn_weighted_model,
+}
+
+# (precision, jit_compile) ; the first one is the reference for the accuracy deltas
+TRAINING_CONFIGS = [('float32', False), ('float32', True), ('mixed_float16', False), ('mixed_float16', True), ('mixed_bfloat16', False), ('mixed_bfloat16', True)]
+
+
+def synthetic_graph_dataset(num_examples = 2048, num_classes = 35, seed = 0):
+    """
+    Learnable synthetic graphs : the features of each class are drawn around a class
+    prototype, and the graphs use the fixed 'window' topology, so that every batch has
+    the same shapes (as needed by XLA).
+
+    Returns:
+        dataset: Unbatched dataset of (graph_tensor, label)
+    """
+    rng = np.random.default_rng(seed)
+    prototypes = rng.standard_normal((num_classes, 98, 39)).astype(np.float32)
+    labels = rng.integers(0, num_classes, num_examples).astype(np.int32)
+    features = prototypes[labels] + 2.0 * rng.standard_normal((num_examples, 98, 39)).astype(np.float32)
+
+    ds = tf.data.Dataset.from_tensor_slices((features, tf.zeros([num_examples, 0]), labels))
+    ds = ds.map(lambda mfcc, wav, label: utils_graph.create_edge_lists(mfcc, 98, label, mode = 'window', window_size = 5))
+    ds = ds.map(base_gnn.edge_lists_to_graph_tensors_for_dataset)
+
+    return ds.cache()
+
+
+def benchmark_training(train_ds, val_ds, builders, configs = TRAINING_CONFIGS, epochs = 3, steps_per_execution = 1, seed = 0):
+    """
+    Train every builder in every configuration and measure the steps/sec (excluding the
+    first epoch, which includes tracing and XLA compilation) and the final val accuracy.
+
+    Args:
+        train_ds, val_ds: Batched datasets of (graph_tensor, label) (with drop_remainder = True)
+        builders: Dictionary {name: model builder}
+        configs: List of (precision, jit_compile)
+        epochs: Number of epochs (at least 2)
+        steps_per_execution: See base_gnn.train
+    Returns:
+        results: Dictionary {builder: {config: {...}}}
+    """
+    if epochs < 2:
+        raise ValueError("At least 2 epochs are needed (the first one only measures the compilation)")
+
+    graphs_spec = train_ds.element_spec[0]
+    steps_per_epoch = int(train_ds.cardinality())
+
+    class EpochTimer(tf.keras.callbacks.Callback):
+        def on_epoch_begin(self, epoch, logs = None):
+            self.start = time.perf_counter()
+        def on_epoch_end(self, epoch, logs = None):
+            self.times.append(time.perf_counter() - self.start)
+
+    results = {}
+    for name, builder in builders.items():
+        results[name] = {}
+
+        for precision, jit_compile in configs:
+            config_name = f"{precision}{'_xla' if jit_compile else ''}"
+            try:
+                base_gnn.set_precision(precision)
+                tf.random.set_seed(seed)
+
+                model = builder(graph_tensor_specification = graphs_spec)
+                base_gnn.compile_model(model, jit_compile = jit_compile, steps_per_execution = steps_per_execution)
+
+                timer = EpochTimer()
+                timer.times = []
+                model.fit(train_ds, epochs = epochs, callbacks = [timer], verbose = 0)
+                _, val_accuracy = model.evaluate(val_ds, verbose = 0)
+
+                steady_time = sum(timer.times[1:])
+                results[name][config_name] = {
+                    'steps_per_sec': steps_per_epoch * (epochs - 1) / steady_time,
+                    'first_epoch_sec': timer.times[0],
+                    'val_accuracy': float(val_accuracy),
+                }
+            except Exception as error:
+                # Some layers may not support a policy (or XLA) : report it instead of stopping
+                results[name][config_name] = {'error': f"{type(error).__name__}: {error}"}
+
+            finally:
+                base_gnn.set_precision(None)
+                tf.keras.backend.clear_session()
+
+        # Speedups and accuracy deltas with respect to the reference configuration
+        reference = results[name].get(f"{configs[0][0]}{'_xla' if configs[0][1] else ''}", {})
+        for config_name, metrics in results[name].items():
+            if 'error' in metrics or 'error' in reference:
+                continue
+            metrics['speedup'] = metrics['steps_per_sec'] / reference['steps_per_sec']
+            metrics['val_accuracy_delta'] = metrics['val_accuracy'] - reference['val_accuracy']
+
+        for config_name, metrics in results[name].items():
+            print(f"{name:>46}  {config_name:>20}  " + ('  '.join(f"{k} {v:.4g}" for k, v in metrics.items() if not isinstance(v, str)) or metrics['error']))
+
+    return results
+
+
+
+### CLI
+
+def configure_cpu(num_threads = None, seed = 0, hide_gpus = True):
+    """
+    Hide the GPUs, fix the number of threads and seed everything, so that runs are comparable across machines.
+    Must be called before any tensorflow operation runs.
+    """
+    if hide_gpus:
+        tf.config.set_visible_devices([], 'GPU')
+
+    if num_threads is not None:
+        tf.config.threading.set_intra_op_parallelism_threads(num_threads)
+        tf.config.threading.set_inter_op_parallelism_threads(num_threads)
+
+    tf.random.set_seed(seed)
+    np.random.seed(seed)
+    random.seed(seed)
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'Benchmark the stages of the input pipeline (or the training).')
+    parser.add_argument('--suite', default = 'pipeline', choices = ['pipeline', 'frontend', 'training'])
+    parser.add_argument('--data-dir', default = None, help = 'Sample the corpus from this directory (default: synthetic corpus)')
+    parser.add_argument('--num-examples', type = int, default = 256)
+    parser.add_argument('--mfcc', action = 'store_true', help = 'Use MFCCs instead of GNCCs')
+    parser.add_argument('--graph-mode', default = 'similarity', choices = ['window', 'cosine window', 'similarity', 'knn'])
+    parser.add_argument('--num-threads', type = int, default = None, help = 'Intra/inter op threads (default: TF default)')
+    parser.add_argument('--warmup', type = int, default = 2)
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--output', default = 'benchmark.json')
+    # Training suite
+    parser.add_argument('--builders', nargs = '+', default = list(MODEL_BUILDERS), choices = list(MODEL_BUILDERS))
+    parser.add_argument('--epochs', type = int, default = 3)
+    parser.add_argument('--batch-size', type = int, default = 64)
+    parser.add_argument('--steps-per-execution', type = int, default = 1)
+    parser.add_argument('--use-gpu', action = 'store_true', help = 'Training suite : keep the GPUs visible (mixed float16 only pays off there)')
+    args = parser.parse_args(argv)
+
+    configure_cpu(args.num_threads, args.seed, hide_gpus = not (args.suite == 'training' and args.use_gpu))
+
+    if args.suite == 'training':
+        ds = synthetic_graph_dataset(num_examples = args.num_examples, seed = args.seed)
+        num_val = max(args.batch_size, args.num_examples // 5)
+        train_ds = ds.skip(num_val).batch(args.batch_size, drop_remainder = True).prefetch(tf.data.AUTOTUNE)
+        val_ds = ds.take(num_val).batch(args.batch_size, drop_remainder = True)
+
+        results = benchmark_training(train_ds, val_ds, {name: MODEL_BUILDERS[name] for name in args.builders},
+                                     epochs = args.epochs, steps_per_execution = args.steps_per_execution, seed = args.seed)
+        report = {
+            'config': {**vars(args), 'corpus': 'synthetic'},
+            'environment': environment_info(args.num_threads),
+            'training': results,
+        }
+
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent = 2)
+
+        print(f"Results written to {args.output}")
+
+        return report
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if args.data_dir is None:
+            path_files, labels, noise_dir = make_synthetic_corpus(tmp_dir, num_examples = args.num_examples, seed = args.seed)
+        else:
+            path_files, labels, noise_dir = sample_corpus(args.data_dir, num_examples = args.num_examples, seed = args.seed)
+
+        if args.suite == 'frontend':
+            results = benchmark_frontend(path_files, labels, gammatone = not args.mfcc, warmup = args.warmup)
+        else:
+            results = run_benchmark(path_files, labels, noise_dir, gammatone = not args.mfcc, graph_mode = args.graph_mode, warmup = args.warmup)
+
+    report = {
+        'config': {**vars(args), 'corpus': 'synthetic' if args.data_dir is None else 'sampled'},
+        'environment': environment_info(args.num_threads),
+        'frontend' if args.suite == 'frontend' else 'stages': results,
+    }
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent = 2)
+
+    print(f"Results written to {args.output}")
+
+    return report
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
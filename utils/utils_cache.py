@@ -0,0 +1,229 @@
+import os
+import json
+import time
+import uuid
+import shutil
+import hashlib
+import contextlib
+import numpy as np
+import tensorflow as tf
+
+
+
+# Bump this whenever the feature extraction code changes in a way that is not
+# captured by the preprocessing config (e.g. a different window function),
+# so that stale caches are not reused.
+FEATURE_CACHE_VERSION = 2
+
+INDEX_FILE_NAME = 'index.json'
+LOCK_FILE_NAME = 'index.lock'
+
+# Seconds to wait for the index lock held by another process
+LOCK_TIMEOUT = 600
+
+
+
+### KEYS
+
+def preprocessing_config_hash(config):
+    """
+    Hash the full preprocessing configuration.
+    Every distinct configuration gets its own cache subdirectory, so changing
+    any parameter (gammatone, frame_length, frame_step, M, num_coeffs, ...)
+    automatically invalidates the previously cached features.
+
+    Args:
+        config: Dictionary with the preprocessing parameters (JSON serializable)
+    Returns:
+        config_hash: Short hex digest identifying the configuration
+    """
+    payload = json.dumps({'version': FEATURE_CACHE_VERSION, **config}, sort_keys=True)
+
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()[:16]
+
+
+def file_cache_key(file_path):
+    """
+    Content address of an audio file: its absolute path and modification time.
+    If the file is replaced or touched, the key changes and the features are recomputed.
+
+    Args:
+        file_path: Path to the audio file
+    Returns:
+        key: Hex digest identifying the file version
+    """
+    file_path = os.path.abspath(file_path)
+    mtime = os.stat(file_path).st_mtime_ns
+
+    return hashlib.sha1(f"{file_path}:{mtime}".encode('utf-8')).hexdigest()
+
+
+
+### CACHE STORAGE
+
+def open_feature_cache(cache_dir, config):
+    """
+    Open (or create) the feature cache for a given preprocessing configuration.
+
+    On disk the cache looks like:
+        cache_dir/<config_hash>/index.json            (config, shard names, key -> (shard, row))
+        cache_dir/<config_hash>/shard_<unique id>.npy ([n, num_frames, num_features] features)
+        ...
+
+    Several processes (e.g. the workers of a multi worker training) can fill the same
+    cache : every shard gets a unique name and the index is updated under a lock
+    (see write_feature_shard).
+
+    Args:
+        cache_dir: Root directory of the feature cache
+        config: Dictionary with the preprocessing parameters
+    Returns:
+        cache: Dictionary describing the opened cache
+    """
+    config_dir = os.path.join(cache_dir, preprocessing_config_hash(config))
+    os.makedirs(config_dir, exist_ok=True)
+
+    index_path = os.path.join(config_dir, INDEX_FILE_NAME)
+
+    return {'dir': config_dir, 'index_path': index_path, 'lock_path': os.path.join(config_dir, LOCK_FILE_NAME),
+            'index': read_index(index_path, config)}
+
+
+def read_index(index_path, config):
+    if os.path.exists(index_path):
+        with open(index_path, 'r') as f:
+            return json.load(f)
+
+    return {'config': config, 'shards': [], 'entries': {}}
+
+
+@contextlib.contextmanager
+def index_lock(cache, timeout = LOCK_TIMEOUT):
+    """
+    Exclusive lock on the index of the cache, shared between processes
+    (a lock file created atomically, so it also works on Windows and network file systems).
+    """
+    start = time.monotonic()
+    while True:
+        try:
+            fd = os.open(cache['lock_path'], os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            if time.monotonic() - start > timeout:
+                raise TimeoutError(f"Feature cache index locked for more than {timeout} s; "
+                                   f"remove {cache['lock_path']} if no other process is using the cache")
+            time.sleep(0.05)
+
+    try:
+        os.write(fd, str(os.getpid()).encode('utf-8'))
+        os.close(fd)
+        yield
+    finally:
+        os.remove(cache['lock_path'])
+
+
+def missing_keys(cache, keys):
+    """
+    Return the positions of the keys that are not stored in the cache yet.
+    """
+    entries = cache['index']['entries']
+
+    return [i for i, key in enumerate(keys) if key not in entries]
+
+
+def write_feature_shard(cache, keys, features):
+    """
+    Store a block of features as a new shard and register its keys in the index.
+
+    The shard has a unique name, so concurrent writers never overwrite each other's shards,
+    and the index is re-read, merged and written under index_lock, so no entry is lost.
+
+    Args:
+        cache: Cache returned by open_feature_cache
+        keys: List of file keys (one per row of features)
+        features: Array of shape [n, num_frames, num_features]
+    """
+    shard_name = f"shard_{uuid.uuid4().hex}.npy"
+    np.save(os.path.join(cache['dir'], shard_name), np.asarray(features, dtype=np.float32))
+
+    with index_lock(cache):
+        # Other processes may have added shards since the cache was opened
+        index = read_index(cache['index_path'], cache['index']['config'])
+
+        shard_id = len(index['shards'])
+        index['shards'].append(shard_name)
+        for row, key in enumerate(keys):
+            index['entries'][key] = [shard_id, row]
+
+        # Write the index atomically, so that an interrupted run never leaves a corrupt cache
+        tmp_path = f"{cache['index_path']}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(index, f)
+        os.replace(tmp_path, cache['index_path'])
+
+    cache['index'] = index
+
+
+def clear_feature_cache(cache_dir, keep_config = None):
+    """
+    Remove cached features from disk.
+
+    Args:
+        cache_dir: Root directory of the feature cache
+        keep_config: If given, the cache of this configuration is kept and all the others are removed
+    """
+    if not os.path.isdir(cache_dir):
+        return
+
+    keep = preprocessing_config_hash(keep_config) if keep_config is not None else None
+
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if name != keep and os.path.isdir(path):
+            shutil.rmtree(path)
+
+
+
+### DATASET
+
+def cached_features_dataset(cache, keys, labels, shuffle = False):
+    """
+    Create a TensorFlow dataset streaming the cached features from disk.
+    The shards are memory mapped, so only the rows that are actually read are loaded.
+
+    Note that the waveform is not cached; to keep the (features, wav, label)
+    structure of create_tf_dataset, an empty waveform is returned instead.
+
+    Args:
+        cache: Cache returned by open_feature_cache (all keys must be present)
+        keys: List of file keys, in dataset order
+        labels: List of corresponding labels
+        shuffle: Whether to shuffle the examples
+    Returns:
+        dataset: TensorFlow dataset of (features, wav, label)
+    """
+    entries = cache['index']['entries']
+    locations = np.array([entries[key] for key in keys], dtype=np.int64).reshape(-1, 2)
+
+    # Memory map the shards that are needed
+    shard_names = cache['index']['shards']
+    shards = {int(shard_id): np.load(os.path.join(cache['dir'], shard_names[int(shard_id)]), mmap_mode='r')
+              for shard_id in np.unique(locations[:, 0])}
+    feature_shape = next(iter(shards.values())).shape[1:]
+
+    def read_row(shard_id, row):
+        return np.array(shards[int(shard_id)][int(row)], dtype=np.float32)
+
+    def load(shard_id, row, label):
+        features = tf.numpy_function(read_row, [shard_id, row], tf.float32)
+        features.set_shape(feature_shape)
+        return features, tf.zeros([0], dtype=tf.float32), label
+
+    ds = tf.data.Dataset.from_tensor_slices((locations[:, 0], locations[:, 1], labels))
+
+    if shuffle:
+        ds = ds.shuffle(buffer_size=len(ds))
+
+    ds = ds.map(load, num_parallel_calls=tf.data.AUTOTUNE)
+
+    return ds
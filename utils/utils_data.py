@@ -12,6 +12,7 @@ from pathlib import Path
 import sounddevice as sd
 from utils_spec_augmentation import *
 from scipy.signal import gammatone
+from utils import utils_cache, utils_noise, utils_manifest, utils_random, utils_distribute
 
 
 
@@ -100,7 +101,7 @@ def listen_audio(wav, sample_rate=16000):
 # THESE TWO FOR SINGLE WAV FILES
 
 def add_noise(wav, noise_dir='speech_commands_v0.02/_background_noise_', 
-              noise_type='random', min_snr_db=-5, max_snr_db=10):
+              noise_type='random', min_snr_db=-5, max_snr_db=10, seed=None):
     """
     Add noise to an audio waveform at a random SNR between min_snr_db and max_snr_db.
     Using : https://github.com/hrtlacek/SNR/blob/main/SNR.ipynb
@@ -113,9 +114,13 @@ def add_noise(wav, noise_dir='speech_commands_v0.02/_background_noise_',
         noise_type: Type of noise ('random', 'white', etc.)
         min_snr_db: Minimum SNR in dB
         max_snr_db: Maximum SNR in dB
+        seed: Optional seed of the noise file, segment and SNR (reproducible, and independent
+              of the global state of the random module)
     Returns:
         wavs_noisy: waveform with added noise at specified SNR
     """
+    rng = random.Random(seed) if seed is not None else random
+
     # Load the noise files
     noise_files = list(pathlib.Path(noise_dir).glob('*.wav'))
     noise_files = [str(noise_file) for noise_file in noise_files]
@@ -123,7 +128,7 @@ def add_noise(wav, noise_dir='speech_commands_v0.02/_background_noise_',
 
     if noise_type == 'random':
         # Randomly select a noise file
-        noise_file = random.choice(noise_files)
+        noise_file = rng.choice(sorted(noise_files))
     else:
         noise_file = noise_dir / (noise_type + '.wav')
         noise_file = str(noise_file)
@@ -133,7 +138,7 @@ def add_noise(wav, noise_dir='speech_commands_v0.02/_background_noise_',
 
     # Get a random segment of noise
     noise_length = tf.shape(noise_wav)[0]
-    start_index = random.randint(0, noise_length - 16000)
+    start_index = rng.randint(0, int(noise_length) - 16000)
     noise_segment = noise_wav[start_index:start_index + 16000]
     
     # Ensure the noise segment has the same shape as the wav
@@ -145,7 +150,7 @@ def add_noise(wav, noise_dir='speech_commands_v0.02/_background_noise_',
     noise_power = tf.reduce_mean(tf.square(noise_segment))
     
     # Generate random SNR in the specified range
-    target_snr_db = random.uniform(min_snr_db, max_snr_db)
+    target_snr_db = rng.uniform(min_snr_db, max_snr_db)
     
     # Calculate the scaling factor for the noise
     target_snr_linear = 10 ** (target_snr_db / 10)
@@ -217,7 +222,7 @@ def add_padding_or_trimming(wav, target_length = 16000, padding_mode = 'realisti
 
 # THIS ONE FOR DATASET
 
-def preprocess_audio(file_path, label, sample_rate, frame_length, frame_step, gammatone = False, noise = False, spec_augmentation = False, noise_type = 'random', min_snr_db = -5, max_snr_db = 10):
+def preprocess_audio(file_path, label, sample_rate, frame_length, frame_step, gammatone = False, noise = False, spec_augmentation = False, noise_type = 'random', min_snr_db = -5, max_snr_db = 10, noise_bank = None, noise_reduction_mode = 'time', seed = None):
     """
     Preprocess the audio file by loading, trimming/padding, and normalizing.
     
@@ -226,10 +231,41 @@ def preprocess_audio(file_path, label, sample_rate, frame_length, frame_step, ga
         file_path: Path to the audio file
         label: Label of the audio file
         noise: Boolean indicating whether to add noise or not
+        noise_bank: Preloaded noise bank (see utils_noise.load_noise_bank), used when noise = True
+        noise_reduction_mode: See extract_features
+        seed: Optional stateless seed [2] of the example (see utils_random.AugmentationSeeds),
+              split into the seeds of the noise and of the spec augmentation
 
     Returns:
+        features: MFCCs or GNCCs of the audio file
         wav: Preprocessed waveform
         label: Label of the audio file"""
+
+    noise_seed, spec_seed = (None, None) if seed is None else tf.unstack(utils_random.split_seed(seed))
+
+    wav, label = load_audio(file_path, label, noise = noise, noise_type = noise_type,
+                            min_snr_db = min_snr_db, max_snr_db = max_snr_db, noise_bank = noise_bank, seed = noise_seed)
+
+    return extract_features(wav, label, sample_rate, frame_length, frame_step,
+                            gammatone = gammatone, spec_augmentation = spec_augmentation,
+                            noise_reduction_mode = noise_reduction_mode, seed = spec_seed)
+
+
+def load_audio(file_path, label, noise = False, noise_type = 'random', min_snr_db = -5, max_snr_db = 10, noise_bank = None, seed = None):
+    """
+    First stage of preprocess_audio : load the audio file, trim/pad it to 16000 samples
+    and (optionally) add background noise. Works on a single example.
+
+    Args:
+        file_path: Path to the audio file
+        label: Label of the audio file
+        noise: Boolean indicating whether to add noise or not
+        noise_bank: Preloaded noise bank (see utils_noise.load_noise_bank), used when noise = True
+        seed: Optional stateless seed [2] of the noise (see utils_random.AugmentationSeeds)
+
+    Returns:
+        wav: Waveform of 16000 samples
+        label: Label of the audio file"""
     # Load audio file
     file_contents = tf.io.read_file(file_path)
     # Decode wav (returns waveform and sample rate)
@@ -261,65 +297,80 @@ def preprocess_audio(file_path, label, sample_rate, frame_length, frame_step, ga
     wav = tf.squeeze(wav, axis = -1)
 
     if noise == True:
-        # Load the noise files
-        noise_files = list(pathlib.Path('speech_commands_v0.02/_background_noise_').glob('*.wav'))
-        noise_files = [str(noise_file) for noise_file in noise_files]
-        noise_dir = Path('speech_commands_v0.02/_background_noise_' + '/')
-
-        if noise_type == 'random':
-            # Randomly select a noise file
-            noise_file = random.choice(noise_files)
+        # Without a preloaded bank, decode the noise files here (at trace time, so only once per map function)
+        if noise_bank is None:
+            noise_bank = utils_noise.load_noise_bank(utils_noise.NOISE_DIR, segment_length = target_length)
+
+        # Get a random segment of noise (file and start index are sampled in-graph)
+        segment_seed, snr_seed = (None, None) if seed is None else tf.unstack(utils_random.split_seed(seed))
+        noise_segment = utils_noise.sample_noise_segment(noise_bank, segment_length = target_length, noise_type = noise_type, stateless_seed = segment_seed)
+
+        # Generate random SNR in the specified range
+        if snr_seed is not None:
+            target_snr_db = tf.random.stateless_uniform([], snr_seed, minval = min_snr_db, maxval = max_snr_db)
         else:
-            noise_file = noise_dir / (noise_type + '.wav')
-            noise_file = str(noise_file)
-            
-       
-        noise_wav, _ = read_path_to_wav(noise_file)
+            target_snr_db = tf.random.uniform([], minval = min_snr_db, maxval = max_snr_db)
 
-        # Get a random segment of noise
-        noise_length = tf.shape(noise_wav)[0]
+        # Add the scaled noise to the signal
+        wav = utils_noise.mix_noise(wav, noise_segment, target_snr_db)
 
-        start_index = tf.random.uniform(
-            shape=[], 
-            minval=0, 
-            maxval=noise_length - 16000,
-            dtype=tf.int32
-                                        )
-      #  start_index = random.randint(0, int(noise_length) - 16000)
+    return wav, label
 
 
-        noise_segment = noise_wav[start_index:start_index + 16000]
-        
-        # Ensure the noise segment has the same shape as the wav
-        if len(noise_segment.shape) > 1:
-            noise_segment = tf.squeeze(noise_segment, axis=-1)
-        
-        # Calculate signal power
-        signal_power = tf.reduce_mean(tf.square(wav))
-        noise_power = tf.reduce_mean(tf.square(noise_segment))
-        
-        # Generate random SNR in the specified range
-        target_snr_db = 5 #random.uniform(min_snr_db, max_snr_db)
-        
-        # Calculate the scaling factor for the noise
-        target_snr_linear = 10 ** (target_snr_db / 10)
-        scaling_factor = tf.sqrt(signal_power / (noise_power * target_snr_linear))
-        
-        # Scale the noise to achieve the target SNR
-        scaled_noise = noise_segment * scaling_factor
-        
-        # Add the scaled noise to the signal
-        wav = wav + scaled_noise
+def extract_features(wav, label, sample_rate, frame_length, frame_step, gammatone = False, spec_augmentation = False, noise_reduction_mode = 'time', seed = None):
+    """
+    Second stage of preprocess_audio : noise reduction, spectrogram, filterbanks, DCT and deltas.
+    Works both on a single waveform [16000] and on a batch of waveforms [B, 16000]
+    (all the operations act on the last axes), so it can be applied after .batch().
+
+    Args:
+        wav: Waveform(s) of 16000 samples
+        label: Label(s) of the audio file(s)
+        gammatone: Whether to compute GNCCs (True) or MFCCs (False)
+        spec_augmentation: Whether to apply spec augmentation
+        noise_reduction_mode: 'time' to apply noise_reduction to the waveform (default),
+                              'spectral' to apply the same noise floor mask directly to the
+                              magnitude spectrogram (spectral_noise_reduction : one STFT per
+                              example instead of two STFTs and an inverse STFT ; the energies
+                              are then computed on the original waveform),
+                              None to skip it. Both noise reductions use the mean magnitude of
+                              the whole clip, so they are not causal : models meant for
+                              streaming inference (see utils_streaming) must be trained with None.
+        seed: Optional stateless seed(s) of the spec augmentation ([2], or [B, 2] for a batch ;
+              see utils_random.AugmentationSeeds)
+
+    Returns:
+        features: MFCCs or GNCCs ([98, 39] or [B, 98, 39])
+        wav: Noise reduced waveform(s)
+        label: Label(s) of the audio file(s)"""
 
     # Remove noise in the frequency domain
-    wav = noise_reduction(wav, noise_threshold=0.1, frame_length=frame_length, frame_step=frame_step)
+    if noise_reduction_mode == 'time':
+        wav = noise_reduction(wav, noise_threshold=0.1, frame_length=frame_length, frame_step=frame_step)
+    elif noise_reduction_mode not in (None, 'spectral'):
+        raise ValueError("Unsupported noise reduction mode: {}".format(noise_reduction_mode))
 
     # Next, get the spectrogram of the audio file
-    spectrogram, frame_step = get_spectrogram(wav)
+    spectrogram, frame_step = get_spectrogram(wav, sample_rate, frame_length = frame_length, frame_step = frame_step)
 
+    if noise_reduction_mode == 'spectral':
+        spectrogram = spectral_noise_reduction(spectrogram, noise_threshold=0.1)
 
-    if spec_augmentation:
-        spectrogram = spec_augment_easy(spectrogram, freq_param = 5, time_param = 15, mode = 'all')
+
+    if spec_augmentation and seed is not None:
+        # Reproducible masks (stateless, drawn from the seed of each example)
+        if spectrogram.shape.rank == 3:
+            spectrogram = tf.map_fn(lambda args: spec_augment_stateless(args[0], args[1], freq_param = 5, time_param = 15, mode = 'all'),
+                                    (spectrogram, seed), fn_output_signature = spectrogram.dtype)
+        else:
+            spectrogram = spec_augment_stateless(spectrogram, seed, freq_param = 5, time_param = 15, mode = 'all')
+
+    elif spec_augmentation:
+        if spectrogram.shape.rank == 3:
+            # The masks are drawn per example
+            spectrogram = tf.map_fn(lambda spec: spec_augment_easy(spec, freq_param = 5, time_param = 15, mode = 'all'), spectrogram)
+        else:
+            spectrogram = spec_augment_easy(spectrogram, freq_param = 5, time_param = 15, mode = 'all')
 
     
     # Get MFCCs
@@ -338,9 +389,166 @@ def preprocess_audio(file_path, label, sample_rate, frame_length, frame_step, ga
     
 
 
+### FEATURE FRONT-END
+
+class FeatureFrontend:
+    """
+    Feature extraction with the whole configuration in one place : waveforms [B, clip_length]
+    to features [B, num_frames, 3 * num_coeffs + 3] (same computations as extract_features,
+    without spec augmentation).
+
+    The constants (filterbank, delta operators) are built once in the constructor,
+    and extract is a tf.function with a fixed input signature, so it is traced only once.
+    The same object configures the training pipeline (create_tf_dataset(..., frontend = ...),
+    also with the feature cache, keyed by frontend.config) and the streaming inference
+    (utils_streaming.IncrementalFeatureExtractor(frontend = ...), with static_features).
+    frontend_parity compares it with extract_features.
+
+    Args:
+        gammatone: GNCCs (True) or MFCCs (False)
+        sample_rate: Sample rate of the audio
+        clip_length: Number of samples of a waveform
+        frame_length, frame_step: STFT frame length and hop (samples)
+        fft_length: FFT length (defaults to frame_length)
+        num_filters: Number of filters (defaults to 32 for gammatone, 26 for mel)
+        min_frequency, max_frequency: Band of the filterbank (max_frequency defaults to Nyquist)
+        num_coeffs: Number of cepstral coefficients (the 0th is skipped)
+        M: Delta context
+        noise_reduction_mode: 'time', 'spectral' or None (see extract_features)
+    """
+
+    def __init__(self, gammatone = True, sample_rate = 16000, clip_length = 16000, frame_length = 400, frame_step = 160, fft_length = None,
+                 num_filters = None, min_frequency = 100, max_frequency = None, num_coeffs = 12, M = 2, noise_reduction_mode = None):
+        if noise_reduction_mode not in ('time', 'spectral', None):
+            raise ValueError("Unsupported noise reduction mode: {}".format(noise_reduction_mode))
+
+        self.gammatone = gammatone
+        self.sample_rate = sample_rate
+        self.clip_length = clip_length
+        self.frame_length = frame_length
+        self.frame_step = frame_step
+        self.fft_length = fft_length or frame_length
+        self.num_filters = num_filters or (32 if gammatone else 26)
+        self.min_frequency = min_frequency
+        self.max_frequency = max_frequency or float(sample_rate/2)
+        self.num_coeffs = num_coeffs
+        self.M = M
+        self.noise_reduction_mode = noise_reduction_mode
+
+        self.num_frames = 1 + (clip_length - frame_length) // frame_step
+        self.num_features = 3 * num_coeffs + 3
+
+        # Constants, shared by every call
+        self.filterbank = get_filterbank('gammatone' if gammatone else 'mel', num_filters = self.num_filters, sample_rate = sample_rate,
+                                         min_freq = min_frequency, max_freq = self.max_frequency, fft_size = self.fft_length)
+        self.delta_operators = delta_operators(self.num_frames, M)
+
+        self.extract = tf.function(self._extract, input_signature = [tf.TensorSpec([None, clip_length], tf.float32, name = 'waveforms')])
+
+
+    def __call__(self, wavs):
+        return self.extract(wavs)
+
+
+    @property
+    def output_shape(self):
+        return (self.num_frames, self.num_features)
+
+
+    @property
+    def config(self):
+        """
+        Full configuration (JSON serializable), e.g. to key the feature cache.
+        """
+        return {
+            'gammatone': bool(self.gammatone),
+            'sample_rate': int(self.sample_rate),
+            'clip_length': int(self.clip_length),
+            'frame_length': int(self.frame_length),
+            'frame_step': int(self.frame_step),
+            'fft_length': int(self.fft_length),
+            'num_filters': int(self.num_filters),
+            'min_frequency': float(self.min_frequency),
+            'max_frequency': float(self.max_frequency),
+            'num_coeffs': int(self.num_coeffs),
+            'M': int(self.M),
+            'noise_threshold': 0.1,
+            'noise_reduction_mode': self.noise_reduction_mode,
+        }
+
+
+    def cepstra(self, spectrogram):
+        """
+        Cepstral coefficients [..., frames, num_coeffs] of a magnitude spectrogram [..., frames, bins].
+        """
+        log_spectrogram = tf.math.log(tf.tensordot(spectrogram, self.filterbank, 1) + np.finfo(float).eps)
+
+        if self.gammatone:
+            return tf.signal.dct(log_spectrogram, type=2)[..., 1:self.num_coeffs+1]
+
+        return tf.signal.mfccs_from_log_mel_spectrograms(log_spectrogram)[..., 1:self.num_coeffs+1]
+
+
+    def static_features(self, frame):
+        """
+        Cepstra and log energy [num_coeffs + 1] of a single frame [frame_length] (no noise reduction,
+        no deltas), used by the streaming feature extractor.
+        """
+        spectrogram, _ = get_spectrogram(frame, self.sample_rate, frame_length = self.frame_length, frame_step = self.frame_step, fft_length = self.fft_length)
+        log_frame_energy = get_log_frame_energy(frame, self.frame_length, self.frame_step)
+
+        return tf.concat([self.cepstra(spectrogram)[0], log_frame_energy[0]], axis=0)
+
+
+    def _extract(self, wavs):
+        if self.noise_reduction_mode == 'time':
+            # (the inverse STFT only covers the complete frames : the waveform gets shorter,
+            # with the same frames)
+            wavs = noise_reduction(wavs, noise_threshold=0.1, frame_length=self.frame_length, frame_step=self.frame_step)
+
+        spectrogram, _ = get_spectrogram(wavs, self.sample_rate, frame_length = self.frame_length, frame_step = self.frame_step, fft_length = self.fft_length)
+
+        if self.noise_reduction_mode == 'spectral':
+            spectrogram = spectral_noise_reduction(spectrogram, noise_threshold=0.1)
+
+        cepstra = self.cepstra(spectrogram)
+        log_frame_energy = get_log_frame_energy(wavs, self.frame_length, self.frame_step)
+
+        # Both orders of deltas of the cepstra and the energy in one product (with self.delta_operators)
+        features = compute_deltas(cepstra, log_frame_energy, self.M)
+
+        return tf.ensure_shape(features, [None, self.num_frames, self.num_features])
+
+
+def frontend_parity(wavs, gammatone = True, sample_rate = 16000, frame_length = 400, frame_step = 160,
+                    noise_reduction_modes = ('time', 'spectral', None)):
+    """
+    Compare a FeatureFrontend (default filterbank, coefficients and deltas) with extract_features
+    on the same batch of waveforms, for every noise reduction mode.
+
+    Args:
+        wavs: Waveforms [B, 16000]
+    Returns:
+        report: {str(mode): max absolute difference of the features}
+    """
+    wavs = tf.convert_to_tensor(wavs, dtype=tf.float32)
+    report = {}
+
+    for mode in noise_reduction_modes:
+        frontend = FeatureFrontend(gammatone = gammatone, sample_rate = sample_rate, clip_length = wavs.shape[-1],
+                                   frame_length = frame_length, frame_step = frame_step, noise_reduction_mode = mode)
+        reference, _, _ = extract_features(wavs, None, sample_rate, frame_length, frame_step,
+                                           gammatone = gammatone, noise_reduction_mode = mode)
+
+        report[str(mode)] = float(tf.reduce_max(tf.abs(frontend(wavs) - reference)))
+
+    return report
+
+
+
 ### MAIN FUNCTIONS 
 
-def load_audio_dataset(data_dir, validation_file, test_file, batch_size=32):
+def load_audio_dataset(data_dir, validation_file, test_file, batch_size=32, use_manifest = False, manifest_path = None):
     """
     Load audio datasets with predefined splits from text files.
     
@@ -351,10 +559,22 @@ def load_audio_dataset(data_dir, validation_file, test_file, batch_size=32):
         batch_size: Batch size for the dataset
         sample_rate: Sample rate for the audio files
         duration: Duration in seconds to crop/pad audio files
+        use_manifest: If True, the file index is read from a cached manifest (see utils_manifest),
+                      which is built with a parallel scan the first time
+        manifest_path: Where to cache the manifest (defaults to data_dir/manifest.npz)
     
     Returns:
         train_ds, val_ds, test_ds: TensorFlow datasets for each split
     """
+    if use_manifest:
+        manifest = utils_manifest.get_manifest(data_dir, validation_file, test_file, manifest_path = manifest_path)
+
+        train_files, train_labels = utils_manifest.select_split(manifest, 'train')
+        val_files_list, val_labels = utils_manifest.select_split(manifest, 'val')
+        test_files_list, test_labels = utils_manifest.select_split(manifest, 'test')
+
+        return train_files, train_labels, val_files_list, val_labels, test_files_list, test_labels, utils_manifest.class_to_index_from_manifest(manifest)
+
     data_dir = pathlib.Path(data_dir)
     
     # Read validation and test file lists
@@ -409,24 +629,125 @@ def load_audio_dataset(data_dir, validation_file, test_file, batch_size=32):
     return train_files, train_labels, val_files_list, val_labels, test_files_list, test_labels, class_to_index
 
     
-def create_tf_dataset(path_files, labels, sample_rate, frame_length, frame_step, mode = 'train', gammatone= False, noise = False, spec_augmentation = False, noise_type = 'random', min_snr_db = -5, max_snr_db = 10):
+def create_tf_dataset(path_files, labels, sample_rate, frame_length, frame_step, mode = 'train', gammatone= False, noise = False, spec_augmentation = False, noise_type = 'random', min_snr_db = -5, max_snr_db = 10, cache_dir = None, cache_shard_size = 4096, batched_features = False, feature_batch_size = 64, noise_reduction_mode = 'time', num_shards = 1, shard_index = 0, frontend = None, augmentation_seeds = None, batched_noise = False, noise_probability = 1.0, num_noises = 1, snr_values = None):
     """
     Create a TensorFlow dataset from the audio files and labels.
     Args:
         path_files: List of audio file paths
         labels: List of corresponding labels
         mode: Mode of the dataset ('train', 'val', or 'test')
+        cache_dir: If given, the deterministic features are stored in (and streamed from) a
+                   persistent on-disk cache in this directory (see utils_cache)
+        cache_shard_size: Number of examples per cache shard
+        batched_features: If True, only decoding/padding/noise run per example; the feature
+                          extraction (STFTs, filterbank, DCT, deltas) runs once per batch of
+                          feature_batch_size waveforms. The dataset is unbatched again afterwards,
+                          so the output is the same as in the per-example mode.
+        feature_batch_size: Number of waveforms per feature extraction batch
+        noise_reduction_mode: 'time', 'spectral' or None (see extract_features)
+        num_shards, shard_index: For multi worker training, the files are split across the
+                                 workers (see utils_distribute.worker_info) and this worker only
+                                 reads the files of its shard (all the shards have the same size,
+                                 see utils_distribute.shard_files)
+        frontend: Optional FeatureFrontend computing the features of every batch of
+                  feature_batch_size waveforms (implies batched_features; its configuration
+                  replaces gammatone, frame_length, frame_step and noise_reduction_mode ;
+                  not supported with spec augmentation ; with cache_dir, the cached features are
+                  computed by the frontend and keyed by its full configuration)
+        augmentation_seeds: Optional utils_random.AugmentationSeeds : the noise and the spec
+                            augmentation of every example are then drawn with stateless ops from
+                            a seed of (global seed, epoch, index of the file), and the shuffling
+                            is seeded too, so every epoch is reproducible
+        min_snr_db, max_snr_db: Range of the (uniform) SNR of the noise
+        batched_noise: If True (implies batched_features), the noise is mixed into every batch of
+                       feature_batch_size waveforms at once (utils_noise.add_noise_batch : one gather
+                       from the noise bank and one scaling for the whole batch), with the options:
+        noise_probability: Probability that an example gets noise
+        num_noises: Number of noise segments mixed into every example
+        snr_values: Optional list of SNRs (in dB) to draw from instead of the [min_snr_db, max_snr_db] range
     Returns:
         dataset: TensorFlow dataset"""
 
-    # Create datasets
-    ds = tf.data.Dataset.from_tensor_slices((path_files, labels))
+    if frontend is not None and spec_augmentation:
+        raise ValueError("The feature front-end does not apply spec augmentation")
+
+    # Shard by file : each worker only reads (and preprocesses) its own files, the same number on every worker
+    # (the per example seeds keep the index of the file in the full list)
+    indices = list(range(len(path_files)))
+    if num_shards > 1:
+        path_files, labels, indices = utils_distribute.shard_files(path_files, labels, num_shards, shard_index)
+
+    # Without noise and spec augmentation, the features of a file never change,
+    # so they can be computed once and streamed from disk afterwards
+    if cache_dir is not None:
+        if not noise and not spec_augmentation:
+            return create_cached_tf_dataset(path_files, labels, sample_rate, frame_length, frame_step, mode = mode,
+                                            gammatone = gammatone, cache_dir = cache_dir, cache_shard_size = cache_shard_size,
+                                            noise_reduction_mode = noise_reduction_mode, frontend = frontend)
+        print("Feature cache skipped: noise and spec augmentation make the features random.")
+
+    # Decode all the background noise files once, instead of once per example
+    noise_bank = utils_noise.load_noise_bank(utils_noise.NOISE_DIR) if noise else None
+
+    # Create datasets (with the index of every file, the per example seeds are derived from it)
+    ds = tf.data.Dataset.from_tensor_slices((path_files, labels, tf.constant(indices, dtype=tf.int64)))
     # Shuffle if train
     if mode == 'train':
-        ds = ds.shuffle(buffer_size=len(ds))
+        ds = ds.shuffle(buffer_size=len(ds), seed = None if augmentation_seeds is None else augmentation_seeds.global_seed)
+
+    def example_seed(index):
+        return None if augmentation_seeds is None else augmentation_seeds.example_seed(index)
+
+    if batched_features or frontend is not None or batched_noise:
+
+        def load(file_path, label, index):
+            if augmentation_seeds is None:
+                return load_audio(file_path, label, noise=noise and not batched_noise, noise_type=noise_type, min_snr_db=min_snr_db,
+                                  max_snr_db=max_snr_db, noise_bank=noise_bank)
+
+            # Same split as in preprocess_audio : noise seed, spec augmentation seed (kept for after .batch())
+            noise_seed, spec_seed = tf.unstack(utils_random.split_seed(example_seed(index)))
+            wav, label = load_audio(file_path, label, noise=noise and not batched_noise, noise_type=noise_type, min_snr_db=min_snr_db,
+                                    max_snr_db=max_snr_db, noise_bank=noise_bank, seed=noise_seed)
+            return wav, label, noise_seed, spec_seed
+
+        ds = ds.map(load, num_parallel_calls=tf.data.AUTOTUNE)
+        ds = ds.batch(feature_batch_size)
+
+        if noise and batched_noise:
+            # Every example is drawn with its own noise seed (seeds[0] : [B, 2]), whatever the batch it is in
+            ds = ds.map(lambda wavs, labels, *seeds: (utils_noise.add_noise_batch(wavs, noise_bank, min_snr_db=min_snr_db, max_snr_db=max_snr_db,
+                                                                                    snr_values=snr_values, noise_probability=noise_probability,
+                                                                                    num_noises=num_noises, noise_type=noise_type,
+                                                                                    seeds=seeds[0] if seeds else None),
+                                                      labels, *seeds),
+                        num_parallel_calls=tf.data.AUTOTUNE)
+
+        if frontend is not None:
+            ds = ds.map(lambda wavs, labels, *seeds: (frontend(tf.ensure_shape(wavs, [None, frontend.clip_length])), wavs, labels),
+                        num_parallel_calls=tf.data.AUTOTUNE)
+            return ds.unbatch()
+
+        ds = ds.map(
+            lambda wavs, labels, *seeds: extract_features(
+                wavs,
+                labels,
+                sample_rate=sample_rate,
+                frame_length=frame_length,
+                frame_step=frame_step,
+                gammatone=gammatone,
+                spec_augmentation=spec_augmentation,
+                noise_reduction_mode=noise_reduction_mode,
+                seed=seeds[1] if seeds else None
+            ),
+            num_parallel_calls=tf.data.AUTOTUNE
+                    )
+        ds = ds.unbatch()
+
+        return ds
  
     ds = ds.map(
-    lambda file_path, label: preprocess_audio(
+    lambda file_path, label, index: preprocess_audio(
         file_path, 
         label, 
         sample_rate=sample_rate,
@@ -437,7 +758,10 @@ def create_tf_dataset(path_files, labels, sample_rate, frame_length, frame_step,
         noise=noise, 
         noise_type=noise_type, 
         min_snr_db=min_snr_db, 
-        max_snr_db=max_snr_db
+        max_snr_db=max_snr_db,
+        noise_bank=noise_bank,
+        noise_reduction_mode=noise_reduction_mode,
+        seed=example_seed(index)
     ),
     num_parallel_calls=tf.data.AUTOTUNE
                 )  
@@ -446,6 +770,79 @@ def create_tf_dataset(path_files, labels, sample_rate, frame_length, frame_step,
     return ds
 
 
+def create_cached_tf_dataset(path_files, labels, sample_rate, frame_length, frame_step, mode = 'train', gammatone = False, cache_dir = 'feature_cache', cache_shard_size = 4096, noise_reduction_mode = 'time', frontend = None):
+    """
+    Create a TensorFlow dataset of deterministic features (no noise, no spec augmentation)
+    backed by the persistent feature cache. Files that are not cached yet (or whose
+    modification time changed) are preprocessed once and written as new shards.
+
+    Args:
+        path_files: List of audio file paths
+        labels: List of corresponding labels
+        mode: Mode of the dataset ('train', 'val', or 'test')
+        cache_dir: Root directory of the feature cache
+        cache_shard_size: Number of examples per cache shard
+        noise_reduction_mode: 'time', 'spectral' or None (see extract_features)
+        frontend: Optional FeatureFrontend computing the features (the cache is then keyed by
+                  its configuration, and the other preprocessing arguments are ignored)
+    Returns:
+        dataset: TensorFlow dataset of (features, wav, label), where wav is empty
+    """
+    # The cache is keyed by the full preprocessing configuration
+    config = {'frontend': frontend.config} if frontend is not None else {
+        'sample_rate': int(sample_rate),
+        'frame_length': int(frame_length),
+        'frame_step': int(frame_step),
+        'gammatone': bool(gammatone),
+        'M': 2,
+        'num_coeffs': 12,
+        'noise_threshold': 0.1,
+        'noise_reduction_mode': noise_reduction_mode,
+    }
+    cache = utils_cache.open_feature_cache(cache_dir, config)
+
+    keys = [utils_cache.file_cache_key(file_path) for file_path in path_files]
+    missing = utils_cache.missing_keys(cache, keys)
+
+    if missing:
+        print(f"Feature cache: computing {len(missing)} of {len(keys)} examples ({mode}).")
+
+        missing_files = [path_files[i] for i in missing]
+        missing_labels = [labels[i] for i in missing]
+
+        # Preprocess in parallel, but keep the order (needed to match features to keys)
+        ds_missing = tf.data.Dataset.from_tensor_slices((missing_files, missing_labels))
+
+        if frontend is not None:
+            ds_missing = ds_missing.map(lambda file_path, label: load_audio(file_path, label, noise=False),
+                                        num_parallel_calls=tf.data.AUTOTUNE, deterministic=True)
+            ds_missing = ds_missing.batch(cache_shard_size).map(
+                lambda wavs, labels: frontend(tf.ensure_shape(wavs, [None, frontend.clip_length])))
+        else:
+            ds_missing = ds_missing.map(
+                lambda file_path, label: preprocess_audio(
+                    file_path,
+                    label,
+                    sample_rate=sample_rate,
+                    frame_length=frame_length,
+                    frame_step=frame_step,
+                    gammatone=gammatone,
+                    noise=False,
+                    spec_augmentation=False,
+                    noise_reduction_mode=noise_reduction_mode),
+                num_parallel_calls=tf.data.AUTOTUNE,
+                deterministic=True)
+            ds_missing = ds_missing.map(lambda features, wav, label: features).batch(cache_shard_size)
+
+        start = 0
+        for features in ds_missing:
+            features = features.numpy()
+            utils_cache.write_feature_shard(cache, [keys[i] for i in missing[start:start + len(features)]], features)
+            start += len(features)
+
+    return utils_cache.cached_features_dataset(cache, keys, labels, shuffle = (mode == 'train'))
+
+
 # Optional
 
 def noise_reduction(wav, noise_threshold=0.1, frame_length = 400, frame_step = 160):
@@ -476,8 +873,8 @@ def noise_reduction(wav, noise_threshold=0.1, frame_length = 400, frame_step = 1
     magnitude = tf.abs(stft)
     phase = tf.math.angle(stft)
     
-    # Compute noise threshold
-    noise_floor = tf.reduce_mean(magnitude, axis=0)
+    # Compute noise threshold (mean over the frames, also for batched input)
+    noise_floor = tf.reduce_mean(magnitude, axis=-2, keepdims=True)
     
     # Create a noise reduction mask
     noise_mask = magnitude < (noise_floor * noise_threshold)
@@ -495,10 +892,29 @@ def noise_reduction(wav, noise_threshold=0.1, frame_length = 400, frame_step = 1
     return cleaned_wav
 
 
+def spectral_noise_reduction(magnitude, noise_threshold=0.1):
+
+    """
+    Same noise floor mask as noise_reduction, applied directly to the magnitude spectrogram
+    used for the filterbanks (no inverse STFT and second STFT).
+
+    Args:
+        magnitude: Magnitude spectrogram [..., frames, bins] (see get_spectrogram)
+        noise_threshold: Threshold for noise reduction (default 0.1)
+    Returns:
+        Noise-reduced magnitude spectrogram
+    """
+    # Noise floor of every frequency bin (mean over the frames)
+    noise_floor = tf.reduce_mean(magnitude, axis=-2, keepdims=True)
+
+    # Set the bins below the threshold to zero
+    return tf.where(magnitude < (noise_floor * noise_threshold), tf.zeros_like(magnitude), magnitude)
+
+
 # FEATURE EXTRACTION
 
 
-def get_spectrogram(wav, sample_rate = 16000):
+def get_spectrogram(wav, sample_rate = 16000, frame_length = None, frame_step = None, fft_length = None):
   # Taken partly from : https://www.tensorflow.org/tutorials/audio/simple_audio
 
 
@@ -512,10 +928,15 @@ def get_spectrogram(wav, sample_rate = 16000):
     # frame_step : defines the overlap of frames that we have. We take the standard
     # value of 10 ms --> 16.000 samples/second * 0.010s = 160 samples.
 
-    frame_length = int(sample_rate * 0.025)  # 25 ms # like in lecture
-    frame_step = int(sample_rate * 0.010)  # 10 ms # like in lecture
+    # (the caller's frame_length / frame_step are used if given)
+    if frame_length is None:
+        frame_length = int(sample_rate * 0.025)  # 25 ms # like in lecture
+    if frame_step is None:
+        frame_step = int(sample_rate * 0.010)  # 10 ms # like in lecture
+    if fft_length is None:
+        fft_length = frame_length
 
-    spectrogram = tf.signal.stft(wav, frame_length= frame_length, frame_step= frame_step, fft_length= frame_length,
+    spectrogram = tf.signal.stft(wav, frame_length= frame_length, frame_step= frame_step, fft_length= fft_length,
                         window_fn= tf.signal.hamming_window) # using Hamming Window like in Lecture (TODO: Eventually we can try different types of windows (e.g. Gaussian etc))
     # Obtain the magnitude of the STFT.
     spectrogram = tf.abs(spectrogram)
@@ -532,21 +953,22 @@ def get_spectrogram(wav, sample_rate = 16000):
 #    Classic filterbank used to extract MFCCs, uses triangular filters
 
 
-def apply_mel_filterbanks(spectrogram, sample_rate = 16000):
+def apply_mel_filterbanks(spectrogram, sample_rate = 16000, num_filters = 26, min_frequency = 100, max_frequency = None):
     # Taken partly from https://www.tensorflow.org/api_docs/python/tf/signal/mfccs_from_log_mel_spectrograms
 
-    # Obtain the number of frequency bins of our spectrogram.
-    num_spectrogram_bins = tf.shape(spectrogram)[-1]
-
     # Define the frequency band we are intereted into:
-    min_frequency = 100  # to filter out some background noise, we look at frequencies from 80 ...
-    max_frequency = float(sample_rate/2)    # ... up to Nyquist frequency (8000 Hz in our case)
+    # min_frequency : to filter out some background noise, we look at frequencies from 100 ...
+    if max_frequency is None:
+        max_frequency = float(sample_rate/2)    # ... up to Nyquist frequency (8000 Hz in our case)
 
     # And the number of filters
-    num_mel_filters = 26
+    num_mel_filters = num_filters
 
     # Create transformation matrix that maps from linear frequency scale to mel frequency scale
-    mel_weight_matrix = tf.signal.linear_to_mel_weight_matrix(num_mel_filters, num_spectrogram_bins, sample_rate, min_frequency, max_frequency)
+    # (built only once per configuration, see get_filterbank)
+    mel_weight_matrix = get_filterbank('mel', num_filters = num_mel_filters, sample_rate = sample_rate,
+                                       min_freq = min_frequency, max_freq = max_frequency,
+                                       fft_size = 2 * (spectrogram.shape[-1] - 1))
 
     # Apply the transformation
     mel_spectrogram = tf.tensordot(spectrogram, mel_weight_matrix, 1)
@@ -564,11 +986,14 @@ def apply_mel_filterbanks(spectrogram, sample_rate = 16000):
 # Define the function to compute the delta coefficients:
 
 def compute_delta(mfccs, M):
+        # Works on [frames, coeffs] as well as on batched [..., frames, coeffs] input
+
         # Get the number of frames (needed, bc tensorflow has None dynamically for the first dimension and we need it in calculations)
-        frame_count = tf.shape(mfccs)[0]
+        frame_count = tf.shape(mfccs)[-2]
     
         # Pad the mfccs at the beginning and at the end to handle boundary frames
-        padded_mfccs = tf.pad(mfccs, [[M, M], [0, 0]], mode='SYMMETRIC')    # This pads [M,M] in time (frames) dimension and pads [0,0] in the frequency dimension
+        batch_paddings = [[0, 0]] * (mfccs.shape.rank - 2)
+        padded_mfccs = tf.pad(mfccs, batch_paddings + [[M, M], [0, 0]], mode='SYMMETRIC')    # This pads [M,M] in time (frames) dimension and pads [0,0] in the frequency dimension
     
         # Prepare the denominator: 2 * sum(m²)
         denominator = 2 * sum([m**2 for m in range(1, M+1)])
@@ -580,11 +1005,11 @@ def compute_delta(mfccs, M):
         for m in range(1, M+1):
         
             # Get frames at n+m
-            next_frames = padded_mfccs[M+m:M+m+frame_count]
+            next_frames = padded_mfccs[..., M+m:M+m+frame_count, :]
             # The indexes are shifted by M with respect to the original mfccs because of the padding
             
             # Get frames at n-m
-            prev_frames = padded_mfccs[M-m:M-m+frame_count]
+            prev_frames = padded_mfccs[..., M-m:M-m+frame_count, :]
         
             # Add weighted difference to the delta coefficients
             deltas += m * (next_frames - prev_frames) / denominator
@@ -592,40 +1017,107 @@ def compute_delta(mfccs, M):
         return deltas
 
 
-def get_mfccs(log_mel_spectrogram, wav, frame_length, frame_step, M = 2):
-    
-    # 1. Compute the DCT and select the coefficients 2, ... 13 from the log-mel spectrogram
-    mfccs_0 = tf.signal.mfccs_from_log_mel_spectrograms(log_mel_spectrogram)[..., 1:13]
- 
+# compute_delta is linear in its input (the symmetric padding only repeats frames), so on a
+# fixed number of frames it is a [frames, frames] banded matrix D; the second order delta
+# (the delta of the delta, each one padded at its own boundaries) is exactly D @ D.
+# The operators are built once per (frames, M) and shared by every graph.
+DELTA_OPERATOR_REGISTRY = {}
+
+
+def delta_operators(num_frames, M = 2):
+    """
+    Regression operators of the first and second order deltas of num_frames frames.
+
+    Args:
+        num_frames: Number of frames (static)
+        M: Delta context (as in compute_delta)
+    Returns:
+        operators: tf.constant of shape [2, num_frames, num_frames] (first and second order)
+    """
+    key = (int(num_frames), int(M))
+
+    if key in DELTA_OPERATOR_REGISTRY:
+        return DELTA_OPERATOR_REGISTRY[key]
+
+    denominator = 2 * sum([m**2 for m in range(1, M+1)])
 
-    # 2. Compute the first derivative of the MFCCs
-    mfccs_delta_1 = compute_delta(mfccs_0, M)
+    # Frame of the original block read by every row of the symmetrically padded block
+    source = np.arange(-M, num_frames + M)
+    source = np.where(source < 0, -source - 1, source)
+    source = np.where(source >= num_frames, 2 * num_frames - 1 - source, source)
+
+    delta_1 = np.zeros((num_frames, num_frames))
+    rows = np.arange(num_frames)
+    for m in range(1, M+1):
+        np.add.at(delta_1, (rows, source[rows + M + m]), m / denominator)
+        np.add.at(delta_1, (rows, source[rows + M - m]), -m / denominator)
+
+    with tf.init_scope():
+        operators = tf.constant(np.stack([delta_1, delta_1 @ delta_1]), dtype=tf.float32)
+
+    DELTA_OPERATOR_REGISTRY[key] = operators
+
+    return operators
+
+
+def compute_deltas(cepstra, log_frame_energy, M = 2):
+    """
+    First and second order deltas of the cepstra and of the energy together, as a single
+    product with the precomputed delta_operators (same values as compute_delta applied
+    once and twice, up to float rounding).
+    Works on [frames, coeffs] as well as on batched [..., frames, coeffs] input.
+
+    Args:
+        cepstra: Cepstral coefficients [..., frames, num_coeffs]
+        log_frame_energy: Log energy of the frames [..., frames, 1]
+        M: Delta context
+    Returns:
+        features: [..., frames, 3 * num_coeffs + 3], ordered as
+                  cepstra, delta, delta-delta, energy, energy delta, energy delta-delta
+    """
+    block = tf.concat([cepstra, log_frame_energy], axis=-1)
+    num_frames = block.shape[-2]
 
+    # Without a static number of frames the operators can't be built : fall back to the loop
+    if num_frames is None:
+        delta_1 = compute_delta(block, M)
+        delta_2 = compute_delta(delta_1, M)
+    else:
+        delta_1, delta_2 = tf.unstack(tf.einsum('ots,...sf->...otf', delta_operators(num_frames, M), block), axis=-3)
 
-    # 3. Compute the second derivative of the MFCCs
-    mfccs_delta_2 = compute_delta(mfccs_delta_1, M)
+    num_coeffs = cepstra.shape[-1]
 
+    return tf.concat([block[..., :num_coeffs], delta_1[..., :num_coeffs], delta_2[..., :num_coeffs],
+                      block[..., num_coeffs:], delta_1[..., num_coeffs:], delta_2[..., num_coeffs:]], axis=-1)
 
-    # 4. Compute the energies of the signal:
 
-    # First energy
+def get_log_frame_energy(wav, frame_length, frame_step):
+    """
+    Log10 energy of every frame of the waveform(s), [..., frames, 1].
+    """
     # Divide the raw audio into frames
     framed_wav = tf.signal.frame(wav, frame_length= frame_length, frame_step= frame_step)
     # Compute the energy of each frame
     frame_energy = tf.reduce_sum(framed_wav**2, axis=-1)
     # Take the logarithm
     log_frame_energy = tf.math.log(frame_energy + np.finfo(float).eps)/tf.math.log(10.0)
-    # Add a dimension to match the shape of mfccs_0
-    log_frame_energy = tf.expand_dims(log_frame_energy, axis=-1)
+    # Add a dimension to match the shape of the cepstra
+    return tf.expand_dims(log_frame_energy, axis=-1)
+
+
+def get_mfccs(log_mel_spectrogram, wav, frame_length, frame_step, M = 2):
+    
+    # 1. Compute the DCT and select the coefficients 2, ... 13 from the log-mel spectrogram
+    mfccs_0 = tf.signal.mfccs_from_log_mel_spectrograms(log_mel_spectrogram)[..., 1:13]
+
 
-    # Second energy
-    energy_delta_1 = compute_delta(log_frame_energy, M)
+    # 2. Compute the log energy of every frame of the signal
+    log_frame_energy = get_log_frame_energy(wav, frame_length, frame_step)
 
-    # Third energy
-    energy_delta_2 = compute_delta(energy_delta_1, M)
 
-    # 5. Finally, concatenate the MFCCs, delta coefficients and energy coefficients:
-    mfccs = tf.concat([mfccs_0, mfccs_delta_1, mfccs_delta_2, log_frame_energy, energy_delta_1, energy_delta_2], axis=-1)
+    # 3. Compute the first and second derivatives of the MFCCs and of the energy (in one product),
+    #    and concatenate the MFCCs, delta coefficients and energy coefficients
+    mfccs = compute_deltas(mfccs_0, log_frame_energy, M)
 
     return mfccs
 
@@ -832,22 +1324,81 @@ def create_gammatone_filterbank(num_filters=32, sample_rate=16000, min_freq=100,
     return filterbank
 
 
+# Since building the filterbanks is expensive (the gammatone one loops in Python over the filters
+# and runs an FFT for each of them), we build each matrix only once and keep it in a registry.
+
+# Registry of the filterbank matrices : (type, num_filters, sample_rate, min_freq, max_freq, fft_size) -> tf.constant
+FILTERBANK_REGISTRY = {}
+
+# If set, the filterbank matrices are also serialized to (and loaded from) this directory
+FILTERBANK_CACHE_DIR = None
+
+
+def get_filterbank(filter_type, num_filters, sample_rate, min_freq, max_freq, fft_size, cache_dir = None):
+    """
+    Get a filterbank matrix, building it only the first time it is requested.
+
+    Args:
+        filter_type: 'mel' or 'gammatone'
+        num_filters: Number of filters
+        sample_rate: Sample rate of the audio
+        min_freq: Lowest frequency of the filterbank
+        max_freq: Highest frequency of the filterbank
+        fft_size: FFT length of the spectrogram (the matrix has fft_size // 2 + 1 rows)
+        cache_dir: Directory to serialize the matrix to (defaults to FILTERBANK_CACHE_DIR)
+    Returns:
+        filterbank: tf.constant of shape [fft_size // 2 + 1, num_filters]
+    """
+    key = (filter_type, int(num_filters), int(sample_rate), float(min_freq), float(max_freq), int(fft_size))
+
+    if key in FILTERBANK_REGISTRY:
+        return FILTERBANK_REGISTRY[key]
+
+    cache_dir = cache_dir if cache_dir is not None else FILTERBANK_CACHE_DIR
+    cache_path = None
+    if cache_dir is not None:
+        cache_path = os.path.join(cache_dir, "{}_{}_{}_{:g}_{:g}_{}.npy".format(*key))
+
+    # The matrix is computed eagerly (also when called while tracing a tf.function / dataset map),
+    # so that the same constant can be reused by every graph
+    with tf.init_scope():
+        if cache_path is not None and os.path.exists(cache_path):
+            filterbank = np.load(cache_path)
+
+        elif filter_type == 'mel':
+            filterbank = tf.signal.linear_to_mel_weight_matrix(num_filters, fft_size // 2 + 1, sample_rate, min_freq, max_freq).numpy()
+
+        elif filter_type == 'gammatone':
+            filterbank = create_gammatone_filterbank(num_filters = num_filters, sample_rate = sample_rate,
+                                                     min_freq = min_freq, max_freq = max_freq, fft_size = fft_size)
+
+        else:
+            raise ValueError("Unsupported filterbank type: {}".format(filter_type))
+
+        if cache_path is not None and not os.path.exists(cache_path):
+            os.makedirs(cache_dir, exist_ok = True)
+            np.save(cache_path, filterbank)
+
+        filterbank = tf.constant(filterbank, dtype=tf.float32)
+
+    FILTERBANK_REGISTRY[key] = filterbank
+
+    return filterbank
+
+
 # Finally, we apply the filterbank to our spectrogram
 
-def apply_gammatone_filterbanks(spectrogram, sample_rate=16000):
-    
-    # Obtain the number of frequency bins of our spectrogram
-    num_spectrogram_bins = tf.shape(spectrogram)[-1]
+def apply_gammatone_filterbanks(spectrogram, sample_rate=16000, num_filters = 32, min_frequency = 100, max_frequency = None):
     
     # Define the frequency band we are interested in (same as mel filter implementation)
-    min_frequency = 100
-    max_frequency = float(sample_rate/2)
-    
-    # Number of filters (same as mel filters)
-    num_filters = 32
+    if max_frequency is None:
+        max_frequency = float(sample_rate/2)
     
-    # Create Gammatone filter bank
-    gammatone_weight_matrix = create_gammatone_filterbank_tf(num_filters = num_filters, sample_rate=16000, min_freq=100, max_freq=8000, fft_size=400)
+    # Create Gammatone filter bank (built only once per configuration, see get_filterbank),
+    # matching the FFT length of the spectrogram
+    gammatone_weight_matrix = get_filterbank('gammatone', num_filters = num_filters, sample_rate = sample_rate,
+                                             min_freq = min_frequency, max_freq = max_frequency,
+                                             fft_size = 2 * (spectrogram.shape[-1] - 1))
     
     # Apply the transformation
     gammatone_spectrogram = tf.tensordot(spectrogram, gammatone_weight_matrix, 1)
@@ -866,31 +1417,15 @@ def get_gnccs(log_gammatone_spectrogram, wav, frame_length, frame_step, M = 2, n
     # 1. Compute the DCT
     gnccs_full = tf.signal.dct(log_gammatone_spectrogram, type=2)
     # Select coefficients (skip the 0th)
-    gnccs_0 = gnccs_full[:, 1:num_coeffs+1]
+    gnccs_0 = gnccs_full[..., 1:num_coeffs+1]
 
     
-    # 2. Compute the first derivative of the GNCCs
-    gnccs_delta_1 = compute_delta(gnccs_0, M)
-
-
-    # 3. Compute the second derivative of the GNCCs
-    gnccs_delta_2 = compute_delta(gnccs_delta_1, M)
-
-    # 4. Compute the energies of the signal (same as before)
-    # First energy
-    framed_wav = tf.signal.frame(wav, frame_length=frame_length, frame_step=frame_step)
-    frame_energy = tf.reduce_sum(framed_wav**2, axis=-1)
-    log_frame_energy = tf.math.log(frame_energy + np.finfo(float).eps)/tf.math.log(10.0)
-    log_frame_energy = tf.expand_dims(log_frame_energy, axis=-1)
-
-    # Second energy
-    energy_delta_1 = compute_delta(log_frame_energy, M)
-
-    # Third energy
-    energy_delta_2 = compute_delta(energy_delta_1, M)
+    # 2. Compute the log energy of every frame of the signal (same as before)
+    log_frame_energy = get_log_frame_energy(wav, frame_length, frame_step)
 
-    # 6. Concatenate the GCCs, delta coefficients and energy coefficients
-    gnccs = tf.concat([gnccs_0, gnccs_delta_1, gnccs_delta_2, log_frame_energy, energy_delta_1, energy_delta_2], axis=-1)
+    # 3. Compute the first and second derivatives of the GNCCs and of the energy (in one product),
+    #    and concatenate the GCCs, delta coefficients and energy coefficients
+    gnccs = compute_deltas(gnccs_0, log_frame_energy, M)
 
     return gnccs
 
@@ -0,0 +1,183 @@
+import os
+import sys
+import json
+import socket
+import subprocess
+import tensorflow as tf
+
+
+
+### DEVICES AND STRATEGIES
+
+def configure_local_cpu_devices(num_devices):
+    """
+    Split the physical CPU into num_devices logical devices, so that MirroredStrategy
+    can run one replica per device on a single machine.
+    Must be called before any tensorflow operation runs.
+    """
+    cpus = tf.config.list_physical_devices('CPU')
+    tf.config.set_logical_device_configuration(cpus[0], [tf.config.LogicalDeviceConfiguration() for _ in range(num_devices)])
+
+    return tf.config.list_logical_devices('CPU')
+
+
+def get_strategy(kind = None, num_cpu_devices = None):
+    """
+    Create the distribution strategy used to build and train the models.
+
+    Args:
+        kind: None (default strategy, single device),
+              'mirrored' (one replica per local device : the GPUs, or the logical CPU devices),
+              'multi_worker' (one replica per worker process, configured through TF_CONFIG, see set_tf_config)
+        num_cpu_devices: For 'mirrored' without GPUs, number of logical CPU devices to create
+    Returns:
+        strategy: tf.distribute.Strategy
+    """
+    if kind is None:
+        return tf.distribute.get_strategy()
+
+    if kind == 'mirrored':
+        if tf.config.list_physical_devices('GPU'):
+            return tf.distribute.MirroredStrategy()
+
+        devices = configure_local_cpu_devices(num_cpu_devices) if num_cpu_devices else tf.config.list_logical_devices('CPU')
+        # NCCL is GPU only : reduce the gradients on one device instead
+        return tf.distribute.MirroredStrategy(devices = [device.name for device in devices],
+                                              cross_device_ops = tf.distribute.ReductionToOneDevice())
+
+    if kind == 'multi_worker':
+        communication = tf.distribute.experimental.CommunicationImplementation.RING
+        return tf.distribute.MultiWorkerMirroredStrategy(
+            communication_options = tf.distribute.experimental.CommunicationOptions(implementation = communication))
+
+    raise ValueError("Unsupported strategy: {}".format(kind))
+
+
+def worker_info():
+    """
+    Number of workers and index of this worker, read from TF_CONFIG (1 and 0 without it).
+    """
+    tf_config = json.loads(os.environ.get('TF_CONFIG', '{}'))
+    workers = tf_config.get('cluster', {}).get('worker', [])
+
+    if not workers:
+        return 1, 0
+
+    return len(workers), int(tf_config['task']['index'])
+
+
+def set_tf_config(worker_addresses, task_index):
+    """
+    Set the TF_CONFIG environment variable of a MultiWorkerMirroredStrategy worker.
+
+    Args:
+        worker_addresses: List of 'host:port' of all the workers
+        task_index: Index of this worker (worker 0 is the chief)
+    """
+    os.environ['TF_CONFIG'] = json.dumps({
+        'cluster': {'worker': list(worker_addresses)},
+        'task': {'type': 'worker', 'index': task_index},
+    })
+
+
+def launch_local_workers(num_workers, args, host = 'localhost'):
+    """
+    Start num_workers local processes running `python <args>`, each with its TF_CONFIG,
+    to test the multi worker training on a single machine, e.g.
+        launch_local_workers(2, ['main.py'])
+    (with the strategy of main.py set to 'multi_worker').
+
+    Returns:
+        return_codes: Exit code of each worker
+    """
+    # Free ports for the workers
+    ports = []
+    for _ in range(num_workers):
+        with socket.socket() as s:
+            s.bind((host, 0))
+            ports.append(s.getsockname()[1])
+    addresses = [f"{host}:{port}" for port in ports]
+
+    processes = []
+    for index in range(num_workers):
+        env = dict(os.environ)
+        env['TF_CONFIG'] = json.dumps({'cluster': {'worker': addresses}, 'task': {'type': 'worker', 'index': index}})
+        processes.append(subprocess.Popen([sys.executable] + list(args), env = env))
+
+    return [process.wait() for process in processes]
+
+
+
+### DATASETS
+
+def global_batch_size(per_replica_batch_size, strategy):
+    """
+    Batch size of the (global) dataset : every replica gets per_replica_batch_size examples per step.
+    """
+    return per_replica_batch_size * strategy.num_replicas_in_sync
+
+
+def shard_files(path_files, labels, num_shards, shard_index):
+    """
+    Split the files across the workers, with the same number of files on every worker.
+
+    Under MultiWorkerMirroredStrategy every worker must run the same number of steps per epoch
+    (the gradients are all-reduced at every step) : with uneven shards, the workers with more batches
+    would wait forever in the collectives at the end of the epoch. The shorter shards (when the number
+    of files does not divide evenly) are therefore padded with files from the start of the list, i.e. at
+    most one example per worker is seen twice per epoch. The datasets then map every file to one example, so all
+    the workers get the same number of batches (and the same size for the last one).
+
+    Args:
+        path_files: List of audio file paths
+        labels: List of corresponding labels
+        num_shards: Number of workers
+        shard_index: Index of this worker
+    Returns:
+        path_files, labels: Files and labels of this worker
+        indices: Position of every file of the shard in the full list (for the per example seeds)
+    """
+    path_files, labels = list(path_files), list(labels)
+    shard_size = -(-len(path_files) // num_shards)
+
+    # Every num_shards-th file, wrapping around the list for the shorter shards
+    indices = [(shard_index + i * num_shards) % len(path_files) for i in range(shard_size)]
+
+    return [path_files[i] for i in indices], [labels[i] for i in indices], indices
+
+
+def set_auto_shard_policy(ds, file_based):
+    """
+    Configure how tf.distribute shards the dataset across the workers.
+
+    Args:
+        ds: Dataset given to model.fit
+        file_based: True if the dataset reads its data from several files (e.g. utils_tfrecord.read_graph_tfrecords) :
+                    every worker then reads its own subset of the files (FILE).
+                    Otherwise every worker would run the whole pipeline and keep 1/num_workers of
+                    the elements (DATA); the audio datasets are instead sharded by file before
+                    decoding (create_tf_dataset(..., num_shards, shard_index), see shard_files), so auto sharding is OFF.
+    """
+    options = tf.data.Options()
+    options.experimental_distribute.auto_shard_policy = (tf.data.experimental.AutoShardPolicy.FILE if file_based
+                                                         else tf.data.experimental.AutoShardPolicy.OFF)
+
+    return ds.with_options(options)
+
+
+def per_replica_graph_spec(graph_tensor_specification):
+    """
+    Graph spec to build the model with : the global batch is split across the replicas,
+    so the batch dimension must not be fixed (e.g. by drop_remainder = True).
+    """
+    return graph_tensor_specification._unbatch()._batch(None)
+
+
+def build_model(builder, graph_tensor_specification, strategy = None, **kwargs):
+    """
+    Build a model (any of the base_gnn builders) with its variables mirrored by the strategy.
+    """
+    strategy = strategy or tf.distribute.get_strategy()
+
+    with strategy.scope():
+        return builder(graph_tensor_specification = per_replica_graph_spec(graph_tensor_specification), **kwargs)
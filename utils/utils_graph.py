@@ -7,7 +7,7 @@ import scipy as sp
 
 
 #TODO: alpha, beta and threshold are best to be tuned on a validation set
-def create_adjacency_matrix(mfcc, num_frames, label, mode = 'similarity', n_dilation_layers = 0, window_size = 5, window_size_cosine = 10, cosine_window_thresh = 0.3, alpha = 0.7, beta = 0.1, threshold = 0.3):
+def create_adjacency_matrix(mfcc, num_frames, label, mode = 'similarity', n_dilation_layers = 0, window_size = 5, window_size_cosine = 10, cosine_window_thresh = 0.3, alpha = 0.7, beta = 0.1, threshold = 0.3, k = 8, knn_radius = None, knn_direction = 'in'):
     """
     Create a custom adjacency matrix for the graph.
     Since all our MFCCs are of the same length, we can create a static adjacency matrix.
@@ -19,7 +19,7 @@ def create_adjacency_matrix(mfcc, num_frames, label, mode = 'similarity', n_dila
         num_frames: Number of frames in the MFCC.
         label: The label of the audio file.
         mode: Sets the mode in which the adjacency matrix is created.
-               'window', 'cosine window', 'similarity'
+               'window', 'cosine window', 'similarity', 'knn'
         n_dilation_layers: Number of dilation layers to create.
         window_size: Size of the sliding window for the 'window' mode.
         window_size_cosine: Size of the sliding window for the 'cosine window' mode.
@@ -27,6 +27,14 @@ def create_adjacency_matrix(mfcc, num_frames, label, mode = 'similarity', n_dila
         beta: Scaling factor in the distance penalty for the similarity function (decides how fast the penalty increases with distance).
         cosine_window_thresh: Threshold for the cosine window mode.
         threshold: Threshold for the similarity function.
+        k: Number of neighbors of every frame for the 'knn' mode.
+        knn_radius: For the 'knn' mode, only the frames at most knn_radius apart are candidate neighbors (None for all the frames).
+        knn_direction: For the 'knn' mode, 'in' : the edges go from the k neighbors to the frame (every frame receives
+                       exactly k messages in the models receiving at tfgnn.TARGET : base_GATv2_model, GAT_GCN_model,
+                       base_gnn_weighted_model), 'out' : the edges go from the frame to its k neighbors (for the models
+                       receiving at tfgnn.SOURCE : base_gnn_model, base_gnn_model_learning_edge_weights, base_gnn_model_using_gcn,
+                       base_gnn_model_using_gcn_with_residual_blocks, base_gnn_with_context_node_model).
+                       Use base_gnn.knn_direction_for_builder to get the direction of a builder.
    
         
         Returns:
@@ -67,6 +75,13 @@ def create_adjacency_matrix(mfcc, num_frames, label, mode = 'similarity', n_dila
         # Fix self loops by setting diagonal to 0
         adjacency_matrix = tf.linalg.set_diag(adjacency_matrix, tf.zeros(num_frames, dtype=tf.float32))
 
+        adjacency_matrices.append(adjacency_matrix)
+
+        # Dilated versions (rates 2, 4, 6, ... as for the other modes) : the frames exactly d hops away,
+        # the same edge sets as create_edge_lists(mode = 'window')
+        dilation_rates = [2 * (i + 1) for i in range(n_dilation_layers)]
+        adjacency_matrices.extend(create_dilated_adjacency_matrices(adjacency_matrix, dilation_rates))
+
     
 
     elif mode == 'cosine window':
@@ -105,17 +120,15 @@ def create_adjacency_matrix(mfcc, num_frames, label, mode = 'similarity', n_dila
         # Create a dilated version of the adjacency matrix
         # We start with a dilation rate of 2 and increase it by 2 for each layer
         # (2, 4, 6, 8, ...)
-        dilation_rate = 2
+        # All the dilated matrices come out of a single breadth-first expansion,
+        # and the similarity matrix computed above is reused for their weights
+        dilation_rates = [2 * (i + 1) for i in range(n_dilation_layers)]
 
-        for i in range(n_dilation_layers):
-            adjacency_matrix_dilated = create_dilated_adjacency_matrix(adjacency_matrix, dilation_rate=dilation_rate)
+        for adjacency_matrix_dilated in create_dilated_adjacency_matrices(adjacency_matrix, dilation_rates):
             # Substitute the weights of the edges with the cosine similarity values
-            similarity_matrix = normalized_cosine_similarity(mfcc, num_frames)
             adjacency_matrix_dilated = tf.where(adjacency_matrix_dilated > 0, similarity_matrix, adjacency_matrix_dilated)
             # Append the dilated adjacency matrix to the list
             adjacency_matrices.append(adjacency_matrix_dilated)
-            # Increase the dilation rate for the next layer
-            dilation_rate += 2
 
 
 
@@ -140,16 +153,47 @@ def create_adjacency_matrix(mfcc, num_frames, label, mode = 'similarity', n_dila
         # Create a dilated version of the adjacency matrix
         # We start with a dilation rate of 2 and increase it by 2 for each layer
         # (2, 4, 6, 8, ...)
-        dilation_rate = 2
+        dilation_rates = [2 * (i + 1) for i in range(n_dilation_layers)]
 
-        for i in range(n_dilation_layers):
-            adjacency_matrix_dilated = create_dilated_adjacency_matrix(adjacency_matrix, dilation_rate=dilation_rate)
+        for adjacency_matrix_dilated in create_dilated_adjacency_matrices(adjacency_matrix, dilation_rates):
             # Substitute the weights of the edges with the similarity values
             adjacency_matrix_dilated = tf.where(adjacency_matrix_dilated > 0, similarity_matrix, adjacency_matrix_dilated)
             # Append the dilated adjacency matrix to the list
             adjacency_matrices.append(adjacency_matrix_dilated)
-            # Increase the dilation rate for the next layer
-            dilation_rate += 2
+
+
+
+    elif mode == 'knn':
+
+    # 4. MODE 'KNN' : Like 'similarity', but instead of a threshold every frame keeps its k most similar frames
+    #    (optionally only among the frames at most knn_radius apart). Every graph therefore has exactly
+    #    num_frames * k edges, so the batches have a fixed number of edges and a predictable memory.
+    #    The graph is directed (frame j can be a neighbor of i but not the opposite) : with knn_direction 'in'
+    #    column i holds the k neighbors of frame i (edges neighbor -> frame, fixed in-degree k, for the models
+    #    receiving at tfgnn.TARGET), with 'out' row i holds them (fixed out-degree k, for the models receiving
+    #    at tfgnn.SOURCE) ; see base_gnn.knn_direction_for_builder.
+    #    (The dilated edge sets are found on this graph as for the other modes, their size is not fixed.)
+
+        check_knn_direction(knn_direction)
+
+        similarity_matrix = similarity_function(mfcc, num_frames, alpha=alpha, beta=beta)
+        neighbors, weights = knn_neighbors(similarity_matrix, num_frames, k, knn_radius)
+
+        # Scatter the k weights of every row
+        rows = tf.repeat(tf.range(tf.shape(neighbors)[0]), k)
+        indices = tf.stack([rows, tf.reshape(neighbors, [-1])], axis=1)
+        adjacency_matrix = tf.scatter_nd(indices, tf.reshape(weights, [-1]), tf.shape(similarity_matrix))
+
+        if knn_direction == 'in':
+            adjacency_matrix = tf.transpose(adjacency_matrix)
+
+        adjacency_matrices.append(adjacency_matrix)
+
+        dilation_rates = [2 * (i + 1) for i in range(n_dilation_layers)]
+
+        for adjacency_matrix_dilated in create_dilated_adjacency_matrices(adjacency_matrix, dilation_rates):
+            adjacency_matrix_dilated = tf.where(adjacency_matrix_dilated > 0, similarity_matrix, adjacency_matrix_dilated)
+            adjacency_matrices.append(adjacency_matrix_dilated)
 
 
     
@@ -164,6 +208,288 @@ def create_adjacency_matrix(mfcc, num_frames, label, mode = 'similarity', n_dila
 
 
 
+def create_edge_lists(mfcc, num_frames, label, mode = 'window', n_dilation_layers = 0, window_size = 5, window_size_cosine = 10, cosine_window_thresh = 0.3, alpha = 0.7, beta = 0.1, k = 8, knn_radius = None, knn_direction = 'in'):
+    """
+    Sparse-native counterpart of create_adjacency_matrix for the banded modes ('window' and 'cosine window') and the 'knn' mode.
+    Instead of materializing [num_frames, num_frames] matrices and recovering the edges with tf.where,
+    the edges are built directly from the band structure and the cosine similarity is computed only
+    for the in-band pairs. The cost therefore scales with the number of edges instead of num_frames².
+
+    Since all clips have the same number of frames, the candidate edges are the same for every example:
+    they are taken from a precomputed template (see get_edge_template), and the per-example work
+    reduces to gathering the weights and applying the threshold mask.
+
+    The edges come out in the same (row-major) order as tf.where on the corresponding adjacency matrix.
+
+    Args:
+        mfcc: The MFCCs of the audio file.
+        num_frames: Number of frames in the MFCC (must be known statically).
+        label: The label of the audio file.
+        mode: 'window', 'cosine window' or 'knn' (same meaning as in create_adjacency_matrix)
+        n_dilation_layers: Number of dilation layers to create.
+        window_size: Size of the sliding window for the 'window' mode.
+        window_size_cosine: Size of the sliding window for the 'cosine window' mode.
+        cosine_window_thresh: Threshold for the cosine window mode.
+        alpha, beta: Parameters of the similarity function for the 'knn' mode.
+        k: Number of neighbors of every frame for the 'knn' mode.
+        knn_radius: Temporal radius of the candidate neighbors for the 'knn' mode (None for all the frames).
+        knn_direction: 'in' (neighbors -> frame, for the models receiving at tfgnn.TARGET) or 'out' (frame -> neighbors,
+                       for the models receiving at tfgnn.SOURCE), see create_adjacency_matrix and base_gnn.knn_direction_for_builder.
+
+    Returns:
+        mfcc: The MFCCs of the audio file.
+        edge_lists: Tuple with one (sources, targets, weights) tuple per edge set.
+        label: The label of the audio file.
+    """
+
+    # Dilation rates 2, 4, 6, ... (as in create_adjacency_matrix)
+    dilation_rates = tuple(2 * (i + 1) for i in range(n_dilation_layers))
+
+    if mode == 'window':
+
+        # Unweighted band : every frame is connected to its 'window_size' neighbors
+        # (the dilated edge sets connect the frames exactly d hops away)
+        template = get_edge_template(mode, num_frames, window_size, dilation_rates)
+        edge_lists = tuple((sources, targets, tf.ones(tf.shape(sources), dtype=tf.float32)) for sources, targets in template)
+
+
+    elif mode == 'cosine window':
+
+        # Normalize the features once; all the edge sets gather their weights from them
+        normalized_features = tf.nn.l2_normalize(mfcc, axis=1)
+
+        # Weighted band : the weights are the normalized cosine similarities of the in-band pairs
+        sources, targets = get_edge_template(mode, num_frames, window_size_cosine)[0]
+        weights = edge_cosine_similarity(normalized_features, sources, targets)
+
+        # Now use a threshold to remove edges with low similarity
+        keep = weights >= cosine_window_thresh
+        sources, targets, weights = tf.boolean_mask(sources, keep), tf.boolean_mask(targets, keep), tf.boolean_mask(weights, keep)
+        edge_lists = ((sources, targets, weights),)
+
+        # The thresholded graph is no longer a band, so the dilated edge sets are
+        # found with a breadth-first expansion on the edge list
+        for dilated_sources, dilated_targets in dilate_edge_list(sources, targets, num_frames, dilation_rates):
+            dilated_weights = edge_cosine_similarity(normalized_features, dilated_sources, dilated_targets)
+            edge_lists += ((dilated_sources, dilated_targets, dilated_weights),)
+
+
+    elif mode == 'knn':
+
+        # Exactly k edges per frame : the edge list has a static size num_frames * k
+        check_knn_direction(knn_direction)
+
+        similarity_matrix = similarity_function(mfcc, num_frames, alpha=alpha, beta=beta)
+        neighbors, weights = knn_neighbors(similarity_matrix, num_frames, k, knn_radius)
+
+        frames = tf.repeat(tf.range(tf.shape(neighbors)[0], dtype=tf.int64), k)
+        neighbors = tf.cast(tf.reshape(neighbors, [-1]), tf.int64)
+        weights = tf.reshape(weights, [-1])
+
+        if knn_direction == 'out':
+            sources, targets = frames, neighbors
+        else:
+            # Edges neighbor -> frame, back in row-major order (by source, then target)
+            order = tf.argsort(neighbors * tf.cast(num_frames, tf.int64) + frames)
+            sources, targets, weights = tf.gather(neighbors, order), tf.gather(frames, order), tf.gather(weights, order)
+
+        edge_lists = ((sources, targets, weights),)
+
+        for dilated_sources, dilated_targets in dilate_edge_list(sources, targets, num_frames, dilation_rates):
+            dilated_weights = tf.gather_nd(similarity_matrix, tf.stack([dilated_sources, dilated_targets], axis=1))
+            edge_lists += ((dilated_sources, dilated_targets, dilated_weights),)
+
+
+    else:
+        raise ValueError("Unsupported mode for edge lists: {}".format(mode))
+
+
+    return mfcc, edge_lists, label
+
+
+
+# Registry of the edge templates : (mode, num_frames, window_size, dilation_rates) -> ((sources, targets), ...)
+EDGE_TEMPLATE_REGISTRY = {}
+
+
+def get_edge_template(mode, num_frames, window_size, dilation_rates = ()):
+
+    """
+    Get the (candidate) edges of a fixed-topology graph, computing them only the first time they are requested.
+    For the banded modes, the first edge set is the band of width window_size and the dilated edge set
+    of rate d connects the frames whose distance is in ((d-1) * window_size, d * window_size],
+    i.e. the frames exactly d hops away in the band graph.
+
+    Args:
+        mode: 'window' or 'cosine window'
+        num_frames: Number of frames (int or tensor with a static value)
+        window_size: Size of the sliding window
+        dilation_rates: Dilation rates of the additional edge sets
+
+    Returns:
+        template: Tuple with one (sources, targets) tuple of int64 constants per edge set.
+    """
+
+    num_frames = tf.get_static_value(num_frames)
+    if num_frames is None:
+        raise ValueError("Edge templates need a static number of frames.")
+
+    key = (mode, int(num_frames), int(window_size), tuple(int(rate) for rate in dilation_rates))
+
+    if key in EDGE_TEMPLATE_REGISTRY:
+        return EDGE_TEMPLATE_REGISTRY[key]
+
+    if mode not in ('window', 'cosine window'):
+        raise ValueError("Unsupported mode for edge templates: {}".format(mode))
+
+    # (min_distance, max_distance] of each edge set
+    bands = [(0, window_size)] + [((rate - 1) * window_size, rate * window_size) for rate in dilation_rates]
+
+    # The constants are created eagerly, so that they can be shared by every traced graph
+    with tf.init_scope():
+        template = tuple(
+            tuple(tf.constant(indices, dtype=tf.int64) for indices in band_edges(int(num_frames), max_distance, min_distance))
+            for min_distance, max_distance in bands)
+
+    EDGE_TEMPLATE_REGISTRY[key] = template
+
+    return template
+
+
+
+def band_edges(num_frames, max_distance, min_distance = 0):
+
+    """
+    Create the edges of a band graph : frame i is connected to every frame j with min_distance < |i - j| <= max_distance.
+    The edges are sorted by source and then by target (as tf.where would return them).
+
+    Returns:
+        sources, targets: numpy int64 arrays of shape [num_edges]
+    """
+
+    # All the offsets inside the band, in increasing order
+    offsets = band_offsets(max_distance, min_distance)
+
+    # Each frame is paired with all the offsets
+    sources = np.repeat(np.arange(num_frames), len(offsets))
+    targets = sources + np.tile(offsets, num_frames)
+
+    # Drop the pairs falling outside the clip
+    valid = (targets >= 0) & (targets < num_frames)
+
+    return sources[valid].astype(np.int64), targets[valid].astype(np.int64)
+
+
+
+def band_offsets(max_distance, min_distance = 0):
+
+    """
+    Offsets j - i of the frames j connected to frame i in a band graph (min_distance < |j - i| <= max_distance).
+
+    Returns:
+        offsets: numpy int64 array, in increasing order
+    """
+
+    return np.concatenate([np.arange(-max_distance, -min_distance), np.arange(min_distance + 1, max_distance + 1)]).astype(np.int64)
+
+
+
+def edge_cosine_similarity(normalized_features, sources, targets):
+
+    """
+    Compute the normalized cosine similarity (as in normalized_cosine_similarity) only for the given pairs of frames.
+    normalized_features are the l2 normalized MFCCs (tf.nn.l2_normalize(mfccs, axis=1)).
+
+    """
+
+    # Dot product of the two endpoints of each edge
+    cosine_similarity = tf.reduce_sum(tf.gather(normalized_features, sources) * tf.gather(normalized_features, targets), axis=-1)
+
+    return (cosine_similarity + 1) / 2
+
+
+
+def dilate_edge_list(sources, targets, num_frames, dilation_rates):
+
+    """
+    Sparse counterpart of create_dilated_adjacency_matrices : the dilated edge set of rate d connects
+    each frame to the frames exactly d hops away (shortest path of length d), which is the same as
+        A_dilated = {A^d - [A^(d-1) + ... + A^1 + (d-1)*I]} > 0
+    The level sets are found with one breadth-first expansion from all frames at once, where each
+    step only gathers/scatters along the existing edges (cost ~ num_edges * num_frames per hop).
+
+    Args:
+        sources, targets: Edge list of the graph
+        num_frames: Number of frames (nodes)
+        dilation_rates: Dilation rates to extract
+
+    Returns:
+        dilated_edge_lists: List of (sources, targets) tuples, one per dilation rate, sorted as tf.where would return them.
+    """
+
+    if not dilation_rates:
+        return []
+
+    num_frames = tf.cast(num_frames, tf.int64)
+
+    # reached[v, i] = 1 if frame v has been reached from frame i ; frontier holds the last level only
+    reached = tf.eye(num_frames, dtype=tf.float32)
+    frontier = reached
+
+    dilated_edge_lists = []
+    for hop in range(1, max(dilation_rates) + 1):
+        # Move every walk one step along the edges (source -> target)
+        frontier = tf.math.unsorted_segment_sum(tf.gather(frontier, sources), targets, num_frames)
+        # Keep only the frames that were not reached with fewer hops
+        frontier = tf.cast(frontier > 0, tf.float32) * (1 - reached)
+        reached = reached + frontier
+
+        if hop in dilation_rates:
+            # Transpose to get [start frame, reached frame] and list the pairs
+            edges = tf.where(tf.transpose(frontier) > 0)
+            dilated_edge_lists.append((edges[:, 0], edges[:, 1]))
+
+    return dilated_edge_lists
+
+
+
+def create_dilated_adjacency_matrices(adjacency_matrix, dilation_rates):
+
+    """
+    Create the dilated adjacency matrices of several dilation rates with one breadth-first expansion.
+    The dilated matrix of rate d connects the nodes exactly d hops away, which is the same as
+        A_dilated = {A^d - [A^(d-1) + ... + A^1 + (d-1)*I]} > 0
+    but needs only max(dilation_rates) matrix products in total, instead of d - 1 products per rate.
+
+    Args:
+        adjacency_matrix: The original adjacency matrix (A)
+        dilation_rates: Dilation rates to compute
+
+    Returns:
+        dilated_adjacency_matrices: List of binary matrices, one per dilation rate
+    """
+
+    if not dilation_rates:
+        return []
+
+    connected = tf.cast(adjacency_matrix > 0, dtype=tf.float32)
+
+    # reached[i, j] = 1 if node j has been reached from node i ; frontier holds the last level only
+    reached = tf.eye(tf.shape(adjacency_matrix)[0], dtype=tf.float32)
+    frontier = reached
+
+    dilated_adjacency_matrices = {}
+    for hop in range(1, max(dilation_rates) + 1):
+        frontier = tf.cast(tf.linalg.matmul(frontier, connected) > 0, dtype=tf.float32) * (1 - reached)
+        reached = reached + frontier
+
+        if hop in dilation_rates:
+            dilated_adjacency_matrices[hop] = frontier
+
+    return [dilated_adjacency_matrices[rate] for rate in dilation_rates]
+
+
+
 def create_dilated_adjacency_matrix(adjacency_matrix, dilation_rate = 2):
 
     """
@@ -281,6 +607,52 @@ def similarity_function(mfccs, num_frames, alpha, beta):
 
 
 
+def check_knn_direction(knn_direction):
+    if knn_direction not in ('in', 'out'):
+        raise ValueError("Unsupported knn direction: {}".format(knn_direction))
+
+
+def knn_neighbors(similarity_matrix, num_frames, k, radius = None):
+
+    """
+    The k most similar frames of every frame (with tf.math.top_k on the rows of the similarity matrix).
+    A frame is never its own neighbor ; with a radius, only the frames at most radius apart are candidates.
+
+    Args:
+        similarity_matrix: Similarity between all pairs of frames [num_frames, num_frames]
+        num_frames: Number of frames
+        k: Number of neighbors (static)
+        radius: Temporal radius of the candidates (None for all the frames) ; must be at least k,
+                so that every frame (including the first and last ones) has k candidates
+
+    Returns:
+        neighbors: Indices of the neighbors of every frame, in increasing order [num_frames, k] (int32)
+        weights: Similarity of every frame to its neighbors [num_frames, k]
+    """
+
+    if radius is not None and radius < k:
+        raise ValueError(f"knn_radius ({radius}) must be at least k ({k}).")
+
+    indices = tf.range(num_frames, dtype=tf.int32)
+    distance = tf.abs(tf.reshape(indices, [-1, 1]) - tf.reshape(indices, [1, -1]))
+
+    # Exclude the frame itself (and the frames outside the radius) from the candidates
+    candidates = distance > 0
+    if radius is not None:
+        candidates = candidates & (distance <= radius)
+    scores = tf.where(candidates, similarity_matrix, tf.fill(tf.shape(similarity_matrix), float('-inf')))
+
+    weights, neighbors = tf.math.top_k(scores, k=k)
+
+    # Sort the neighbors of every row by index (the row-major order of tf.where on the adjacency matrix)
+    order = tf.argsort(neighbors, axis=1)
+    neighbors = tf.gather(neighbors, order, batch_dims=1)
+    weights = tf.gather(weights, order, batch_dims=1)
+
+    return neighbors, weights
+
+
+
 def visualize_adjacency_matrix(adjacency_matrix, title="Adjacency Matrix"):
     """
     Visualize an adjacency matrix as a heatmap.
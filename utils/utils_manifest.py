@@ -0,0 +1,195 @@
+import os
+import wave
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+
+
+# Bump this whenever the manifest layout changes
+MANIFEST_VERSION = 1
+
+SPLITS = ['train', 'val', 'test']
+
+
+
+### SCANNING
+
+def read_wav_header(file_path):
+    """
+    Read only the header of a WAV file.
+
+    Returns:
+        num_samples: Number of samples (per channel)
+        sample_rate: Sample rate of the audio file
+    """
+    with wave.open(file_path, 'rb') as f:
+        return f.getnframes(), f.getframerate()
+
+
+def speaker_id_from_file_name(file_name):
+    """
+    Speech Commands file names are <speaker id>_nohash_<utterance number>.wav (e.g. 0a7c2a8d_nohash_0.wav).
+    """
+    return file_name.split('_nohash_')[0]
+
+
+def scan_class_dir(class_dir, read_headers = True):
+    """
+    List the audio files of one class folder with os.scandir (and read their WAV headers).
+
+    Returns:
+        entries: List of (file name, num_samples, sample_rate)
+    """
+    entries = []
+    with os.scandir(class_dir) as it:
+        for entry in it:
+            if not entry.is_file() or not entry.name.endswith('.wav'):
+                continue
+            num_samples, sample_rate = read_wav_header(entry.path) if read_headers else (-1, -1)
+            entries.append((entry.name, num_samples, sample_rate))
+
+    # Directory order is arbitrary ; sort to get a reproducible manifest
+    return sorted(entries)
+
+
+def build_manifest(data_dir, validation_file, test_file, num_workers = 16, read_headers = True):
+    """
+    Index the whole dataset : scan the class folders in parallel on a thread pool
+    and collect, for every file, its label, split, length, sample rate and speaker.
+
+    Args:
+        data_dir: Directory containing audio files organized in class subfolders
+        validation_file: Path to validation_list.txt
+        test_file: Path to testing_list.txt
+        num_workers: Number of threads scanning the folders
+        read_headers: Whether to read the WAV headers (num_samples, sample_rate)
+    Returns:
+        manifest: Dictionary of columns (numpy arrays) + 'class_names'
+    """
+    # Read validation and test file lists
+    with open(validation_file, 'r') as f:
+        val_files = set(line.strip() for line in f)
+
+    with open(test_file, 'r') as f:
+        test_files = set(line.strip() for line in f)
+
+    # Get all class folders (excluding _background_noise_, since not part of train, val or test)
+    with os.scandir(data_dir) as it:
+        class_names = sorted(entry.name for entry in it
+                             if entry.is_dir() and entry.name != '_background_noise_')
+
+    # Scan the class folders in parallel (the work is I/O bound, so threads are enough)
+    with ThreadPoolExecutor(max_workers = num_workers) as executor:
+        scans = list(executor.map(lambda name: scan_class_dir(os.path.join(data_dir, name), read_headers), class_names))
+
+    paths, labels, splits, num_samples, sample_rates, speakers = [], [], [], [], [], []
+
+    for class_idx, (class_name, entries) in enumerate(zip(class_names, scans)):
+        for file_name, n, sr in entries:
+            # Relative path for matching with validation/test lists (i.e. bed/0a7_nohash_0.wav)
+            rel_path = class_name + '/' + file_name
+            if rel_path in test_files:
+                split = SPLITS.index('test')
+            elif rel_path in val_files:
+                split = SPLITS.index('val')
+            else:
+                split = SPLITS.index('train')
+
+            paths.append(os.path.join(data_dir, class_name, file_name))
+            labels.append(class_idx)
+            splits.append(split)
+            num_samples.append(n)
+            sample_rates.append(sr)
+            speakers.append(speaker_id_from_file_name(file_name))
+
+    return {
+        'path': np.array(paths),
+        'label': np.array(labels, dtype=np.int32),
+        'split': np.array(splits, dtype=np.int8),
+        'num_samples': np.array(num_samples, dtype=np.int64),
+        'sample_rate': np.array(sample_rates, dtype=np.int32),
+        'speaker_id': np.array(speakers),
+        'class_names': np.array(class_names),
+    }
+
+
+
+### STORAGE
+
+def save_manifest(manifest, manifest_path):
+    """
+    Write the manifest as a columnar (uncompressed) NPZ file.
+
+    The file is written under a name unique to the process and then renamed : concurrent
+    writers (e.g. the workers of a multi worker run, which all call get_manifest at startup)
+    each publish a complete file, and the last rename wins.
+    """
+    # (np.savez appends '.npz' to names that do not end with it)
+    tmp_path = f"{manifest_path}.{os.getpid()}.tmp.npz"
+    np.savez(tmp_path, version = np.array(MANIFEST_VERSION), **manifest)
+    os.replace(tmp_path, manifest_path)
+
+
+def load_manifest(manifest_path):
+    """
+    Read a manifest written by save_manifest.
+
+    Returns:
+        manifest: Dictionary of columns, or None if the file is missing or outdated
+    """
+    if not os.path.exists(manifest_path):
+        return None
+
+    with np.load(manifest_path, allow_pickle = False) as data:
+        if int(data['version']) != MANIFEST_VERSION:
+            return None
+        return {key: data[key] for key in data.files if key != 'version'}
+
+
+def get_manifest(data_dir, validation_file, test_file, manifest_path = None, num_workers = 16, rebuild = False):
+    """
+    Load the cached manifest, (re)building it if it is missing, outdated or older than the split lists.
+
+    Args:
+        data_dir: Directory containing audio files organized in class subfolders
+        validation_file: Path to validation_list.txt
+        test_file: Path to testing_list.txt
+        manifest_path: Where to cache the manifest (defaults to data_dir/manifest.npz)
+        num_workers: Number of threads scanning the folders
+        rebuild: Force a new scan
+    Returns:
+        manifest: Dictionary of columns (numpy arrays) + 'class_names'
+    """
+    if manifest_path is None:
+        manifest_path = os.path.join(data_dir, 'manifest.npz')
+
+    manifest = None
+    if not rebuild and os.path.exists(manifest_path):
+        manifest_mtime = os.path.getmtime(manifest_path)
+        if manifest_mtime >= max(os.path.getmtime(validation_file), os.path.getmtime(test_file)):
+            manifest = load_manifest(manifest_path)
+
+    if manifest is None:
+        manifest = build_manifest(data_dir, validation_file, test_file, num_workers = num_workers)
+        save_manifest(manifest, manifest_path)
+
+    return manifest
+
+
+
+### QUERIES
+
+def select_split(manifest, split):
+    """
+    Get the file paths and labels of one split ('train', 'val' or 'test').
+    """
+    mask = manifest['split'] == SPLITS.index(split)
+
+    return manifest['path'][mask].tolist(), manifest['label'][mask].tolist()
+
+
+def class_to_index_from_manifest(manifest):
+    """
+    Create the class to index mapping stored in the manifest.
+    """
+    return {str(cls): i for i, cls in enumerate(manifest['class_names'])}
@@ -0,0 +1,279 @@
+import pathlib
+import numpy as np
+import tensorflow as tf
+from scipy.io import wavfile
+from utils import utils_random
+
+
+
+NOISE_DIR = 'speech_commands_v0.02/_background_noise_'
+
+
+
+### NOISE BANK
+
+def load_noise_bank(noise_dir = NOISE_DIR, segment_length = 16000):
+    """
+    Decode all the background noise files once and pack them into a single
+    contiguous float32 tensor, with the per-file offsets and lengths needed to
+    cut segments out of it with in-graph ops.
+
+    Since the decoding happens in numpy, this can also be called while a
+    tf.data map function is being traced: the bank then becomes a constant of the graph.
+
+    Args:
+        noise_dir: Directory containing the noise files (.wav)
+        segment_length: Length of the segments that will be sampled; shorter files are skipped
+    Returns:
+        noise_bank: Dictionary with
+            'samples': tf.Tensor [total_samples] with all the noise files concatenated
+            'offsets': tf.Tensor [num_files] start of each file in 'samples'
+            'lengths': tf.Tensor [num_files] number of samples of each file
+            'names': list of file names (without extension), in bank order
+    """
+    noise_files = sorted(pathlib.Path(noise_dir).glob('*.wav'))
+
+    waveforms, names = [], []
+    for noise_file in noise_files:
+        _, wav = wavfile.read(str(noise_file))
+
+        # Convert to float in [-1, 1), same scaling as tf.audio.decode_wav
+        if wav.dtype == np.int16:
+            wav = wav.astype(np.float32) / 32768.0
+        elif wav.dtype == np.int32:
+            wav = wav.astype(np.float32) / 2147483648.0
+        else:
+            wav = wav.astype(np.float32)
+
+        # Keep only the first channel
+        if wav.ndim > 1:
+            wav = wav[:, 0]
+
+        if len(wav) <= segment_length:
+            continue
+
+        waveforms.append(wav)
+        names.append(noise_file.stem)
+
+    if not waveforms:
+        raise ValueError(f"No noise files longer than {segment_length} samples found in {noise_dir}")
+
+    lengths = np.array([len(wav) for wav in waveforms], dtype=np.int32)
+    offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]]).astype(np.int32)
+
+    return {
+        'samples': tf.constant(np.concatenate(waveforms), dtype=tf.float32),
+        'offsets': tf.constant(offsets, dtype=tf.int32),
+        'lengths': tf.constant(lengths, dtype=tf.int32),
+        'names': names,
+    }
+
+
+def noise_type_to_index(noise_bank, noise_type):
+    """
+    Convert a noise type (file name without extension, e.g. 'exercise_bike') to its index in the bank.
+    Returns None for 'random'.
+    """
+    if noise_type == 'random':
+        return None
+
+    if noise_type not in noise_bank['names']:
+        raise ValueError("Unknown noise type: {}".format(noise_type))
+
+    return noise_bank['names'].index(noise_type)
+
+
+def sample_noise_segment(noise_bank, segment_length = 16000, noise_type = 'random', seed = None, stateless_seed = None):
+    """
+    Sample a random noise segment from the bank, entirely with in-graph ops.
+
+    Args:
+        noise_bank: Bank returned by load_noise_bank
+        segment_length: Number of samples of the segment
+        noise_type: 'random' to pick a random file, otherwise the name of the noise file
+        seed: Optional op-level seed (together with tf.random.set_seed, makes the selection deterministic)
+        stateless_seed: Optional seed [2] (see utils_random.AugmentationSeeds) : file and start index
+                        are then drawn with stateless ops, independently of the thread running the map
+    Returns:
+        noise_segment: tf.Tensor [segment_length]
+    """
+    num_files = tf.shape(noise_bank['lengths'])[0]
+
+    if stateless_seed is not None:
+        file_seed, start_seed = tf.unstack(tf.random.experimental.stateless_split(stateless_seed, num = 2))
+        uniform = lambda maxval, seed: tf.random.stateless_uniform(shape=[], seed=seed, minval=0, maxval=maxval, dtype=tf.int32)
+    else:
+        file_seed, start_seed = seed, seed
+        uniform = lambda maxval, seed: tf.random.uniform(shape=[], minval=0, maxval=maxval, dtype=tf.int32, seed=seed)
+
+    file_index = noise_type_to_index(noise_bank, noise_type)
+    if file_index is None:
+        # Randomly select a noise file
+        file_index = uniform(num_files, file_seed)
+
+    # Get a random segment of noise
+    noise_length = tf.gather(noise_bank['lengths'], file_index)
+    start_index = uniform(noise_length - segment_length, start_seed)
+    start_index += tf.gather(noise_bank['offsets'], file_index)
+
+    return tf.slice(noise_bank['samples'], [start_index], [segment_length])
+
+
+def mix_noise(wav, noise_segment, target_snr_db):
+    """
+    Add the noise segment to the waveform, scaled to reach the target SNR.
+    Using : https://github.com/hrtlacek/SNR/blob/main/SNR.ipynb
+
+    Args:
+        wav: Audio waveform
+        noise_segment: Noise segment with the same shape as wav
+        target_snr_db: Target SNR in dB
+    Returns:
+        wav_noisy: waveform with added noise at the target SNR
+    """
+    # Calculate signal power
+    signal_power = tf.reduce_mean(tf.square(wav))
+    noise_power = tf.reduce_mean(tf.square(noise_segment))
+
+    # Calculate the scaling factor for the noise
+    target_snr_linear = 10 ** (target_snr_db / 10)
+    scaling_factor = tf.sqrt(signal_power / (noise_power * target_snr_linear))
+
+    # Add the scaled noise to the signal
+    return wav + noise_segment * scaling_factor
+
+
+
+### BATCHED NOISE
+
+def draw_snr_db(batch_size, min_snr_db = -5, max_snr_db = 10, snr_values = None, seeds = None):
+    """
+    Draw one target SNR per example.
+
+    Args:
+        batch_size: Number of examples
+        min_snr_db, max_snr_db: Range of the uniform distribution (in dB)
+        snr_values: Optional list of SNRs (in dB) : the SNR of every example is then one of them,
+                    uniformly (e.g. [0, 5, 10] as in a fixed-SNR protocol) instead of the range
+        seeds: Optional stateless seeds [batch_size, 2], one per example (otherwise stateful ops)
+    Returns:
+        target_snr_db: tf.Tensor [batch_size]
+    """
+    if snr_values is not None:
+        snr_values = tf.constant(snr_values, dtype=tf.float32)
+        shape, maxval, dtype = [batch_size], tf.shape(snr_values)[0], tf.int32
+        choice = (utils_random.uniform_per_example(seeds, minval=0, maxval=maxval, dtype=dtype) if seeds is not None
+                  else tf.random.uniform(shape, minval=0, maxval=maxval, dtype=dtype))
+        return tf.gather(snr_values, choice)
+
+    if seeds is not None:
+        return utils_random.uniform_per_example(seeds, minval=min_snr_db, maxval=max_snr_db)
+
+    return tf.random.uniform([batch_size], minval=min_snr_db, maxval=max_snr_db)
+
+
+def sample_noise_segments(noise_bank, batch_size, segment_length = 16000, noise_type = 'random', seeds = None):
+    """
+    Sample batch_size noise segments from the bank with a single gather.
+
+    Args:
+        noise_bank: Bank returned by load_noise_bank
+        batch_size: Number of segments
+        segment_length: Number of samples of every segment
+        noise_type: 'random' to pick a random file per segment, otherwise the name of the noise file
+        seeds: Optional stateless seeds [batch_size, 2], one per segment (otherwise stateful ops)
+    Returns:
+        noise_segments: tf.Tensor [batch_size, segment_length]
+    """
+    num_files = tf.shape(noise_bank['lengths'])[0]
+
+    if seeds is not None:
+        file_seed, start_seed = tf.unstack(utils_random.split_seeds(seeds, num = 2))
+        uniform = lambda shape, minval, maxval, seeds, dtype: utils_random.uniform_per_example(seeds, minval=minval, maxval=maxval, dtype=dtype)
+    else:
+        file_seed, start_seed = None, None
+        uniform = lambda shape, minval, maxval, seeds, dtype: tf.random.uniform(shape, minval=minval, maxval=maxval, dtype=dtype)
+
+    file_index = noise_type_to_index(noise_bank, noise_type)
+    if file_index is None:
+        file_indices = uniform([batch_size], 0, num_files, file_seed, tf.int32)
+    else:
+        file_indices = tf.fill([batch_size], file_index)
+
+    # Start of every segment, uniform in [0, length - segment_length) of its file
+    # (drawn as a fraction, since the range is different for every example)
+    max_starts = tf.gather(noise_bank['lengths'], file_indices) - segment_length
+    fraction = uniform([batch_size], 0.0, 1.0, start_seed, tf.float32)
+    starts = tf.minimum(tf.cast(fraction * tf.cast(max_starts, tf.float32), tf.int32), max_starts - 1)
+    starts += tf.gather(noise_bank['offsets'], file_indices)
+
+    # [batch_size, segment_length] indices into the bank : one gather for the whole batch
+    indices = starts[:, tf.newaxis] + tf.range(segment_length)[tf.newaxis, :]
+
+    return tf.gather(noise_bank['samples'], indices)
+
+
+def scale_noise_batch(wavs, noise_segments, target_snr_db):
+    """
+    Scale every noise segment to the target SNR with respect to its waveform.
+
+    Args:
+        wavs: Waveforms [B, num_samples]
+        noise_segments: Noise segments [B, num_samples]
+        target_snr_db: Target SNRs [B] (in dB)
+    Returns:
+        scaled_noise: [B, num_samples]
+    """
+    signal_power = tf.reduce_mean(tf.square(wavs), axis=-1)
+    noise_power = tf.reduce_mean(tf.square(noise_segments), axis=-1)
+
+    target_snr_linear = 10 ** (target_snr_db / 10)
+    scaling_factor = tf.sqrt(signal_power / (noise_power * target_snr_linear))
+
+    return noise_segments * scaling_factor[:, tf.newaxis]
+
+
+def mix_noise_batch(wavs, noise_segments, target_snr_db):
+    """
+    Batched mix_noise : add every noise segment to its waveform at its target SNR [B] (in dB).
+    """
+    return wavs + scale_noise_batch(wavs, noise_segments, target_snr_db)
+
+
+def add_noise_batch(wavs, noise_bank, min_snr_db = -5, max_snr_db = 10, snr_values = None, noise_probability = 1.0,
+                    num_noises = 1, noise_type = 'random', seeds = None):
+    """
+    Add background noise to a whole batch of waveforms at once (after .batch()).
+
+    Args:
+        wavs: Waveforms [B, num_samples]
+        noise_bank: Bank returned by load_noise_bank
+        min_snr_db, max_snr_db, snr_values: Distribution of the SNR of every example (see draw_snr_db)
+        noise_probability: Probability that an example gets noise (the others are left clean)
+        num_noises: Number of noise segments mixed into every example ; their powers add up,
+                    so each is scaled to the target SNR + 10 log10(num_noises) dB and the
+                    total noise reaches the target SNR
+        noise_type: 'random' or the name of a noise file
+        seeds: Optional stateless seeds [B, 2], one per example (otherwise stateful ops) : the noise of
+               every example then only depends on its own seed, not on the rest of the batch
+    Returns:
+        wavs_noisy: [B, num_samples]
+    """
+    batch_size, num_samples = tf.shape(wavs)[0], tf.shape(wavs)[1]
+    # [B, 2] seeds of the SNR, of the probability and of every noise segment
+    seeds = [None] * (num_noises + 2) if seeds is None else tf.unstack(utils_random.split_seeds(seeds, num = num_noises + 2))
+
+    target_snr_db = draw_snr_db(batch_size, min_snr_db, max_snr_db, snr_values = snr_values, seeds = seeds[0])
+    per_noise_snr_db = target_snr_db + 10 * np.log10(num_noises)
+
+    noise = tf.zeros_like(wavs)
+    for i in range(num_noises):
+        noise_segments = sample_noise_segments(noise_bank, batch_size, segment_length = num_samples, noise_type = noise_type, seeds = seeds[i + 2])
+        noise += scale_noise_batch(wavs, noise_segments, per_noise_snr_db)
+
+    if noise_probability < 1.0:
+        keep = (utils_random.uniform_per_example(seeds[1]) if seeds[1] is not None
+                else tf.random.uniform([batch_size])) < noise_probability
+        noise *= tf.cast(keep, noise.dtype)[:, tf.newaxis]
+
+    return wavs + noise
@@ -0,0 +1,239 @@
+import os
+import json
+import time
+import platform
+import threading
+import numpy as np
+import tensorflow as tf
+
+
+
+### MEMORY
+
+def current_rss_mb():
+    """
+    Current resident set size of the process in MB (from /proc on Linux, the peak RSS elsewhere).
+    """
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            resident_pages = int(f.read().split()[1])
+        return resident_pages * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except (OSError, ValueError, AttributeError):
+        pass
+
+    return peak_rss_mb()
+
+
+def peak_rss_mb():
+    """
+    Peak resident set size of the process since it started, in MB (ru_maxrss ; None without the resource module).
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    return peak / 2**20 if platform.system() == 'Darwin' else peak / 2**10
+
+
+class MemorySampler:
+    """
+    Samples the host memory (RSS) of the process in a background thread.
+
+    Args:
+        interval: Seconds between two samples
+    """
+
+    def __init__(self, interval = 1.0):
+        self.interval = interval
+        self.samples = []
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _run(self):
+        start = time.perf_counter()
+        while not self._stop.is_set():
+            self.samples.append((time.perf_counter() - start, current_rss_mb()))
+            self._stop.wait(self.interval)
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target = self._run, daemon = True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def summary(self):
+        rss = [value for _, value in self.samples if value is not None]
+        return {
+            'interval_sec': self.interval,
+            'peak_rss_mb': max(rss) if rss else None,
+            'samples': self.samples,
+        }
+
+
+
+### CALLBACKS
+
+class ThroughputCallback(tf.keras.callbacks.Callback):
+    """
+    Records, for every epoch, the training time, the number of steps, the examples/sec
+    (and the host memory at the end of the epoch).
+
+    Args:
+        batch_size: Number of examples per step (global batch size)
+    """
+
+    def __init__(self, batch_size):
+        super().__init__()
+        self.batch_size = batch_size
+        self.epochs = []
+
+    def on_epoch_begin(self, epoch, logs = None):
+        self.epoch_start = time.perf_counter()
+        self.steps = 0
+
+    def on_train_batch_end(self, batch, logs = None):
+        # With steps_per_execution > 1 this is only called once per execution, with the index of its last step
+        self.steps = batch + 1
+
+    def on_test_begin(self, logs = None):
+        # The validation at the end of the epoch is not part of the training throughput
+        self.train_time = time.perf_counter() - self.epoch_start
+
+    def on_epoch_end(self, epoch, logs = None):
+        train_time = getattr(self, 'train_time', None) or (time.perf_counter() - self.epoch_start)
+        self.train_time = None
+
+        self.epochs.append({
+            'epoch': epoch,
+            'train_sec': train_time,
+            'epoch_sec': time.perf_counter() - self.epoch_start,
+            'steps': self.steps,
+            'examples_per_sec': self.steps * self.batch_size / train_time,
+            'rss_mb': current_rss_mb(),
+            **{key: float(value) for key, value in (logs or {}).items()},
+        })
+        print(f"Epoch {epoch}: {self.epochs[-1]['examples_per_sec']:.1f} examples/sec")
+
+
+def profiling_callbacks(profile_dir, batch_size, profile_batches = (10, 20)):
+    """
+    Callbacks of a profiled training run.
+
+    Args:
+        profile_dir: Directory of the TensorBoard logs (open with tensorboard --logdir profile_dir, Profile tab)
+        batch_size: Global batch size
+        profile_batches: (first, last) step of the first epoch captured by the profiler trace
+                         (None for no trace)
+    Returns:
+        callbacks: List of callbacks (the ThroughputCallback is the last one)
+    """
+    callbacks = []
+
+    if profile_batches is not None:
+        callbacks.append(tf.keras.callbacks.TensorBoard(log_dir = profile_dir, profile_batch = tuple(profile_batches)))
+
+    callbacks.append(ThroughputCallback(batch_size))
+
+    return callbacks
+
+
+
+### INPUT PIPELINE
+
+def optimizer_variables(optimizer):
+    # A property of the new optimizers, a method of the legacy ones
+    variables = optimizer.variables
+    return list(variables() if callable(variables) else variables)
+
+
+def measure_input_wait(model, ds, num_steps = 50, skip_steps = 2):
+    """
+    Split the step time into input pipeline wait and compute : the batches are fetched
+    in Python (time waited for the dataset) and then run with model.train_on_batch
+    (same compiled train step as model.fit). Inside model.fit the batch is fetched
+    within the compiled step, so the two can't be told apart from callbacks.
+
+    These are real training steps : the weights and the optimizer state (moments,
+    iterations) are saved before and restored afterwards, so that a profiled run
+    starts model.fit from the same state as an unprofiled one.
+
+    If the wait dominates, the preprocessing (preprocess_audio, graph construction)
+    is the bottleneck ; otherwise it is the model (message passing layers).
+
+    Args:
+        model: Compiled model
+        ds: Batched training dataset
+        num_steps: Number of measured steps
+        skip_steps: First steps not measured (tracing / warm up)
+    Returns:
+        report: Dictionary with the per step times and their summary
+    """
+    # Create the optimizer slots now, so that their initial values can be restored
+    if hasattr(model.optimizer, 'build'):
+        model.optimizer.build(model.trainable_variables)
+    elif hasattr(model.optimizer, '_create_all_weights'):
+        model.optimizer._create_all_weights(model.trainable_variables)
+    weights = model.get_weights()
+    optimizer_state = [variable.numpy() for variable in optimizer_variables(model.optimizer)]
+
+    iterator = iter(ds)
+    waits, computes = [], []
+
+    for step in range(num_steps + skip_steps):
+        t0 = time.perf_counter()
+        try:
+            x, y = next(iterator)
+        except StopIteration:
+            break
+        t1 = time.perf_counter()
+        model.train_on_batch(x, y)
+        t2 = time.perf_counter()
+
+        if step >= skip_steps:
+            waits.append(t1 - t0)
+            computes.append(t2 - t1)
+
+    model.set_weights(weights)
+    for variable, value in zip(optimizer_variables(model.optimizer), optimizer_state):
+        variable.assign(value)
+
+    if not waits:
+        return {}
+
+    waits, computes = np.array(waits) * 1000, np.array(computes) * 1000
+
+    return {
+        'steps': int(len(waits)),
+        'input_wait_ms_mean': float(np.mean(waits)),
+        'input_wait_ms_p50': float(np.percentile(waits, 50)),
+        'input_wait_ms_p99': float(np.percentile(waits, 99)),
+        'compute_ms_mean': float(np.mean(computes)),
+        'compute_ms_p50': float(np.percentile(computes, 50)),
+        'compute_ms_p99': float(np.percentile(computes, 99)),
+        # Fraction of the step spent waiting for the input
+        'input_bound_fraction': float(np.sum(waits) / (np.sum(waits) + np.sum(computes))),
+        'input_wait_ms': waits.tolist(),
+        'compute_ms': computes.tolist(),
+    }
+
+
+def write_profile_report(profile_dir, report, file_name = 'profile_report.json'):
+    """
+    Write the profiling report next to the TensorBoard traces.
+    """
+    os.makedirs(profile_dir, exist_ok = True)
+    path = os.path.join(profile_dir, file_name)
+
+    with open(path, 'w') as f:
+        json.dump(report, f, indent = 2)
+
+    print(f"Profile report written to {path}")
+
+    return path
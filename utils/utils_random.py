@@ -0,0 +1,84 @@
+import tensorflow as tf
+
+
+
+### PER EXAMPLE SEEDS
+
+class AugmentationSeeds:
+    """
+    Seeds of the random augmentations (noise, spec augmentation), derived for every example
+    from (global seed, epoch, example index) with stateless ops.
+
+    The augmentations only use tf.random.stateless_* ops with these seeds, so their result
+    does not depend on the thread that runs the map function (num_parallel_calls = AUTOTUNE
+    is kept) nor on the machine : every epoch is reproducible, and the same example gets a
+    different augmentation at every epoch.
+
+    The epoch is a variable read by the dataset functions : it is advanced by
+    EpochCallback (see base_gnn.train), or by hand with set_epoch in a custom loop
+    (before creating the iterator of the epoch).
+
+    Args:
+        global_seed: Seed of the whole run
+    """
+
+    def __init__(self, global_seed = 0):
+        self.global_seed = global_seed
+        with tf.init_scope():
+            self.epoch = tf.Variable(0, dtype = tf.int64, trainable = False, name = 'augmentation_epoch')
+
+
+    def set_epoch(self, epoch):
+        self.epoch.assign(epoch)
+
+
+    def example_seed(self, index):
+        """
+        Seed [2] of the example with the given index (position in the list of files) at the current epoch.
+        """
+        seed = tf.constant([self.global_seed, 0], dtype = tf.int64)
+        seed = tf.random.experimental.stateless_fold_in(seed, self.epoch)
+
+        return tf.random.experimental.stateless_fold_in(seed, tf.cast(index, tf.int64))
+
+
+class EpochCallback(tf.keras.callbacks.Callback):
+    """
+    Advance the epoch of the augmentation seeds at the end of every epoch.
+
+    (At the end and not at the beginning : model.fit creates the iterator of the
+    epoch, which may already prefetch examples, before calling on_epoch_begin.)
+    """
+
+    def __init__(self, augmentation_seeds):
+        super().__init__()
+        self.augmentation_seeds = augmentation_seeds
+
+    def on_epoch_end(self, epoch, logs = None):
+        self.augmentation_seeds.set_epoch(epoch + 1)
+
+
+def split_seed(seed, num = 2):
+    """
+    Split a stateless seed [2] into num independent seeds [num, 2].
+    """
+    return tf.random.experimental.stateless_split(seed, num = num)
+
+
+def split_seeds(seeds, num = 2):
+    """
+    Split every seed of a batch of stateless seeds [B, 2] into num independent seeds : [num, B, 2].
+    """
+    split = tf.map_fn(lambda seed: tf.random.experimental.stateless_split(seed, num = num), seeds,
+                      fn_output_signature = seeds.dtype)
+
+    return tf.transpose(split, [1, 0, 2])
+
+
+def uniform_per_example(seeds, minval = 0., maxval = 1., dtype = tf.float32):
+    """
+    One uniform value per example [B], each drawn from the example's own stateless seed (seeds [B, 2]) :
+    the value of an example does not depend on the other examples of its batch.
+    """
+    return tf.map_fn(lambda seed: tf.random.stateless_uniform([], seed, minval = minval, maxval = maxval, dtype = dtype), seeds,
+                     fn_output_signature = dtype)
@@ -0,0 +1,586 @@
+import time
+import queue
+import numpy as np
+import tensorflow as tf
+import sounddevice as sd
+from utils import utils_data, utils_graph
+from models import base_gnn
+
+
+
+# Same graph as the one used for training in main.py
+DEFAULT_GRAPH_KWARGS = {'mode': 'cosine window', 'window_size_cosine': 25, 'n_dilation_layers': 0, 'window_size': 5}
+
+# Largest accepted difference between the incremental features and the ones of the whole window :
+# the window deltas are one matrix product (utils_data.compute_deltas), the incremental ones a
+# sum of a few rows, so they only agree up to float32 rounding
+INCREMENTAL_TOLERANCE = 1e-3
+
+
+
+### RING BUFFER
+
+class RingBuffer:
+    """
+    Fixed size FIFO of rows (audio samples, feature frames, posteriors) backed by a
+    preallocated numpy array : writing never allocates, and once the buffer is full
+    the oldest rows are overwritten.
+    """
+
+    def __init__(self, capacity, row_shape = (), dtype = np.float32):
+        self.capacity = capacity
+        self.buffer = np.zeros((capacity,) + tuple(row_shape), dtype = dtype)
+        self.write_index = 0
+        self.total_written = 0
+
+    def __len__(self):
+        return min(self.total_written, self.capacity)
+
+    def write(self, rows):
+        rows = np.asarray(rows, dtype = self.buffer.dtype).reshape((-1,) + self.buffer.shape[1:])
+        n = len(rows)
+
+        # Only the last 'capacity' rows can survive
+        if n > self.capacity:
+            rows = rows[-self.capacity:]
+
+        first = min(len(rows), self.capacity - self.write_index)
+        self.buffer[self.write_index:self.write_index + first] = rows[:first]
+        self.buffer[:len(rows) - first] = rows[first:]
+
+        self.write_index = (self.write_index + len(rows)) % self.capacity
+        self.total_written += n
+
+    def latest(self, n):
+        """
+        Return (a copy of) the last n rows, oldest first.
+        """
+        if n > len(self):
+            raise ValueError(f"Only {len(self)} rows available, {n} requested")
+
+        start = (self.write_index - n) % self.capacity
+        if start + n <= self.capacity:
+            return self.buffer[start:start + n].copy()
+
+        return np.concatenate([self.buffer[start:], self.buffer[:start + n - self.capacity]])
+
+    def reset(self):
+        self.write_index = 0
+        self.total_written = 0
+
+
+
+### AUDIO SOURCES
+
+class FileAudioSource:
+    """
+    Audio source reading a WAV file hop by hop, to test the streaming detector without a microphone.
+
+    Args:
+        file_path: Path to the audio file (mono, at the detector sample rate)
+        hop_length: Number of samples returned by each read
+        realtime: If True, reads are paced at the audio rate (like a microphone)
+    """
+
+    def __init__(self, file_path, hop_length = 160, realtime = False):
+        wav, sample_rate = utils_data.read_path_to_wav(file_path)
+        self.wav = wav.numpy()[:, 0]
+        self.sample_rate = int(sample_rate)
+        self.hop_length = hop_length
+        self.realtime = realtime
+        self.position = 0
+
+    def __enter__(self):
+        self.position = 0
+        self.start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def read(self):
+        """
+        Return the next hop of audio, or None at the end of the file.
+        """
+        if self.position >= len(self.wav):
+            return None
+
+        chunk = self.wav[self.position:self.position + self.hop_length]
+        self.position += len(chunk)
+
+        if self.realtime:
+            # Wait until the audio of this chunk would have been recorded
+            delay = self.start_time + self.position / self.sample_rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+
+        return chunk
+
+
+class MicrophoneAudioSource:
+    """
+    Audio source recording from the microphone (through sounddevice).
+    The audio callback only queues the blocks, the processing happens in read().
+
+    Args:
+        sample_rate: Recording sample rate
+        hop_length: Number of samples per block
+        device: sounddevice input device (None for the default one)
+    """
+
+    def __init__(self, sample_rate = 16000, hop_length = 160, device = None):
+        self.sample_rate = sample_rate
+        self.hop_length = hop_length
+        self.blocks = queue.Queue()
+        self.stream = sd.InputStream(samplerate = sample_rate, blocksize = hop_length, device = device,
+                                     channels = 1, dtype = 'float32', callback = self._callback)
+
+    def _callback(self, indata, frames, time_info, status):
+        if status:
+            print(f"Microphone: {status}")
+        self.blocks.put(indata[:, 0].copy())
+
+    def __enter__(self):
+        self.stream.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stream.stop()
+        self.stream.close()
+
+    def read(self, timeout = 1.0):
+        """
+        Return the next block of audio (None if nothing was recorded within the timeout).
+        """
+        try:
+            return self.blocks.get(timeout = timeout)
+        except queue.Empty:
+            return None
+
+
+
+### INCREMENTAL FEATURES
+
+def delta_rows(block, M = 2):
+    """
+    numpy version of utils_data.compute_delta (same symmetric padding), used on the few rows
+    at the window boundaries. The features of a whole window come from utils_data.compute_deltas
+    (products with delta_operators, which compute the same values up to float rounding).
+    """
+    frame_count = len(block)
+    padded = np.pad(block, [[M, M], [0, 0]], mode='symmetric')
+    denominator = 2 * sum([m**2 for m in range(1, M+1)])
+
+    deltas = np.zeros_like(block)
+    for m in range(1, M+1):
+        deltas += m * (padded[M+m:M+m+frame_count] - padded[M-m:M-m+frame_count]) / denominator
+
+    return deltas
+
+
+def interior_delta(rows, M = 2):
+    """
+    Delta of the middle row of 2M+1 consecutive rows (no padding involved).
+    """
+    denominator = 2 * sum([m**2 for m in range(1, M+1)])
+
+    delta = np.zeros_like(rows[M])
+    for m in range(1, M+1):
+        delta += m * (rows[M+m] - rows[M-m]) / denominator
+
+    return delta
+
+
+class IncrementalFeatureExtractor:
+    """
+    Computes the features of a sliding window of num_frames frames, moving by one
+    frame (frame_step samples) at a time, at the cost of a single new frame per hop.
+
+    For every new frame t, only
+        - its static features (STFT, filterbank, DCT and log energy of one frame),
+        - the delta of frame t - M (its +-M context is now complete),
+        - the delta-delta of frame t - 2M
+    are computed, and kept in ring buffers. Inside a window the deltas equal these
+    stream values, except near the window boundaries, where compute_delta pads the
+    window symmetrically : the first/last M deltas and the first/last 2M delta-deltas
+    are recomputed from the boundary rows only. The result is the output of get_gnccs / get_mfccs
+    on the window (i.e. extract_features(..., noise_reduction_mode = None) on the corresponding second
+    of audio) up to float32 rounding : these compute the deltas as products with
+    utils_data.delta_operators, in another summation order (see incremental_parity).
+
+    Args:
+        gammatone: GNCCs (True) or MFCCs (False)
+        sample_rate, frame_length, frame_step: As used for training
+        num_frames: Number of frames per window (98 for one second)
+        M: Delta context (as in compute_delta)
+        num_coeffs: Number of cepstral coefficients
+        frontend: Optional utils_data.FeatureFrontend (without noise reduction) : its configuration
+                  replaces the arguments above, and its filterbank is used for every frame
+    """
+
+    def __init__(self, gammatone = True, sample_rate = 16000, frame_length = 400, frame_step = 160, num_frames = 98, M = 2, num_coeffs = 12, frontend = None):
+        if frontend is not None:
+            if frontend.noise_reduction_mode is not None:
+                raise ValueError("The noise reduction is not causal : streaming needs a frontend with noise_reduction_mode = None")
+            gammatone, sample_rate, frame_length, frame_step = frontend.gammatone, frontend.sample_rate, frontend.frame_length, frontend.frame_step
+            num_frames, M, num_coeffs = frontend.num_frames, frontend.M, frontend.num_coeffs
+
+        if num_frames < 6 * M:
+            raise ValueError(f"The window must have at least {6 * M} frames")
+
+        self.gammatone = gammatone
+        self.sample_rate = sample_rate
+        self.frame_length = frame_length
+        self.frame_step = frame_step
+        self.num_frames = num_frames
+        self.M = M
+        self.num_coeffs = num_coeffs
+        self.frontend = frontend
+
+        # Cepstral coefficients + log energy per frame
+        num_static = num_coeffs + 1
+        self.audio = RingBuffer(frame_length)
+        self.static = RingBuffer(num_frames, (num_static,))
+        self.delta_1 = RingBuffer(num_frames - 2 * M, (num_static,))
+        self.delta_2 = RingBuffer(num_frames - 4 * M, (num_static,))
+
+        self.featurize_frame = tf.function(self._featurize_frame, input_signature = [tf.TensorSpec([frame_length], tf.float32)])
+
+        self.reset()
+
+
+    def reset(self):
+        self.audio.reset()
+        self.static.reset()
+        self.delta_1.reset()
+        self.delta_2.reset()
+        self.next_frame_end = self.frame_length
+
+
+    @property
+    def num_samples(self):
+        return self.audio.total_written
+
+
+    @property
+    def ready(self):
+        return self.static.total_written >= self.num_frames
+
+
+    def _featurize_frame(self, frame):
+        if self.frontend is not None:
+            return self.frontend.static_features(frame)
+
+        # Same computations as get_spectrogram / apply_*_filterbanks / get_*ccs, for a single frame
+        spectrogram, _ = utils_data.get_spectrogram(frame, self.sample_rate, frame_length = self.frame_length, frame_step = self.frame_step)
+
+        if self.gammatone:
+            log_spectrogram = utils_data.apply_gammatone_filterbanks(spectrogram, self.sample_rate)
+            cepstra = tf.signal.dct(log_spectrogram, type=2)[..., 1:self.num_coeffs+1]
+        else:
+            log_spectrogram = utils_data.apply_mel_filterbanks(spectrogram, self.sample_rate)
+            cepstra = tf.signal.mfccs_from_log_mel_spectrograms(log_spectrogram)[..., 1:self.num_coeffs+1]
+
+        log_frame_energy = tf.math.log(tf.reduce_sum(frame**2) + np.finfo(float).eps)/tf.math.log(10.0)
+
+        return tf.concat([cepstra[0], [log_frame_energy]], axis=0)
+
+
+    def add_frame(self, frame):
+        """
+        Featurize one new frame (frame_length samples) and update the delta state.
+        """
+        M = self.M
+        self.static.write(self.featurize_frame(frame).numpy())
+
+        # Delta of frame t - M
+        if self.static.total_written >= 2 * M + 1:
+            self.delta_1.write(interior_delta(self.static.latest(2 * M + 1), M))
+
+        # Delta-delta of frame t - 2M
+        if self.delta_1.total_written >= 2 * M + 1:
+            self.delta_2.write(interior_delta(self.delta_1.latest(2 * M + 1), M))
+
+
+    def frames(self, chunk):
+        """
+        Push a chunk of audio (any length); yields once for every frame completed by it.
+        """
+        chunk = np.asarray(chunk, dtype = np.float32)
+
+        while len(chunk) > 0:
+            # Write up to the end of the next frame
+            n = min(self.next_frame_end - self.audio.total_written, len(chunk))
+            self.audio.write(chunk[:n])
+            chunk = chunk[n:]
+
+            if self.audio.total_written < self.next_frame_end:
+                return
+
+            self.add_frame(self.audio.latest(self.frame_length))
+            self.next_frame_end += self.frame_step
+
+            yield
+
+
+    def window_features(self):
+        """
+        Features of the last num_frames frames.
+
+        Returns:
+            features: [num_frames, 3 * num_coeffs + 3], ordered like get_gnccs / get_mfccs
+        """
+        M, N, c = self.M, self.num_frames, self.num_coeffs
+
+        static = self.static.latest(N)
+
+        # Deltas : stream values inside, recomputed (symmetric padding) at the boundaries
+        delta_1 = np.empty_like(static)
+        delta_1[M:N-M] = self.delta_1.latest(N - 2 * M)
+        delta_1[:M] = delta_rows(static[:2*M], M)[:M]
+        delta_1[N-M:] = delta_rows(static[N-2*M:], M)[M:]
+
+        delta_2 = np.empty_like(static)
+        delta_2[2*M:N-2*M] = self.delta_2.latest(N - 4 * M)
+        delta_2[:2*M] = delta_rows(delta_1[:3*M], M)[:2*M]
+        delta_2[N-2*M:] = delta_rows(delta_1[N-3*M:], M)[M:]
+
+        return np.concatenate([static[:, :c], delta_1[:, :c], delta_2[:, :c],
+                               static[:, c:], delta_1[:, c:], delta_2[:, c:]], axis=-1)
+
+
+def incremental_parity(wav, gammatone = True, sample_rate = 16000, frame_length = 400, frame_step = 160, max_windows = None, frontend = None,
+                       tolerance = INCREMENTAL_TOLERANCE):
+    """
+    Compare the incremental features with extract_features(..., noise_reduction_mode = None)
+    (or with the frontend, if given) run on every one-second window of wav.
+
+    Args:
+        tolerance: Largest accepted absolute difference (None to only report it)
+    Returns:
+        max_abs_error: Largest absolute difference over all the windows
+    Raises:
+        AssertionError: If max_abs_error exceeds the tolerance
+    """
+    wav = np.asarray(wav, dtype = np.float32)
+    extractor = IncrementalFeatureExtractor(gammatone = gammatone, sample_rate = sample_rate, frame_length = frame_length, frame_step = frame_step,
+                                            frontend = frontend)
+    frame_length, frame_step = extractor.frame_length, extractor.frame_step
+    clip_length = frontend.clip_length if frontend is not None else 16000
+
+    max_abs_error = 0.0
+    num_windows = 0
+    for _ in extractor.frames(wav):
+        if not extractor.ready:
+            continue
+
+        window_start = extractor.num_samples - frame_length - (extractor.num_frames - 1) * frame_step
+        window = wav[window_start:window_start + clip_length]
+        window = np.pad(window, [0, clip_length - len(window)])
+
+        if frontend is not None:
+            reference = frontend(tf.constant(window[np.newaxis]))[0]
+        else:
+            reference, _, _ = utils_data.extract_features(tf.constant(window), 0, sample_rate, frame_length, frame_step,
+                                                          gammatone = gammatone, noise_reduction_mode = None)
+        max_abs_error = max(max_abs_error, float(np.max(np.abs(reference.numpy() - extractor.window_features()))))
+
+        num_windows += 1
+        if max_windows is not None and num_windows >= max_windows:
+            break
+
+    if tolerance is not None and max_abs_error > tolerance:
+        raise AssertionError(f"The incremental features differ from the window features by {max_abs_error} (tolerance {tolerance})")
+
+    return max_abs_error
+
+
+
+### STREAMING DETECTOR
+
+class StreamingDetector:
+    """
+    Streaming keyword spotter.
+
+    The audio is pushed (in chunks of any size) into an IncrementalFeatureExtractor;
+    every frame_step new samples a new frame is complete and only that frame is
+    featurized, so the sliding window over the last second never recomputes the
+    frames it shares with the previous one.
+    The GNN then classifies the window, the posteriors are smoothed with a moving
+    average and a keyword is detected when its smoothed posterior exceeds the threshold
+    (at most once per refractory period).
+
+    The features match utils_data.extract_features(..., noise_reduction_mode = None)
+    (up to float rounding, see incremental_parity), so the model must be trained without noise reduction (which needs the whole clip).
+
+    Args:
+        model: Trained GNN (batched GraphTensor -> logits)
+        gammatone: GNCCs (True) or MFCCs (False), as used for training
+        sample_rate, frame_length, frame_step: As used for training
+        num_frames: Number of frames per window (98 for one second)
+        graph_kwargs: Arguments of utils_graph.create_edge_lists, as used for training
+        class_names: Optional list of class names, for the detections
+        threshold: Smoothed posterior needed for a detection
+        smoothing_window: Number of posteriors averaged (one per classified hop)
+        refractory_frames: Minimum number of frames between two detections
+        classify_every: Classify every n new frames (1 = every hop)
+        ignore_classes: Class indices never reported (e.g. silence / unknown)
+        frontend: Optional utils_data.FeatureFrontend the model was trained with (replaces gammatone,
+                  sample_rate, frame_length, frame_step and num_frames)
+    """
+
+    def __init__(self, model, gammatone = True, sample_rate = 16000, frame_length = 400, frame_step = 160, num_frames = 98,
+                 graph_kwargs = None, class_names = None, threshold = 0.8, smoothing_window = 5, refractory_frames = 50,
+                 classify_every = 1, ignore_classes = (), frontend = None):
+
+        if frontend is not None:
+            gammatone, sample_rate, frame_length, frame_step = frontend.gammatone, frontend.sample_rate, frontend.frame_length, frontend.frame_step
+            num_frames = frontend.num_frames
+
+        self.model = model
+        self.gammatone = gammatone
+        self.sample_rate = sample_rate
+        self.frame_length = frame_length
+        self.frame_step = frame_step
+        self.num_frames = num_frames
+        self.graph_kwargs = dict(DEFAULT_GRAPH_KWARGS if graph_kwargs is None else graph_kwargs)
+        self.class_names = class_names
+        self.threshold = threshold
+        self.refractory_frames = refractory_frames
+        self.classify_every = classify_every
+        self.ignore_classes = list(ignore_classes)
+
+        self.num_classes = int(model.output_shape[-1])
+
+        self.extractor = IncrementalFeatureExtractor(gammatone = gammatone, sample_rate = sample_rate, frame_length = frame_length,
+                                                     frame_step = frame_step, num_frames = num_frames, frontend = frontend)
+        self.posteriors = RingBuffer(smoothing_window, (self.num_classes,))
+
+        num_features = frontend.num_features if frontend is not None else 39
+        self.classify = tf.function(self._classify, input_signature = [tf.TensorSpec([num_frames, num_features], tf.float32)])
+
+        self.reset()
+
+
+    def reset(self):
+        self.extractor.reset()
+        self.posteriors.reset()
+        self.frames_since_detection = self.refractory_frames
+        self.hop_latencies = []
+
+
+    def _classify(self, features):
+        features, edge_lists, _ = utils_graph.create_edge_lists(features, self.num_frames, 0, **self.graph_kwargs)
+        graph, _ = base_gnn.edge_lists_to_graph_tensors_for_dataset(features, edge_lists, 0)
+
+        # The model expects a batch of graphs
+        graph = tf.data.Dataset.from_tensors(graph).batch(1).get_single_element()
+
+        logits = self.model(graph, training = False)
+
+        return tf.nn.softmax(logits[0])
+
+
+    def process(self, chunk):
+        """
+        Push a chunk of audio through the detector.
+
+        Args:
+            chunk: 1D array of samples (any length)
+        Returns:
+            detections: List of detections ({'label', 'class_name', 'score', 'time'}) triggered by this chunk
+        """
+        detections = []
+
+        # Time from the arrival of the samples completing a frame to the (possible) detection
+        start = time.perf_counter()
+        for _ in self.extractor.frames(chunk):
+            detection = self._new_frame()
+
+            now = time.perf_counter()
+            self.hop_latencies.append(now - start)
+            start = now
+
+            if detection is not None:
+                detections.append(detection)
+
+        return detections
+
+
+    def _new_frame(self):
+        self.frames_since_detection += 1
+
+        num_computed = self.extractor.static.total_written
+        if num_computed < self.num_frames or (num_computed - self.num_frames) % self.classify_every != 0:
+            return None
+
+        self.posteriors.write(self.classify(self.extractor.window_features()).numpy())
+
+        # Moving average of the last posteriors
+        smoothed = self.posteriors.latest(len(self.posteriors)).mean(axis=0)
+        smoothed[self.ignore_classes] = 0
+
+        label = int(np.argmax(smoothed))
+        score = float(smoothed[label])
+
+        if score < self.threshold or self.frames_since_detection < self.refractory_frames:
+            return None
+
+        self.frames_since_detection = 0
+
+        return {
+            'label': label,
+            'class_name': self.class_names[label] if self.class_names is not None else None,
+            'score': score,
+            # End of the window, in seconds from the start of the stream
+            'time': self.extractor.num_samples / self.sample_rate,
+        }
+
+
+    def run(self, source, on_detection = None, max_seconds = None):
+        """
+        Run the detector on an audio source until it is exhausted (or for max_seconds of audio).
+
+        Args:
+            source: FileAudioSource or MicrophoneAudioSource
+            on_detection: Optional callback, called with every detection
+            max_seconds: Optional limit on the processed audio
+        Returns:
+            detections: List of all detections
+        """
+        detections = []
+
+        with source:
+            while max_seconds is None or self.extractor.num_samples < max_seconds * self.sample_rate:
+                chunk = source.read()
+                if chunk is None:
+                    if isinstance(source, FileAudioSource):
+                        break
+                    continue
+
+                for detection in self.process(chunk):
+                    detections.append(detection)
+                    if on_detection is not None:
+                        on_detection(detection)
+
+        return detections
+
+
+    def latency_stats(self):
+        """
+        Processing time per hop (new frame + classification), compared to the hop duration.
+        """
+        if not self.hop_latencies:
+            return {}
+
+        latencies = np.asarray(self.hop_latencies) * 1000
+        hop_ms = 1000 * self.frame_step / self.sample_rate
+
+        return {
+            'hops': int(len(latencies)),
+            'hop_ms': hop_ms,
+            'p50_ms': float(np.percentile(latencies, 50)),
+            'p99_ms': float(np.percentile(latencies, 99)),
+            'max_ms': float(np.max(latencies)),
+            'fraction_over_hop': float(np.mean(latencies > hop_ms)),
+        }
@@ -0,0 +1,137 @@
+import os
+import json
+import tensorflow as tf
+import tensorflow_gnn as tfgnn
+
+
+
+# The label travels inside the graph, as a context feature
+LABEL_FEATURE = 'label'
+SCHEMA_FILE_NAME = 'schema.pbtxt'
+# Written next to the schema : how the shards are stored (compression)
+OPTIONS_FILE_NAME = 'tfrecord_options.json'
+
+
+
+### EXPORT
+
+def add_label_to_graph(graph, label):
+    """
+    Store the label of an (unbatched) graph as a context feature, so that the
+    GraphTensor can be serialized on its own.
+    """
+    return graph.replace_features(context = {LABEL_FEATURE: tf.reshape(tf.cast(label, tf.int64), [1])})
+
+
+def write_graph_tfrecords(ds, output_dir, num_shards = 16, compression = None):
+    """
+    Serialize a dataset of ready-to-train GraphTensors into sharded TFRecord files,
+    together with the graph schema needed to parse them back.
+
+    On disk:
+        output_dir/schema.pbtxt
+        output_dir/tfrecord_options.json  (compression, read back by read_graph_tfrecords)
+        output_dir/graphs.tfrecord-00000-of-00016
+        ...
+
+    Args:
+        ds: Unbatched dataset of (graph_tensor, label)
+            (e.g. the output of base_gnn.edge_lists_to_graph_tensors_for_dataset)
+        output_dir: Directory to write the shards to
+        num_shards: Number of TFRecord files
+        compression: None, 'GZIP' or 'ZLIB'
+    Returns:
+        shard_paths: List of the written TFRecord files
+    """
+    os.makedirs(output_dir, exist_ok = True)
+
+    ds = ds.map(add_label_to_graph, num_parallel_calls = tf.data.AUTOTUNE)
+
+    # Write the schema describing the graphs (including the label)
+    schema = tfgnn.create_schema_pb_from_graph_spec(ds.element_spec)
+    tfgnn.write_schema(schema, os.path.join(output_dir, SCHEMA_FILE_NAME))
+
+    with open(os.path.join(output_dir, OPTIONS_FILE_NAME), 'w') as f:
+        json.dump({'compression': compression or None, 'num_shards': num_shards}, f)
+
+    options = tf.io.TFRecordOptions(compression_type = compression or '')
+    shard_paths = [os.path.join(output_dir, f"graphs.tfrecord-{i:05d}-of-{num_shards:05d}") for i in range(num_shards)]
+    writers = [tf.io.TFRecordWriter(path, options = options) for path in shard_paths]
+
+    # Distribute the examples round-robin over the shards
+    num_graphs = 0
+    for graph in ds:
+        example = tfgnn.write_example(graph)
+        writers[num_graphs % num_shards].write(example.SerializeToString())
+        num_graphs += 1
+
+    for writer in writers:
+        writer.close()
+
+    print(f"Wrote {num_graphs} graphs to {num_shards} shards in {output_dir}")
+
+    return shard_paths
+
+
+
+### IMPORT
+
+def read_tfrecord_options(input_dir):
+    """
+    Options recorded by write_graph_tfrecords (empty for directories written before they were recorded).
+    """
+    path = os.path.join(input_dir, OPTIONS_FILE_NAME)
+    if not os.path.exists(path):
+        return {}
+
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def read_graph_tfrecords(input_dir, batch_size = 64, shuffle = False, compression = 'auto', shuffle_buffer_size = 10000, cycle_length = 4):
+    """
+    Read the graphs written by write_graph_tfrecords, interleaving the shards.
+
+    Args:
+        input_dir: Directory containing the schema and the shards
+        batch_size: Batch size (the serialized examples are parsed per batch);
+                    None to get unbatched graphs
+        shuffle: Whether to shuffle shards and examples (use it for training)
+        compression: None, 'GZIP' or 'ZLIB' ; defaults to the compression recorded by
+                     write_graph_tfrecords (no compression for directories without it)
+        shuffle_buffer_size: Size of the example shuffle buffer
+        cycle_length: Number of shards read concurrently
+    Returns:
+        dataset: TensorFlow dataset of (graph_tensor, label), ready for model.fit
+    """
+    schema = tfgnn.read_schema(os.path.join(input_dir, SCHEMA_FILE_NAME))
+    graph_spec = tfgnn.create_graph_spec_from_schema_pb(schema)
+
+    if compression == 'auto':
+        compression = read_tfrecord_options(input_dir).get('compression')
+
+    files = tf.data.Dataset.list_files(os.path.join(input_dir, 'graphs.tfrecord-*'), shuffle = shuffle)
+
+    ds = files.interleave(
+        lambda path: tf.data.TFRecordDataset(path, compression_type = compression or ''),
+        cycle_length = cycle_length,
+        num_parallel_calls = tf.data.AUTOTUNE,
+        deterministic = not shuffle)
+
+    if shuffle:
+        ds = ds.shuffle(buffer_size = shuffle_buffer_size)
+
+    if batch_size is not None:
+        ds = ds.batch(batch_size)
+        ds = ds.map(lambda serialized: tfgnn.parse_example(graph_spec, serialized), num_parallel_calls = tf.data.AUTOTUNE)
+    else:
+        ds = ds.map(lambda serialized: tfgnn.parse_single_example(graph_spec, serialized), num_parallel_calls = tf.data.AUTOTUNE)
+
+    def split_label(graph):
+        # Context features have one value per graph component (we have one component per graph)
+        label = tf.cast(graph.context[LABEL_FEATURE][..., 0], tf.int32)
+        return graph.remove_features(context = [LABEL_FEATURE]), label
+
+    ds = ds.map(split_label, num_parallel_calls = tf.data.AUTOTUNE)
+
+    return ds.prefetch(tf.data.AUTOTUNE)
@@ -116,3 +116,35 @@ def spec_augment_easy(spectrogram, freq_param = 10, time_param = 10, mode = 'all
     return spectrogram
 
 
+
+
+## Stateless version of spec_augment_easy : the masks are drawn from a seed [2]
+## (see utils_random.AugmentationSeeds), so they are reproducible in a parallel map
+
+
+def stateless_mask(spectrogram, param, axis, seed):
+    # Same mask as tfio.audio.freq_mask / time_mask : width f in [0, param), start f0 in [0, size - f),
+    # entries f0 ... f0 + f (spectrogram [time, freq]) are set to zero
+    size = tf.shape(spectrogram)[axis]
+    width_seed, start_seed = tf.unstack(tf.random.experimental.stateless_split(seed, num = 2))
+
+    f = tf.random.stateless_uniform([], width_seed, minval = 0, maxval = param, dtype = tf.int32)
+    f0 = tf.random.stateless_uniform([], start_seed, minval = 0, maxval = size - f, dtype = tf.int32)
+
+    indices = tf.range(size)
+    indices = tf.reshape(indices, [-1, 1] if axis == 0 else [1, -1])
+    condition = tf.math.logical_and(tf.math.greater_equal(indices, f0), tf.math.less_equal(indices, f0 + f))
+
+    return tf.where(condition, tf.cast(0, spectrogram.dtype), spectrogram)
+
+
+def spec_augment_stateless(spectrogram, seed, freq_param = 10, time_param = 10, mode = 'all'):
+    freq_seed, time_seed = tf.unstack(tf.random.experimental.stateless_split(seed, num = 2))
+
+    if mode in ('all', 'freq'):
+        spectrogram = stateless_mask(spectrogram, freq_param, axis = 1, seed = freq_seed)
+
+    if mode in ('all', 'time'):
+        spectrogram = stateless_mask(spectrogram, time_param, axis = 0, seed = time_seed)
+
+    return spectrogram